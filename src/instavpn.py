@@ -4,36 +4,53 @@
 InstaVPN - Instance-based VPN builder for AWS VPC.
 
 Usage:
-  instavpn.py [-v | -q] [-y] -i  [-o <CONFIG>]
-  instavpn.py [-v | -q] [-y] -c <CONFIG>
+  instavpn.py [-v | -q] [-y | -p] [-t <ID> | -s] [--profile=<FORMAT>] -i  [-o <CONFIG>]
+  instavpn.py [-v | -q] [-y | -p] [-t <ID> | -s] [--profile=<FORMAT>] -c <CONFIG>
+  instavpn.py [-v | -q] [-y] -t <ID> --rotate-psk [--profile=<FORMAT>] -c <CONFIG>
+  instavpn.py [-v | -q] [-y] [-s] [--profile=<FORMAT>] -f <MANIFEST> [-j <N>]
+  instavpn.py [-v | -q] [-y] --bake -c <CONFIG>
+  instavpn.py [-v | -q] [-j <N>] [--profile=<FORMAT>] --validate <PATH>...
   instavpn.py -h | -V
 
 Options:
   -y --yes      Commit change and build stack without asking.
+  -p --plan     Show what would be built or changed, without changing anything.
+  -t --task=<ID>  Update an existing deployment, by its task ID or stack name.
+  --rotate-psk  Replace the shared secret of the deployment given by -t.
+  -s --single-pass  Allocate EIPs with EC2 calls and create each stack once,
+                instead of creating EIP stacks then updating them.
   -h --help     Show this screen.
   -i --interactive  Interactive UI.
   -c --config   Load config from json
   -o --output   Save config as json.
+  -f --fleet    Check and build every config listed in a manifest.
+  -j --jobs=<N>  Max concurrent deployments in fleet mode, overrides manifest;
+                 processes for --validate.
+  --bake        Bake VPN images in the account and region of both sides of
+                a config, used by stacks created afterwards.
+  --validate    Validate configs offline: json files, directories of them,
+                NDJSON files (.ndjson, .jsonl) or - for NDJSON on stdin.
+  --profile=<FORMAT>  Trace checks, build phases and AWS calls, and write
+                the trace as `chrome` trace events or a `summary` to
+                log_path in instavpn.json.
   -q --quiet    Quiet outputs.
   -v --verbose  Verbose outputs.
   -V --version  Show version.
 """
 
-from docopt import docopt
-arg = docopt(__doc__, version="InstaVPN 0.1")
-
+# Keep module-level imports light; boto and the modules built on it are
+# imported by the code paths that need them, see "Startup time" in USAGE.md.
 import sys
 from json import dump, dumps
-from termcolor import colored
 
 from lib.io import load_json
 from lib.ui import show, ask
-from lib.config import ask_config
-from lib.checker import chk_session
-from lib.actuator import build_world
+
+arg = None
 
 def build_config(arg):
     if arg["--interactive"]:
+        from lib.config import ask_config
         return ask_config()
     elif arg["--config"]:
         return load_json(sys.stdin) if '-' == arg["<CONFIG>"] \
@@ -41,6 +58,87 @@ def build_config(arg):
 
     return None
 
+def fleet():
+    """Fleet entry point"""
+
+    from lib.fleet import load_manifest, run_fleet, show_report
+
+    try:
+        jobs, limits = load_manifest(arg["<MANIFEST>"])
+    except IOError as e:
+        show.error('IOError:', "%s" % e)
+        sys.exit(1)
+    except ValueError as e:
+        show.error('ValueError:', "Manifest and config files should be valid json. %s" % e)
+        sys.exit(1)
+
+    if arg["--jobs"]:
+        limits["jobs"] = int(arg["--jobs"])
+
+    confirm = None if arg["--yes"] else \
+        lambda n: 'y' == ask.yn("Build %d VPNs ?" % n, default='y').lower()
+
+    if not show_report(run_fleet(jobs, limits, confirm, arg["--single-pass"])):
+        sys.exit(1)
+
+def validate():
+    """Offline validator entry point"""
+
+    from lib.validator import validate_paths
+
+    try:
+        results = validate_paths(arg["<PATH>"], int(arg["--jobs"]) if arg["--jobs"] else None)
+    except IOError as e:
+        show.error('IOError:', "%s" % e)
+        sys.exit(1)
+
+    for name, errors, warnings in results:
+        for error in errors:
+            show.error(name, error)
+        for warning in warnings:
+            show.unless_quiet(name, warning)
+
+    failed = len([r for r in results if r[1]])
+    show.output("Validated:", "%d configs, %d failed" % (len(results), failed))
+
+    if failed:
+        sys.exit(1)
+
+def bake(config):
+    """Image baking entry point"""
+
+    from lib.bake import bake as bake_images
+
+    targets = [(config[side]["identity"], config[side]["res"]["subnet_id"])
+        for side in ("server", "client")]
+    regions = sorted(set(identity["region"] for identity, _ in targets))
+
+    if not arg["--yes"] and 'y' != ask.yn("Bake images in %s ?" % ", ".join(regions), default='y').lower():
+        return
+
+    show.output("Baking images", "which usually takes 10 to 20 minutes.")
+    baked, errors = bake_images(targets)
+
+    for account, by_region in sorted(baked.items()):
+        for region, images in sorted(by_region.items()):
+            for arch, ami in sorted(images.items()):
+                show.output("Baked", "%s for %s %s in %s" % (ami, arch, region, account))
+    for (account, region, arch), error in sorted(errors.items()):
+        show.error("Can't bake", "%s %s in %s: %s" % (arch, region, account, error))
+
+    if errors:
+        sys.exit(1)
+
+def profile():
+    """Write trace of this run, see --profile"""
+
+    from time import strftime
+    from lib import trace
+    from lib.io import log_file
+
+    filename = log_file("instavpn-%s-%s.json" % (strftime("%Y%m%d-%H%M%S"), arg["--profile"]))
+    show.output("Profile", "written to %s" % trace.export(filename, arg["--profile"]))
+
 def instavpn():
     """Main entry point"""
 
@@ -49,6 +147,12 @@ def instavpn():
     elif arg["--quiet"]:
         show.set_verbosity(show.QUIET)
 
+    if arg["--fleet"]:
+        return fleet()
+
+    if arg["--validate"]:
+        return validate()
+
     # Load Config
     config = None
     try:
@@ -71,6 +175,9 @@ def instavpn():
         except IOError:
             show.error("Can't save to %s." % arg["<CONFIG>"])
 
+    if arg["--bake"]:
+        return bake(config)
+
     # `params` and `tags` are built later in `chk_session()` call, where related
     # entries in `config[*]` should also follow AWS convention to use CamelCase,
     # instead of snake_case.
@@ -78,23 +185,54 @@ def instavpn():
     session = {
         "config": config,
         "conn": {},
+        "task_id": arg["--task"],
+        "single_pass": arg["--single-pass"],
     }
 
+    from lib.checker import chk_session
+    from lib.actuator import build_world, plan_world, rotate_psk
+
     # Condition and Test Config
     if not chk_session(session):
         show.error("Job terminated", "due to failed config check(s).")
         sys.exit(1)
 
+    if arg["--rotate-psk"]:
+        if arg["--yes"] or 'y' == ask.yn("Rotate PSK ?", default='y').lower():
+            rotate_psk(session)
+        return
+
+    if arg["--plan"]:
+        show.output("Plan:", dumps(plan_world(session), indent=4, sort_keys=True))
+        return
+
     # Final check & go
-    should_build_vpn = 'y' if arg["--yes"] else ask.yn("Build VPN ?", default='y')
+    should_build_vpn = 'y' if arg["--yes"] else \
+        ask.yn("Update VPN ?" if arg["--task"] else "Build VPN ?", default='y')
     if 'y' == should_build_vpn.lower():
         build_world(session)
 
     return
 
 if "__main__" == __name__:
+    from docopt import docopt
+    arg = docopt(__doc__, version="InstaVPN 0.1")
+
+    if arg["--profile"]:
+        from lib import trace
+        if arg["--profile"] not in trace.FORMATS:
+            show.error("--profile", "should be one of %s" % ", ".join(trace.FORMATS))
+            sys.exit(1)
+        trace.enable()
+
     try:
         instavpn()
     except KeyboardInterrupt:
         show.error("\nJob Cancelled")
+    finally:
+        metrics = sys.modules.get("lib.metrics") # Only loaded once AWS was used
+        if metrics:
+            metrics.show_api_metrics()
+        if arg["--profile"]:
+            profile()
 
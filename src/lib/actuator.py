@@ -3,151 +3,814 @@
 
 
 """
+import json
+import re
+
 from boto.exception import EC2ResponseError
-from time import sleep
-from json import dumps
 
 from .ui import show
-from .io import load_tpl
-
+from .io import compile_tpl
+from .keys import create_shared_secret
+from .parallel import run_parallel
+from .trace import span, traced
+from .retry import retry
+from .bake import baked_image
+from .metrics import error_code
+from .monitor import TAG as MONITOR_TAG
+from .waiter import StackWaiter, stack_missing, STATE_FAILED, STATE_UPDATABLE
+
+SIDES = (("client", "Client"), ("server", "Server"))
+
+# cfn-init file of the cfn-hup hook reloading SharedSecret, see rotate_psk
+PSK_HOOK = "/etc/cfn/hooks.d/instavpn-psk.conf"
+
+EIP_PARAMS = ("ServerEIP", "ServerEIPId", "ClientEIP", "ClientEIPId")
+
+# main.json parameters the template is compiled for, and their defaults;
+# they only take effect at boot, so updates keep the values a stack was
+# created with
+TEMPLATE_PARAMS = {"EIPAllocation": "Stack", "BakedImageId": "", "TunnelProfile": "Default",
+    "HealthMonitor": "Disabled"}
+
+@traced("actuator")
 def build_world(session):
-    show.output("Building infrastructures in AWS")
+    """Creates or updates the stacks of every tunnel, then runs post-config
+
+    Tunnels are built concurrently, and so are their standby pairs with
+    `ha`; with an existing deployment, tunnels beyond the first one and
+    standby pairs are created if their stacks don't exist yet. If any
+    tunnel fails, the stacks of the others are deleted for a new deployment,
+    and reported for an existing one.
+    """
+
+    tunnels = _tunnels(session)
+
+    if session.get("task_id"):
+        show.output("Updating InstaVPN", session["tags"]["instavpn"])
+    elif session.get("single_pass"):
+        show.output("Building infrastructures in AWS", "in a single pass")
+    else:
+        show.output("Building infrastructures in AWS")
+
+    if len(tunnels) > 1:
+        show.unless_quiet("Tunnels", "%d pairs of VPN instances%s" % (len(tunnels),
+            ", half of them standby" if session["config"].get("ha") else ""))
 
-    session["stacks"] = {}
+    try:
+        run_parallel(dict((_tunnel_name(view), (lambda view=view: _build_tunnel(view)))
+            for view in tunnels))
+    except Exception:
+        if len(tunnels) > 1:
+            _abandon_tunnels(session, tunnels)
+        raise
 
-    cfn_eip(session)
-    cfn_main(session)
+    if len(tunnels) > 1:
+        session["stacks"] = tunnels[0]["stacks"]
+        session["eips"] = dict(("%s%s" % (side, _tunnel_suffix(view) or "-1"), address)
+            for view in tunnels for side, address in view.get("eips", {}).items())
 
-    post_conf(session)
+    post_conf(session, tunnels)
 
-    show.output("VPN created,", "and the supplied Route Table (if any), has been modified "
-        "to route traffic via the VPN.")
+    show.output("VPN %s," % ("updated" if session.get("task_id") else "created"),
+        "and the supplied Route Table (if any), has been modified to route traffic via the VPN.")
 
     show.output("To destroy the VPN,", "delete both CloudFormation Stacks on each sides. All resources "
         "allocated by InstaVPN, except for Route Table entry, will be cleaned up automatically.")
 
+    if session.get("eips"):
+        show.output("EIPs", "%s were allocated outside the stacks; release them once the stacks "
+            "are deleted." % ", ".join(a.allocation_id for _, a in sorted(session["eips"].items())))
+
+def _abandon_tunnels(session, tunnels):
+    """After a tunnel failed, so that no stack is left up without routes:
+    deletes the stacks of every tunnel of a new deployment and releases
+    their EIPs, or reports those of an existing one, left as they are"""
+
+    if session.get("task_id"):
+        stacks = [stack for view in tunnels for stack in view["stacks"].values()]
+        for stack in stacks:
+            try:
+                retry(stack.update)
+            except Exception:
+                pass # listed with the status it last had
+        names = sorted(stack.stack_name for stack in stacks if not stack.stack_status.startswith("DELETE_"))
+        if names:
+            show.error("Stacks left in place", "%s; client routes and security groups were not "
+                "updated. Rerun with -t once the failure is fixed." % ", ".join(names))
+        return
+
+    for view in tunnels:
+        _delete_stacks(view)
+    run_parallel(dict((_tunnel_name(view), (lambda view=view: release_eips(view)))
+        for view in tunnels if view.get("eips")))
+
+def _build_tunnel(session):
+    """Creates or updates the stacks of one tunnel"""
+
+    session["stacks"] = _existing_stacks(session)
+
+    if session["stacks"]:
+        cfn_update(session)
+    elif session.get("single_pass"):
+        allocate_eips(session)
+        cfn_create(session)
+    else:
+        cfn_eip(session)
+        cfn_main(session)
+
+@traced("actuator")
+def plan_world(session):
+    """What build_world would do, without changing anything in AWS
+
+    Returns a dict of CloudFormation parameters, server SG egress diff and
+    client route diff per side. Values only known after the stacks are
+    created are shown as <OutputName>, and SharedSecret is masked. With
+    several tunnels, or `ha`, the plans of tunnels after the first one and
+    of standby pairs are listed under "tunnels", and client routes cover
+    all active tunnels.
+    """
+
+    tunnels = _tunnels(session)
+    plans, instances = [], []
+
+    for view in tunnels:
+        plan, client_instance_id = _plan_tunnel(view)
+        plans.append(plan)
+        instances.append((view, client_instance_id))
+
+    dest, failover = _client_route_targets(instances)
+
+    plan = plans[0]
+    if len(tunnels) > 1:
+        plan["tunnels"] = plans[1:]
+        for view, tunnel_plan in zip(tunnels, plans):
+            tunnel_plan["server_cidrs"] = view["config"]["server"]["ipsec"]["subnets"]
+            if view.get("standby"):
+                tunnel_plan["standby"] = True
+
+    plan["client_routes"] = dict((rtb.id, dict(zip(("create", "replace", "delete"),
+        _route_diff(rtb.routes, _keep_failover(rtb.routes, dest, failover)))))
+        for rtb in client_route_tables(session))
+
+    return plan
+
+def _plan_tunnel(session):
+    """Returns (plan without client routes, client instance ID or <ClientInstanceId>)"""
+
+    def _params(params):
+        return [[k, "****" if "SharedSecret" == k else v] for k, v in params]
+
+    stacks = _existing_stacks(session)
+    if stacks:
+        return _plan_update(session, stacks)
+
+    eips = [(k, "<%s>" % k) for k in EIP_PARAMS]
+
+    if session.get("single_pass"):
+        stages = lambda side, MySide: {
+            "allocate": ["<%sEIP>" % MySide],
+            "create": {"template": "main.json", "parameters": _params(sorted(session["params"] + eips) +
+                [("EIPAllocation", "Imported")] + _side_params(session, side, MySide))},
+        }
+    else:
+        stages = lambda side, MySide: {
+            "create": {"template": "eip.json", "parameters": _params([("MySide", MySide)])},
+            "update": {"template": "main.json",
+                "parameters": _params(sorted(session["params"] + eips) +
+                    _side_params(session, side, MySide))},
+        }
+
+    plan = {"stacks": dict((side, dict(stages(side, MySide), name = _stack_name(session, side)))
+        for side, MySide in SIDES)}
+
+    # ServerSG starts with the default allow-all egress rule
+    to_revoke, to_add = _sg_egress_diff([_sg_rule("-1", None, None, "0.0.0.0/0")],
+        session["config"]["server"]["res"]["servers_allowed"])
+
+    plan["server_sg"] = {"revoke": to_revoke, "authorize": to_add}
+    plan["client_sg"] = {"authorize": [("-1", None, None, session["cache"]["client"].vpc.cidr_block)]}
+
+    return plan, "<ClientInstanceId%s>" % _tunnel_suffix(session)
+
+def _plan_update(session, stacks):
+    """plan_world for an existing deployment, diffed against its stacks"""
+
+    plan = {"stacks": {}}
+    for side, MySide in SIDES:
+        params, changed = _update_params(session, stacks[side], MySide)
+        changed.update(_template_diff(session["conn"][side]("cloudformation"), stacks[side],
+            _template(session, "main.json", side, MySide, params)))
+        plan["stacks"][side] = {"name": stacks[side].stack_name, "update": {
+            "template": "main.json", "changed": changed} if changed else None}
+
+        ignored = _boot_params_ignored(session, stacks[side], side)
+        if ignored:
+            plan["stacks"][side]["ignored"] = ignored
+
+    conn_ec2 = session["conn"]["server"]("ec2")
+    sg = conn_ec2.get_all_security_groups(
+        group_ids=[_from_cfn_output("ServerSGId", Stack=stacks["server"])])[0]
+    to_revoke, to_add = _sg_egress_diff(_sg_rules(sg.rules_egress),
+        session["config"]["server"]["res"]["servers_allowed"])
+    plan["server_sg"] = {"revoke": to_revoke, "authorize": to_add}
+
+    cidr = session["cache"]["client"].vpc.cidr_block
+    sg = session["conn"]["client"]("vpc").get_all_security_groups(
+        group_ids=[_from_cfn_output("ClientSGId", Stack=stacks["client"])])[0]
+    plan["client_sg"] = {"authorize": [] if _has_ingress(sg, cidr) else [("-1", None, None, cidr)]}
+
+    return plan, _from_cfn_output("ClientInstanceId", Stack=stacks["client"])
+
+@traced("actuator")
 def cfn_eip(session):
-    """Allocates EIP and feed them back to params"""
+    """Allocates EIP and feed them back to params
+
+    Both sides are created and waited for concurrently; EIP outputs are only
+    exchanged once both stacks are ready.
+    """
 
     show.unless_quiet("Creating CFN stack", "to allocate EIP. Should be done in a minute.")
 
     def _allocate(side, MySide):
-        conn_cfn = session["conn"][side]("cloudformation")
+        _create_stack(session, side, _template(session, "eip.json", side, MySide),
+            [("MySide", MySide)])
 
-        # create_stack does not return the stack
-        ret = conn_cfn.create_stack(
-            _stack_name(session, side),
-            template_body = dumps(load_tpl("eip.json")),
-            parameters = [("MySide", MySide)],
-            tags = session["tags"]
-        )
+        _wait_cfn(session, side, max_interval = 5)
 
-        # Store stack information to session["stacks"]
-        while True:
-            try:
-                session["stacks"][side] = conn_cfn.describe_stacks(ret)[0]
-                break
-            except:  sleep(1) # TODO: filter specific error
+        return [(o.key, o.value) for o in session["stacks"][side].outputs]
+
+    outputs = _on_sides(session, _allocate)
+
+    # Recover EIP
+    for side, _ in SIDES:
+        session["params"] += outputs[side]
+
+@traced("actuator")
+def allocate_eips(session):
+    """Allocates EIPs of both sides with EC2 calls, and feeds them to params
+
+    Both sides allocate concurrently without waiting for a stack, so that
+    cfn_create needs a single stack lifecycle per side. Addresses are kept
+    in session["eips"]; they are not owned by the stacks.
+    """
+
+    session["eips"] = {}
 
-    _allocate("client", "Client")
-    _allocate("server", "Server")
-    _wait_cfn(session, interval = 3)
+    def _allocate(side, MySide):
+        address = session["conn"][side]("ec2").allocate_address(domain = "vpc")
+        session["eips"][side] = address
+        return [(MySide + "EIP", address.public_ip), (MySide + "EIPId", address.allocation_id)]
+
+    try:
+        outputs = run_parallel(dict(
+            (side, (lambda side=side, MySide=MySide: _allocate(side, MySide))) for side, MySide in SIDES))
+    except Exception:
+        release_eips(session)
+        raise
+
+    for side, _ in SIDES:
+        session["params"] += outputs[side]
+
+@traced("actuator")
+def cfn_create(session):
+    """Creates the full stack of each side in one pass, with EIPs from allocate_eips
+
+    Stacks are deleted and EIPs released if any side fails.
+    """
 
-    # Revoer EIP
-    for side in ("client", "server"):
-        session["params"] += [(o.key, o.value) for o in session["stacks"][side].outputs]
+    show.unless_quiet("Creating CFN Stack", "to bring up the VPN, which usually takes a few minutes.")
 
+    def _create(side, MySide):
+        parameters = session["params"] + [("EIPAllocation", "Imported")] + \
+            _side_params(session, side, MySide)
+
+        _create_stack(session, side, _template(session, "main.json", side, MySide, parameters),
+            parameters)
+
+        _wait_cfn(session, side, max_interval = 15)
+
+    try:
+        _on_sides(session, _create)
+    except Exception:
+        release_eips(session)
+        raise
+
+def release_eips(session):
+    """Best-effort release of EIPs from allocate_eips, eg., after a failure
+
+    Addresses stay associated with an ENI until the stack holding it is
+    deleted, which takes minutes, so stacks being deleted are waited for
+    first. Addresses still in use are retried for a while, and reported if
+    they can't be released.
+    """
+
+    for side, address in sorted(session.get("eips", {}).items()):
+        conn_ec2 = session["conn"][side]("ec2")
+        try:
+            _wait_deleted(session, side)
+            retry(lambda: conn_ec2.release_address(allocation_id = address.allocation_id),
+                retry_on = lambda e: "InvalidIPAddress.InUse" == error_code(e))
+            del session["eips"][side]
+        except Exception as e:
+            show.error("Can't release EIP", "%s on %s side: %s" % (address.allocation_id, side, e))
+
+@traced("actuator")
 def cfn_main(session):
 
     show.unless_quiet("Updating CFN Stack", "to bring up the VPN, which usually takes a few minutes.")
 
     def _do(side, MySide):
         conn_cfn = session["conn"][side]("cloudformation")
+        waiter = _waiter(session, side, max_interval = 15).mark()
+        parameters = session["params"] + _side_params(session, side, MySide)
 
         conn_cfn.update_stack(
             _stack_name(session, side),
-            template_body = dumps(load_tpl("main.json")),
-            parameters = session["params"] + [("MySide", MySide)],
+            template_body = _template(session, "main.json", side, MySide, parameters),
+            parameters = parameters,
+            capabilities = _capabilities(parameters),
+        )
+
+        _wait_cfn(session, side, waiter)
+
+    _on_sides(session, _do)
+
+@traced("actuator")
+def cfn_update(session):
+    """Updates stacks of an existing deployment in place
+
+    EIPs are kept, and so is SharedSecret with UsePreviousValue. Stacks are
+    only updated when their parameters or template differ, eg., after an
+    upgrade of main.json; failed updates are rolled back by CloudFormation,
+    and stacks are never deleted. TEMPLATE_PARAMS the config asks for are
+    kept as the stacks have them, with a warning.
+    """
+
+    for side, _ in SIDES:
+        stack = session["stacks"][side]
+        for key, (current, wanted) in sorted(_boot_params_ignored(session, stack, side).items()):
+            show.output("Not applied", "%s=%s on %s, which keeps %s=%s: it only takes effect when "
+                "the stack is created. Create a new deployment to change it." % (
+                key, wanted, stack.stack_name, key, current))
+
+    def _do(side, MySide):
+        stack = session["stacks"][side]
+        conn_cfn = session["conn"][side]("cloudformation")
+        params, changed = _update_params(session, stack, MySide)
+        body = _template(session, "main.json", side, MySide, params)
+        changed.update(_template_diff(conn_cfn, stack, body))
+
+        if not changed:
+            show.verbose(msg="Neither parameters nor template changed on %s side, stack left as is" % side)
+            return False
+
+        show.unless_quiet("Updating CFN Stack", "%s on %s side, for changed %s" % (
+            stack.stack_name, side, ", ".join(sorted(changed))))
+
+        waiter = _waiter(session, side, max_interval = 15).mark()
+
+        conn_cfn.update_stack(
+            stack.stack_name,
+            template_body = body,
+            parameters = params + [("SharedSecret", None, True)],
+            capabilities = _capabilities(params),
         )
 
-    _do("client", "Client")
-    _do("server", "Server")
-    _wait_cfn(session, interval=10)
+        _wait_cfn(session, side, waiter)
+        return True
+
+    updated = run_parallel(dict(
+        (side, (lambda side=side, MySide=MySide: _do(side, MySide))) for side, MySide in SIDES))
+
+    show.verbose(msg="%d of %d stacks updated" % (len(filter(None, updated.values())), len(SIDES)))
+
+@traced("actuator")
+def rotate_psk(session):
+    """Replaces SharedSecret of an existing deployment, without rebuilding it
+
+    Both stacks are updated with their previous template and parameters but
+    SharedSecret, which only changes the cfn-init metadata of the VPN
+    instances. cfn-hup on the instances rewrites the secrets file and has
+    ipsec reread it; instances are not replaced and tunnels stay up. Every
+    tunnel gets the same secret.
+
+    Stacks built before cfn-hup was added are refused, as their instances
+    would never reload the secret. If any stack fails to update, the ones
+    that did are given their previous secret back, so both sides of every
+    tunnel keep matching.
+    """
+
+    tunnels = _tunnels(session)
+    for view in tunnels:
+        view["stacks"] = _existing_stacks(view)
+    session["stacks"] = tunnels[0]["stacks"]
+    if not session["stacks"]:
+        raise Exception("PSK rotation needs the task ID of an existing deployment")
+
+    targets = dict(("%s-%s" % (side, _tunnel_name(view)), (view, side, MySide))
+        for view in tunnels if view["stacks"] for side, MySide in SIDES)
+
+    previous = run_parallel(dict((key, (lambda view=view, side=side, MySide=MySide:
+        _stack_secret(view, side, MySide))) for key, (view, side, MySide) in targets.items()))
+
+    secret = create_shared_secret()
+
+    def _do(session, side, secret):
+        stack = session["stacks"][side]
+        conn_cfn = session["conn"][side]("cloudformation")
+        waiter = _waiter(session, side, max_interval = 5).mark()
+
+        conn_cfn.update_stack(
+            stack.stack_name,
+            use_previous_template = True,
+            parameters = [(p.key, None, True) for p in stack.parameters if "SharedSecret" != p.key] +
+                [("SharedSecret", secret)],
+            capabilities = _capabilities([(p.key, p.value) for p in stack.parameters]),
+        )
+
+        _wait_cfn(session, side, waiter)
+
+    def _attempt(key, secret):
+        view, side, _ = targets[key]
+        try:
+            _do(view, side, secret)
+        except Exception as e:
+            return e
+
+    show.unless_quiet("Rotating PSK", "of InstaVPN %s" % session["tags"]["instavpn"])
+    errors = run_parallel(dict((key, (lambda key=key: _attempt(key, secret))) for key in targets))
+
+    failed = sorted(key for key, e in errors.items() if e is not None)
+    if failed:
+        rotated = sorted(set(targets) - set(failed))
+        show.error("Restoring PSK", "previous secret on %s" % (", ".join(
+            targets[key][0]["stacks"][targets[key][1]].stack_name for key in rotated) or "no stack"))
+        restored = run_parallel(dict((key, (lambda key=key: _attempt(key, previous[key])))
+            for key in rotated))
+
+        raise Exception("PSK rotation failed on %s: %s%s" % (
+            ", ".join(targets[key][0]["stacks"][targets[key][1]].stack_name for key in failed),
+            errors[failed[0]], "".join("; can't restore %s: %s" % (
+                targets[key][0]["stacks"][targets[key][1]].stack_name, e)
+                for key, e in sorted(restored.items()) if e is not None)))
+
+    show.output("PSK rotated,", "VPN instances reload it within a minute.")
+
+def _stack_secret(session, side, MySide):
+    """SharedSecret the VPN instance of `side` was given, from its cfn-init metadata
+
+    NoEcho hides it from describe_stacks, but not from the resolved metadata
+    cfn-init reads. Raises if the metadata has no cfn-hup hook to reload it.
+    """
+
+    stack = session["stacks"][side]
+    detail = session["conn"][side]("cloudformation").describe_stack_resource(
+        stack.stack_name, "%sVPN" % MySide)
+    metadata = json.loads(detail["DescribeStackResourceResponse"]["DescribeStackResourceResult"]
+        ["StackResourceDetail"]["Metadata"])
+    files = metadata["AWS::CloudFormation::Init"]["config"]["files"]
+
+    if PSK_HOOK not in files:
+        raise Exception("Stack (%s) was built before cfn-hup reloaded PSKs; update it with -t "
+            "first" % stack.stack_name)
+    return re.search(r'PSK "(.*)"', files["/etc/ipsec.d/instavpn.secrets"]["content"]).group(1)
+
+def _template_diff(conn_cfn, stack, body):
+    """{"template": [...]} if the template of `stack` differs from `body`, else {}"""
+
+    current = conn_cfn.get_template(stack.stack_name)["GetTemplateResponse"]["GetTemplateResult"]["TemplateBody"]
+    if json.loads(current) == json.loads(body):
+        return {}
+    return {"template": ["previous", "main.json"]}
+
+def _update_params(session, stack, MySide):
+    """Returns (params, {key: [current, wanted]}) to update `stack` with
 
-def post_conf(session):
+    SharedSecret is left out of both, and EIPs are taken from the stack, as
+    are TEMPLATE_PARAMS the stack has; the others keep their defaults.
+    """
+
+    current = dict((p.key, p.value) for p in stack.parameters)
+
+    params = [(k, v) for k, v in session["params"]
+            if "SharedSecret" != k and k not in TEMPLATE_PARAMS] + \
+        [(k, current.get(k)) for k in EIP_PARAMS] + \
+        [(k, current[k]) for k in sorted(TEMPLATE_PARAMS) if k in current] + [("MySide", MySide)]
+
+    changed = dict((k, [current.get(k), v]) for k, v in params
+        if current.get(k) != ("%s" % v if v is not None else None))
+
+    return params, changed
+
+def _boot_params_ignored(session, stack, side):
+    """{key: [current, wanted]} of TEMPLATE_PARAMS the config asks for, but
+    `stack` keeps as it was created with, eg., TunnelProfile, or
+    HealthMonitor on client side when `ha` is turned on
+    """
+
+    current = dict((p.key, p.value) for p in stack.parameters)
+    wanted = [(k, v) for k, v in session["params"] if k in TEMPLATE_PARAMS]
+    if "client" == side and session["config"].get("ha"):
+        wanted.append(("HealthMonitor", "Enabled"))
+
+    return dict((k, [current.get(k, TEMPLATE_PARAMS[k]), "%s" % v]) for k, v in wanted
+        if current.get(k, TEMPLATE_PARAMS[k]) != "%s" % v)
+
+def _existing_stacks(session):
+    """{side: stack} of the deployment targeted by session["task_id"], {} if none
+
+    Both stacks must exist and be in a stable state. Tunnels after the first
+    one may not exist yet, eg., when `tunnels` was raised, nor may standby
+    pairs, when `ha` was turned on.
+    """
+
+    if not session.get("task_id"):
+        return {}
+
+    def _describe(side):
+        try:
+            stack = session["conn"][side]("cloudformation").describe_stacks(_stack_name(session, side))[0]
+        except Exception as e:
+            if (session.get("tunnel", 1) > 1 or session.get("standby")) and stack_missing(e):
+                return None
+            raise
+
+        if stack.stack_status not in STATE_UPDATABLE:
+            raise Exception("Stack (%s) is %s, and can't be updated" % (
+                stack.stack_name, stack.stack_status))
+        return stack
+
+    stacks = run_parallel(dict((side, (lambda side=side: _describe(side))) for side, _ in SIDES))
+
+    missing = sorted(side for side, stack in stacks.items() if stack is None)
+    if len(missing) == len(SIDES):
+        return {}
+    if missing:
+        raise Exception("Stack (%s) does not exist" % _stack_name(session, missing[0]))
+    return stacks
+
+@traced("actuator")
+def post_conf(session, tunnels = None):
     show.unless_quiet("CloudFormation stack created", "running post-config")
 
-    _pc_server_sg(session)
-    _pc_client_sg(session)
-    _pc_client_rtb(session)
+    tunnels = tunnels or [session]
 
+    # Server and client sides are in different accounts or regions
+    run_parallel({
+        "server": lambda: [_pc_server_sg(view) for view in tunnels],
+        "client": lambda: ([_pc_client_sg(view) for view in tunnels],
+            _pc_client_rtb(session, tunnels)),
+    })
+
+    if session["config"].get("ha"):
+        _pc_monitor_tags(session, tunnels)
+
+@traced("actuator")
 def _pc_server_sg(session):
-    show.verbose(msg="Cleaning up default Server egress rules")
+    show.verbose(msg="Syncing Server egress rules with servers_allowed")
 
     conn_ec2 = session["conn"]["server"]("ec2")
     sg_id = _from_cfn_output("ServerSGId", Stack=session["stacks"]["server"])
     sg  = conn_ec2.get_all_security_groups(group_ids=[sg_id])[0]
 
-    for rule in sg.rules_egress:
-        conn_ec2.revoke_security_group_egress(
-            group_id    = sg_id,
-            ip_protocol = rule.ip_protocol,
-            from_port   = rule.from_port,
-            to_port     = rule.to_port,
-            cidr_ip     = rule.grants[0]
-        )
+    servers_allowed = session["config"]["server"]["res"]["servers_allowed"]
+    to_revoke, to_add = _sg_egress_diff(_sg_rules(sg.rules_egress), servers_allowed)
 
-    for dest in session["config"]["server"]["res"]["servers_allowed"]:
-        show.verbose(msg="Granting access to %s:%s:%s" % (dest["proto"], dest["ip"], dest["port"]))
-        conn_ec2.authorize_security_group_egress(
-            group_id = sg_id,
-            ip_protocol = dest["proto"] if dest["proto"] != 'all' else "-1",
-            from_port = 0 if 'all' == dest["port"] else int(dest["port"]),
-            to_port = 65535 if 'all' == dest["port"] else int(dest["port"]),
-            cidr_ip = "%s/32" % dest["ip"]
-        )
+    for rule in to_revoke:
+        show.verbose(msg="Revoking access to %s:%s:%s-%s" % (rule[0], rule[3], rule[1], rule[2]))
+    for rule in to_add:
+        show.verbose(msg="Granting access to %s:%s:%s-%s" % (rule[0], rule[3], rule[1], rule[2]))
+
+    calls = _sg_egress_batch(conn_ec2, "RevokeSecurityGroupEgress", sg_id, to_revoke) + \
+        _sg_egress_batch(conn_ec2, "AuthorizeSecurityGroupEgress", sg_id, to_add)
+
+    legacy_calls = sum(len(rule.grants) for rule in sg.rules_egress) + len(servers_allowed)
+    show.verbose(msg="Server SG synced with %d API calls, %d saved" % (calls, legacy_calls - calls))
+
+SG_BATCH_SIZE = 50 # CIDRs per request
+
+def _sg_rule(ip_protocol, from_port, to_port, cidr_ip):
+    """Normalized (proto, from, to, cidr) of a rule; ports are None for all protocols"""
+    ip_protocol = "%s" % ip_protocol
+    if "-1" == ip_protocol:
+        return ("-1", None, None, cidr_ip)
+    return (ip_protocol, int(from_port), int(to_port), cidr_ip)
+
+def _sg_rules(rules):
+    """Normalized rules of boto IPPermissions"""
+    return [_sg_rule(rule.ip_protocol, rule.from_port, rule.to_port, grant.cidr_ip)
+        for rule in rules for grant in rule.grants if grant.cidr_ip]
+
+def _sg_egress_diff(existing, servers_allowed):
+    """Returns (to_revoke, to_add), sorted lists of normalized rules
+
+    Rules both `existing` and wanted in `servers_allowed` are left untouched.
+    """
+
+    existing = set(existing)
 
+    desired = set(_sg_rule(
+        dest["proto"] if dest["proto"] != 'all' else "-1",
+        0 if 'all' == dest["port"] else int(dest["port"]),
+        65535 if 'all' == dest["port"] else int(dest["port"]),
+        "%s/32" % dest["ip"]) for dest in servers_allowed)
+
+    return sorted(existing - desired), sorted(desired - existing)
+
+def _sg_egress_batch(conn_ec2, action, group_id, rules):
+    """Send `rules` with as few `action` requests as possible, returns #requests
+
+    Rules sharing (proto, from, to) go into one IpPermission, and up to
+    SG_BATCH_SIZE CIDRs go into one request.
+    """
+
+    requests = 0
+    for offset in range(0, len(rules), SG_BATCH_SIZE):
+        perms = {}
+        for proto, from_port, to_port, cidr in rules[offset:offset + SG_BATCH_SIZE]:
+            perms.setdefault((proto, from_port, to_port), []).append(cidr)
+
+        params = {"GroupId": group_id}
+        for i, ((proto, from_port, to_port), cidrs) in enumerate(sorted(perms.items()), 1):
+            prefix = "IpPermissions.%d." % i
+            params[prefix + "IpProtocol"] = proto
+            if from_port is not None:
+                params[prefix + "FromPort"] = from_port
+                params[prefix + "ToPort"] = to_port
+            for j, cidr in enumerate(cidrs, 1):
+                params[prefix + "IpRanges.%d.CidrIp" % j] = cidr
+
+        conn_ec2.get_status(action, params, verb='POST')
+        requests += 1
+
+    return requests
+
+@traced("actuator")
 def _pc_client_sg(session):
     show.verbose("Setting up access control with Server Security Groups")
 
-    client_res = session["config"]["client"]["res"]
     conn_vpc = session["conn"]["client"]("vpc")
-    subnet = conn_vpc.get_all_subnets([client_res["subnet_id"]])[0]
-    vpc = conn_vpc.get_all_vpcs([subnet.vpc_id])[0]
+    vpc = session["cache"]["client"].vpc
 
     sg_id = _from_cfn_output("ClientSGId", Stack=session["stacks"]["client"])
     sg = conn_vpc.get_all_security_groups(group_ids=[sg_id])[0]
 
+    if _has_ingress(sg, vpc.cidr_block):
+        return False
+
     sg.authorize(
         ip_protocol = -1,
         cidr_ip = vpc.cidr_block
     )
 
-def _pc_client_rtb(session):
-    """There is either no conflict, or only full replacements in rtb routes,
-    which is enforced by rule_60_rtb_route_compatible.
+def _has_ingress(sg, cidr):
+    """Whether `sg` already allows all traffic from `cidr`"""
+    return ("-1", None, None, cidr) in _sg_rules(sg.rules)
+
+@traced("actuator")
+def _pc_client_rtb(session, tunnels = None):
+    """Existing routes to server subnets all point to an instance, ie., a
+    former client instance, and are replaced; rule_60_rtb_route_compatible
+    refuses routes to gateways, NAT gateways or peering connections.
+
+    Only the minimal set of routes is created, replaced or deleted, and route
+    tables are reconciled concurrently. Server subnets of each of `tunnels`
+    are routed to its client instance; with `ha`, routes the monitor has
+    failed over to the standby client instance are left there.
+    """
+
+    rtbs = client_route_tables(session)
+    if not rtbs: return True
+
+    show.verbose(msg="Changing client Route Table(s) %s" % ", ".join(rtb.id for rtb in rtbs))
+
+    conn_vpc = session["conn"]["client"]("vpc")
+
+    dest, failover = _client_route_targets([(view,
+        _from_cfn_output("ClientInstanceId", Stack=view["stacks"]["client"]))
+        for view in tunnels or [session]])
+
+    calls = run_parallel(dict((rtb.id, (lambda rtb=rtb: _apply_routes(conn_vpc, rtb,
+        _keep_failover(rtb.routes, dest, failover)))) for rtb in rtbs))
+
+    session["cache"]["client"].invalidate("route_tables")
+    show.verbose(msg="Route tables reconciled with %d API calls" % sum(calls.values()))
+
+@traced("actuator")
+def _pc_monitor_tags(session, tunnels):
+    """Tags each client instance of an active/standby pair for lib/monitor.py
+
+    The tag has the other client instance, and the private IP of the server
+    instance of its own pair, pinged through the tunnel.
+    """
+
+    show.verbose(msg="Tagging client instances for the health monitor")
+
+    pairs = {}
+    for view in tunnels:
+        pairs.setdefault(view.get("tunnel", 1), []).append(view)
+    pairs = [views for _, views in sorted(pairs.items()) if 2 == len(views)]
+
+    instance_id = lambda view, side: _from_cfn_output("%sInstanceId" % side.capitalize(),
+        Stack=view["stacks"][side])
+    servers = [instance_id(view, "server") for views in pairs for view in views]
+    private_ips = dict((i.id, i.private_ip_address) for r in session["conn"]["server"]("ec2")
+        .get_all_instances(instance_ids = servers) for i in r.instances)
+
+    conn_vpc = session["conn"]["client"]("vpc")
+    for views in pairs:
+        clients = [instance_id(view, "client") for view in views]
+        for view, me, other in zip(views, clients, clients[::-1]):
+            conn_vpc.create_tags([me], {MONITOR_TAG: "%s %s" % (
+                other, private_ips[instance_id(view, "server")])})
+
+def _client_route_targets(instances):
+    """Returns ({cidr: instance_id}, {active instance_id: standby instance_id})
+
+    * instances: [(view, client instance_id)] of every tunnel
+    """
+
+    dest, active, standby = {}, {}, {}
+    for view, instance_id in instances:
+        if view.get("standby"):
+            standby[view.get("tunnel", 1)] = instance_id
+        else:
+            active[view.get("tunnel", 1)] = instance_id
+            dest.update(_client_route_dest(view, instance_id))
+
+    return dest, dict((active[k], standby[k]) for k in standby if k in active)
+
+def _keep_failover(routes, dest, failover):
+    """`dest` but for routes already failed over to the standby instance"""
+
+    existing = dict((route.destination_cidr_block, route.instance_id) for route in routes)
+    return dict((cidr, existing[cidr] if instance_id in failover and
+        failover[instance_id] == existing.get(cidr) else instance_id) for cidr, instance_id in dest.items())
+
+def _client_route_dest(session, client_instance_id):
+    """{cidr: instance_id} to be routed from client side"""
+    return dict((cidr, client_instance_id) for cidr in session["config"]["server"]["ipsec"]["subnets"])
+
+def client_route_tables(session):
+    """Route tables to be changed on client side
+
+    The supplied route table, and with `route_all_tables`, every route table
+    associated with a subnet of the client VPC or being its main table.
     """
 
-    rtb_id = session["config"]["client"]["res"]["route_table_id"]
-    if rtb_id is None: return True
+    res, conf = session["cache"]["client"], session["config"]["client"]["res"]
+    rtbs = []
 
-    show.verbose(msg="Changing client Route Table")
+    if conf.get("route_table_id"):
+        rtbs.append(res.route_table(conf["route_table_id"]))
 
-    conn = session["conn"]["client"]
+    if conf.get("route_all_tables"):
+        rtbs += [rtb for rtb in res.route_tables
+            if rtb.associations and rtb.id not in [r.id for r in rtbs]]
 
-    dest_cidrs = session["config"]["server"]["ipsec"]["subnets"]
-    client_instnace_id = _from_cfn_output("ClientInstanceId", Stack=session["stacks"]["client"])
+    return rtbs
 
-    rtb = conn("vpc").get_all_route_tables([rtb_id])[0]
+def _route_diff(routes, dest):
+    """Returns (to_create, to_replace, to_delete) CIDR lists
 
-    for route in rtb.routes:
-        if route.destination_cidr_block in dest_cidrs:
-            show.verbose(msg="Removing route to %s" % route.destination_cidr_block)
-            conn("vpc").delete_route(rtb.id, route.destination_cidr_block)
+    * dest: {cidr: instance_id}
+    Routes already pointing to their instance are skipped; routes to one of
+    the instances in `dest` for CIDRs no longer wanted are deleted.
+    """
+
+    existing = dict((route.destination_cidr_block, route) for route in routes)
+    instances = set(dest.values())
+
+    to_create = sorted(cidr for cidr in dest if cidr not in existing)
+    to_replace = sorted(cidr for cidr in dest
+        if cidr in existing and existing[cidr].instance_id != dest[cidr])
+    to_delete = sorted(cidr for cidr, route in existing.items()
+        if cidr not in dest and route.instance_id in instances)
+
+    return to_create, to_replace, to_delete
+
+def _apply_routes(conn_vpc, rtb, dest):
+    """Reconcile routes of `rtb` with `dest`, returns #API calls"""
+    with span("apply_routes", "actuator", route_table = rtb.id):
+        return _apply_route_diff(conn_vpc, rtb, dest)
+
+def _apply_route_diff(conn_vpc, rtb, dest):
+
+    to_create, to_replace, to_delete = _route_diff(rtb.routes, dest)
 
-    for cidr in dest_cidrs:
-        show.verbose(msg="Creating route to %s" % cidr)
-        conn("vpc").create_route(rtb.id, cidr, instance_id = client_instnace_id)
+    for cidr in to_delete:
+        show.verbose(msg="Removing route to %s from %s" % (cidr, rtb.id))
+        conn_vpc.delete_route(rtb.id, cidr)
+
+    for cidr in to_replace:
+        show.verbose(msg="Replacing route to %s in %s" % (cidr, rtb.id))
+        conn_vpc.replace_route(rtb.id, cidr, instance_id = dest[cidr])
+
+    for cidr in to_create:
+        show.verbose(msg="Creating route to %s in %s" % (cidr, rtb.id))
+        conn_vpc.create_route(rtb.id, cidr, instance_id = dest[cidr])
+
+    return len(to_create) + len(to_replace) + len(to_delete)
 
 def _from_cfn_output(key, Stack=None, outputs=None):
 
@@ -157,38 +820,156 @@ def _from_cfn_output(key, Stack=None, outputs=None):
     filtered = [o.value for o in outputs if key == o.key]
     return filtered[0]
 
-def _wait_cfn(session, interval = 5):
-    """Wait and block until all stacks are created"""
+def _on_sides(session, fn):
+    """Run fn(side, MySide) on both sides concurrently, returns {side: result}
 
-    state_ok = ('CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS')
-    state_keep_waiting = ('CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS')
+    Stacks on the other side are deleted if any side fails.
+    """
 
-    ok_s, ok_c = False, False
+    try:
+        return run_parallel(dict(
+            (side, (lambda side=side, MySide=MySide: fn(side, MySide)))
+            for side, MySide in SIDES
+        ))
+    except Exception:
+        _delete_stacks(session)
+        raise
 
-    stacks = session["stacks"]
-    okay = {k : False for k in stacks}
+def _delete_stacks(session):
+    """Best-effort deletion of the stacks in session["stacks"]
 
-    show.verbose(msg="Waiting for AWS Cloud Formation")
+    Stacks that failed, or are deleted already, are left as they are.
+    """
 
-    while not all(okay.values()):
+    for side, stack in sorted(session["stacks"].items()):
+        try:
+            retry(stack.update)
+            if stack.stack_status in STATE_FAILED:
+                continue
+            show.error("Deleting stack", stack.stack_name)
+            retry(stack.delete)
+        except Exception as e:
+            if not stack_missing(e):
+                show.error("Can't delete stack", "%s: %s" % (stack.stack_name, e))
+
+def _wait_cfn(session, side, waiter=None, max_interval = 10):
+    """Wait and block until the stack on `side` is created
+
+    Streams per-resource progress in verbose mode. Pass a `waiter` that was
+    marked before updating an existing stack to skip earlier events.
+    """
 
-        for k, stack in stacks.iteritems():
-            if okay[k]: continue # done already
+    stack = session["stacks"][side]
 
-            stack.update()
+    if waiter is None:
+        waiter = _waiter(session, side, max_interval)
 
-            if stack.stack_status in state_ok: okay[k] = True
-            elif stack.stack_status in state_keep_waiting: pass
-            else:
-                for victim in stacks:
-                    if victim != stack:
-                        try:
-                            victim.delete()
-                        except: pass
-                raise Exception("Stack (%s) failed, may require manual cleanup." % stack.stack_name)
+    show.verbose(msg="Waiting for AWS Cloud Formation on %s side" % side)
+    with span("wait_cfn", "actuator", side = side, stack = stack.stack_name):
+        waiter.wait()
 
-        sleep(interval)
+    stack.update()
+    return True
+
+def _wait_deleted(session, side):
+    """Blocks until the stack of `side` is deleted, if it is being deleted"""
+
+    stack = session.get("stacks", {}).get(side)
+    if stack is None:
+        return
+
+    retry(stack.update)
+    if "DELETE_IN_PROGRESS" == stack.stack_status:
+        show.verbose(msg="Waiting for the stack on %s side to be deleted" % side)
+        with span("wait_deleted", "actuator", side = side, stack = stack.stack_name):
+            _waiter(session, side, max_interval = 15).wait_deleted()
+
+def _waiter(session, side, max_interval = 10):
+    def _on_event(event):
+        show.verbose("[%s] %s" % (side, event.logical_resource_id), "%s%s" % (
+            event.resource_status,
+            " (%s)" % event.resource_status_reason if event.resource_status_reason else ""))
+
+    return StackWaiter(session["conn"][side]("cloudformation"), _stack_name(session, side),
+        on_event = _on_event, max_interval = max_interval)
+
+def _create_stack(session, side, template_body, parameters):
+    """Creates the stack of `side`, and stores it to session["stacks"]"""
+
+    conn_cfn = session["conn"][side]("cloudformation")
+
+    # create_stack does not return the stack
+    ret = conn_cfn.create_stack(
+        _stack_name(session, side),
+        template_body = template_body,
+        parameters = parameters,
+        capabilities = _capabilities(parameters),
+        tags = session["tags"]
+    )
+
+    # A new stack may not be visible to describe_stacks right away
+    with span("describe_new_stack", "actuator", side = side):
+        session["stacks"][side] = retry(lambda: conn_cfn.describe_stacks(ret)[0],
+            retry_on = stack_missing)
+
+def _side_params(session, side, MySide):
+    """Parameters of a new stack specific to `side`: MySide, BakedImageId
+    if an image was baked for its account, region and instance type, and
+    HealthMonitor on client side with `ha`"""
+
+    image = baked_image(session["config"][side].get("identity", {}),
+        session["config"].get("params", {}).get("InstanceType"))
+    monitor = "client" == side and session["config"].get("ha")
+    return ([("BakedImageId", image)] if image else []) + \
+        ([("HealthMonitor", "Enabled")] if monitor else []) + [("MySide", MySide)]
+
+def _capabilities(parameters):
+    """CAPABILITY_IAM for stacks with the IAM role of the health monitor"""
+    return ["CAPABILITY_IAM"] if "Enabled" == dict(p[:2] for p in parameters).get("HealthMonitor") else None
+
+def _template(session, tpl_name, side, MySide, parameters = ()):
+    """Template body pruned to `side`, its region and TEMPLATE_PARAMS in `parameters`"""
+
+    known = dict(TEMPLATE_PARAMS)
+    known.update((p[0], p[1]) for p in parameters if p[0] in TEMPLATE_PARAMS)
+    return compile_tpl(tpl_name, MySide, session["config"][side].get("identity", {}).get("region"), known)
 
 def _stack_name(session, side):
     """Stack name for (session, side)"""
-    return "instavpn-%s-%s" % (session["tags"]["instavpn"], side)
+    return "instavpn-%s-%s%s" % (session["tags"]["instavpn"], side, _tunnel_suffix(session))
+
+def _tunnels(session):
+    """Per-tunnel views of `session`, or [session] itself for a single tunnel
+
+    Views share everything with `session` but `stacks`, `eips` and `params`;
+    their server.ipsec.subnets, servers_allowed and ServerSharedCIDRs are
+    narrowed to the shard of their tunnel, from session["shards"]. With
+    `ha`, the tunnels are followed by a standby view of each of them.
+    """
+
+    shards = session.get("shards") or []
+    views = [session] if len(shards) <= 1 else []
+
+    for idx, shard in enumerate(shards if len(shards) > 1 else [], 1):
+        server = session["config"]["server"]
+        config = dict(session["config"], server = dict(server,
+            ipsec = dict(server["ipsec"], subnets = shard["cidrs"]),
+            res = dict(server["res"], servers_allowed = shard["servers_allowed"])))
+        params = [(k, " ".join(shard["cidrs"]) if "ServerSharedCIDRs" == k else v)
+            for k, v in session["params"]]
+
+        views.append(dict(session, config = config, params = params, stacks = {}, tunnel = idx))
+
+    if session["config"].get("ha"):
+        views += [dict(view, params = list(view["params"]), stacks = {}, standby = True)
+            for view in views]
+
+    return views
+
+def _tunnel_name(session):
+    return "tunnel-%02d%s" % (session.get("tunnel", 1), "-standby" if session.get("standby") else "")
+
+def _tunnel_suffix(session):
+    """Suffix of stack names, none for the first active tunnel"""
+    return ("-%d" % session["tunnel"] if session.get("tunnel", 1) > 1 else "") + \
+        ("-standby" if session.get("standby") else "")
@@ -3,68 +3,216 @@
 AWS Connection handler
 """
 
+import calendar
 import importlib
-from copy import deepcopy
-from json import dumps
+import sys
+import threading
+import time
+from datetime import datetime
+from itertools import count
+
+from .trace import span
+from .metrics import api_metrics, body_error_code, error_code, THROTTLING_CODES
+from . import retry
 
 class AWSConn(object):
-    """Helper object for AWS connector singleton"""
-    __cache = {}
+    """Helper object for AWS connector singleton
+
+    Connections are pooled per identity and shared by all threads. For
+    `role_arn` identities, one set of assumed-role credentials is shared by
+    every service, and is refreshed `REFRESH_BEFORE` seconds ahead of expiry;
+    connections built with older credentials are rebuilt on next use.
+    """
+
+    REFRESH_BEFORE = 300
+    _clock = time.time
+    retry_policy = retry.default_policy
+
+    __cache = {}        # {key: {service: (conn, role credentials or None)}}
+    __role_creds = {}   # {key: (credentials, expires at)}
+    __locks = {}        # {key: RLock}
+    __lock = threading.Lock()
 
-    def __init__(self, identity, instavpn_id = None):
+    def __init__(self, identity, instavpn_id = None, side = None):
         self.identity = identity
         self.instavpn_id = instavpn_id
+        self.side = side
+        self.key = self._key(identity)
+        self.pool_key = self.key + (side,) # API metrics are kept per side
 
-    def _from_cache(self, service):
-        key = self._serialize(self.identity)
-
-        if not self.__cache.get(key, {}):
-            self.__cache[key] = {}
-            return None
+    def __call__(self, service):
+        creds = self._role_credentials() if self.key[1] else None
 
-        return self.__cache[key].get(service, None)
+        cached = self.__cache.get(self.pool_key, {}).get(service)
+        if cached and cached[1] is creds:
+            return cached[0]
 
-    def _build_connection(self, service):
+        with self._key_lock():
+            cached = self.__cache.get(self.pool_key, {}).get(service)
+            if cached and cached[1] is creds:
+                return cached[0]
 
-        if self.identity.get("role_arn", False):
-            user_identity = deepcopy(self.identity)
-            del user_identity["role_arn"]
+            conn = self._build_connection(service, creds)
+            self.__cache.setdefault(self.pool_key, {})[service] = (conn, creds)
 
-            conn = AWSConn(user_identity, self.instavpn_id)
-            role_cred = conn("sts").assume_role(self.identity["role_arn"], self.instavpn_id).credentials
+        return conn
 
-            user_identity["cred"].update({
+    @classmethod
+    def clear(cls):
+        """Drop all pooled connections and credentials"""
+        with cls.__lock:
+            cls.__cache.clear()
+            cls.__role_creds.clear()
+
+    def _key_lock(self):
+        lock = self.__locks.get(self.key)
+        if lock is None:
+            with self.__lock:
+                lock = self.__locks.setdefault(self.key, threading.RLock())
+        return lock
+
+    def _role_credentials(self):
+        """Assumed-role credentials for this identity, refreshed before expiry"""
+
+        cached = self.__role_creds.get(self.key)
+        if cached and cached[1] - self.REFRESH_BEFORE > self._clock():
+            return cached[0]
+
+        with self._key_lock():
+            cached = self.__role_creds.get(self.key)
+            if cached and cached[1] - self.REFRESH_BEFORE > self._clock():
+                return cached[0]
+
+            user_identity = dict(self.identity, role_arn = None)
+            role_cred = AWSConn(user_identity, self.instavpn_id, self.side)("sts").assume_role(
+                self.identity["role_arn"], self.instavpn_id or "instavpn").credentials
+
+            self.__role_creds[self.key] = (role_cred, _parse_expiration(role_cred.expiration))
+            return role_cred
+
+    def _build_connection(self, service, role_cred = None):
+        if role_cred is not None:
+            conn = self._connect(service, {
                 "access": role_cred.access_key,
                 "secret": role_cred.secret_key,
                 "session": role_cred.session_token
             })
+        else:
+            conn = self._connect(service, self.identity.get("cred") or {})
+
+        return self._instrument(conn, service)
+
+    def _instrument(self, conn, service):
+        """Rate-limit, retry, trace and count every API call of `conn`
+
+        Hooked at the make_request funnel: objects returned by boto keep a
+        reference to `conn`, so their calls, eg., Stack.update(), are covered
+        as well. Requests wait for a token of the (account, region) bucket,
+        and requests failing with a retryable code are re-issued with backoff,
+        whether boto returns the error response or raises it. boto's own
+        retries are turned off, so that every attempt takes a token and is
+        counted, and non-idempotent requests are only retried when throttled.
+        Any retries boto still makes, eg., with num_retries in its config, are
+        counted from add_auth calls, as boto signs every attempt.
+        """
+
+        make_request = getattr(conn, "make_request", None)
+        if make_request is None:
+            return conn
+
+        if hasattr(conn, "num_retries"):
+            conn.num_retries = 0
+
+        region, side, policy = self.identity.get("region"), self.side, self.retry_policy
+        tokens = retry.bucket(identity_account(self.identity), region)
+        attempts = threading.local()
+
+        auth_handler = getattr(conn, "_auth_handler", None)
+        if auth_handler is not None:
+            add_auth = auth_handler.add_auth
+
+            def _add_auth(*args, **kwargs):
+                attempts.count = getattr(attempts, "count", 0) + 1
+                return add_auth(*args, **kwargs)
+
+            auth_handler.add_auth = _add_auth
+
+        def _request(action, args, kwargs, retried):
+            """One request; returns (response, error code or None, exc_info if raised)"""
 
-            new_conn = AWSConn(user_identity, self.instavpn_id)
-            return new_conn(service)
+            tokens.acquire()
+            attempts.count, error, started = 0, None, time.time()
+            try:
+                with span("%s.%s" % (service, action), "aws", region = region, side = side):
+                    response = make_request(action, *args, **kwargs)
 
+                if getattr(response, "status", 200) >= 400:
+                    error = body_error_code(response.read()) or "HTTP %d" % response.status
+                return response, error, None
+            except Exception as e:
+                error = e
+                return None, error_code(e), sys.exc_info()
+            finally:
+                api_metrics.record(side, service, region, action, time.time() - started,
+                    max(0, attempts.count - 1) + retried, error)
+
+        def _make_request(action, *args, **kwargs):
+            idempotent = retry.idempotent(action, args[0] if args else kwargs.get("params"))
+
+            for attempt in count(1):
+                response, error, exc_info = _request(action, args, kwargs, attempt > 1)
+                failed = error is not None or exc_info is not None
+
+                if error in THROTTLING_CODES:
+                    tokens.throttled()
+                elif not failed:
+                    tokens.succeeded()
+
+                if not failed or attempt >= policy.max_attempts or not policy.retryable(error, idempotent):
+                    if exc_info is not None:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    return response
+
+                policy.sleep(policy.delay(attempt))
+
+        conn.make_request = _make_request
+        return conn
+
+    def _connect(self, service, cred):
         module = importlib.import_module("boto.%s" % service)
 
-        if self.identity["cred"]["access"]:
+        if cred.get("access"):
             return module.connect_to_region(
                 self.identity["region"],
-                aws_access_key_id       = self.identity["cred"]["access"],
-                aws_secret_access_key   = self.identity["cred"]["secret"],
-                security_token          = self.identity["cred"].get('session', None)
+                aws_access_key_id       = cred["access"],
+                aws_secret_access_key   = cred["secret"],
+                security_token          = cred.get('session', None)
             )
         else:
             return module.connect_to_region(self.identity["region"])
 
-    def __call__(self, service):
-        conn = self._from_cache(service)
-        if conn:
-            return conn
-
-        key = self._serialize(self.identity)
-        conn = self._build_connection(service)
-        self.__cache[key][service] = conn
-
-        return conn
-
     @staticmethod
-    def _serialize(identity):
-        return dumps(identity)
+    def _key(identity):
+        """Hashable key of an identity"""
+        cred = identity.get("cred") or {}
+        return (identity.get("region"), identity.get("role_arn"),
+            cred.get("access"), cred.get("secret"), cred.get("session"))
+
+def _parse_expiration(expiration):
+    """STS expiration (ISO 8601, UTC) to epoch seconds"""
+    try:
+        return calendar.timegm(datetime.strptime(expiration[:19], "%Y-%m-%dT%H:%M:%S").timetuple())
+    except (TypeError, ValueError):
+        return AWSConn._clock() + 900 # Shortest STS session
+
+def identity_account(identity):
+    """Best-effort account key for an identity, without calling AWS
+
+    Account ID of the role if any, otherwise the access key; `None` for
+    credentials from boto config or instance profile.
+    """
+
+    if identity.get("role_arn"):
+        return identity["role_arn"].split(":")[4]
+
+    return (identity.get("cred") or {}).get("access")
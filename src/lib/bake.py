@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Baked VPN images, see `instavpn.py --bake`
+
+A builder instance is launched from the stock AMI of AWSRegionArch2AMI in
+main.json. Its UserData installs aws-cfn-bootstrap, updates and openswan,
+enables ipsec.d includes and forwarding sysctls, then powers it off. An
+image is created from the stopped builder, which is then terminated. All
+regions and archs bake concurrently.
+
+Images are kept in conf/baked_ami.json as {account: AWSRegionArch2AMI}, ie.,
+{account: {region: {arch: ami}}}. New stacks pass the image of their
+account, region and instance type as BakedImageId, which swaps the UserData
+for one only running cfn-init, to write secrets and config, and restarting
+ipsec. Existing stacks keep the image they were created with.
+"""
+
+import time
+
+from boto.ec2.networkinterface import NetworkInterfaceSpecification, NetworkInterfaceCollection
+
+from .ui import show
+from .io import load_config, save_config, load_tpl
+from .aws_conn import AWSConn, identity_account
+from .parallel import run_parallel
+
+BAKED_AMI = "baked_ami.json"
+
+# Builder instance type of each arch in AWSInstanceType2Arch
+BUILDER_TYPES = {"64": "m1.small", "64HVM": "t2.micro"}
+
+BUILD_SCRIPT = "\n".join([
+    "#!/bin/bash -ex",
+    "exec > >(tee >(logger -t \"instavpn-bake\")) 2>&1",
+    "yum install -y aws-cfn-bootstrap",
+    "yum update -y",
+    "yum install -y openswan",
+    "chkconfig ipsec on",
+    "sed -i 's/^#include \\/etc\\/ipsec.d\\//include \\/etc\\/ipsec.d\\//' /etc/ipsec.conf",
+    "sed -i \"s@net.ipv4.ip_forward = 0@net.ipv4.ip_forward = 1\\nnet.ipv4.conf.all.accept_redirects = 0"
+        "\\nnet.ipv4.conf.all.send_redirects = 0@\" /etc/sysctl.conf",
+    "rm -f /root/.bash_history /home/ec2-user/.bash_history",
+    "shutdown -h now",
+    ""])
+
+def baked_amis():
+    """{account: {region: {arch: ami}}} of baked images, {} if none"""
+    try:
+        return load_config(BAKED_AMI)
+    except IOError:
+        return {}
+
+def baked_image(identity, instance_type, amis = None):
+    """Image baked for the account and region of `identity`, and the arch
+    of `instance_type`; None if there is none"""
+
+    arch = load_tpl("main.json")["Mappings"]["AWSInstanceType2Arch"].get(instance_type, {}).get("Arch")
+    if arch is None:
+        return None
+
+    amis = baked_amis() if amis is None else amis
+    return amis.get(_account(identity), {}).get(identity.get("region"), {}).get(arch)
+
+def bake(targets, archs = ("64HVM",), **kwargs):
+    """Bakes an image per target and arch, and saves them to conf/baked_ami.json
+
+    * targets: [(identity, subnet_id)], the subnet should reach the Internet;
+      one target is kept per account and region
+
+    Returns ({account: {region: {arch: ami}}} of new images, {(account,
+    region, arch): error}). Other images in conf/baked_ami.json are kept.
+    """
+
+    jobs = {}
+    for identity, subnet_id in targets:
+        for arch in archs:
+            jobs.setdefault(" ".join((_account(identity), identity["region"], arch)),
+                lambda identity=identity, subnet_id=subnet_id, arch=arch: _try(lambda: bake_image(
+                    AWSConn(identity, None, "bake")("ec2"), identity["region"], arch, subnet_id, **kwargs)))
+
+    baked, errors, amis = {}, {}, baked_amis()
+    for key, (ami, error) in sorted(run_parallel(jobs).items()):
+        account, region, arch = key.split(" ")
+        if error is not None:
+            errors[(account, region, arch)] = error
+            continue
+        baked.setdefault(account, {}).setdefault(region, {})[arch] = ami
+        amis.setdefault(account, {}).setdefault(region, {})[arch] = ami
+
+    if baked:
+        save_config(BAKED_AMI, amis)
+
+    return baked, errors
+
+def bake_image(conn_ec2, region, arch, subnet_id, sleep = time.sleep, clock = time.time,
+        interval = 15, timeout = 1800):
+    """Builds one image with `conn_ec2`, returns its ID
+
+    The builder instance is terminated whether the image is created or not.
+    """
+
+    stock = load_tpl("main.json")["Mappings"]["AWSRegionArch2AMI"][region][arch]
+
+    interfaces = NetworkInterfaceCollection(NetworkInterfaceSpecification(
+        subnet_id = subnet_id, device_index = 0, associate_public_ip_address = True))
+
+    instance = conn_ec2.run_instances(stock, instance_type = BUILDER_TYPES[arch],
+        user_data = BUILD_SCRIPT, network_interfaces = interfaces,
+        instance_initiated_shutdown_behavior = "stop").instances[0]
+    show.verbose("Baking %s %s" % (region, arch), "on builder %s from %s" % (instance.id, stock))
+
+    try:
+        _wait_for(lambda: conn_ec2.get_all_instances(instance_ids = [instance.id])[0].instances[0].state,
+            "stopped", ("terminated", "shutting-down"), sleep, clock, interval, timeout)
+
+        ami = conn_ec2.create_image(instance.id, "instavpn-%s-%s" % (arch, time.strftime("%Y%m%d-%H%M%S")),
+            "InstaVPN: openswan and aws-cfn-bootstrap on %s" % stock)
+
+        _wait_for(lambda: conn_ec2.get_all_images(image_ids = [ami])[0].state,
+            "available", ("failed", "invalid", "deregistered"), sleep, clock, interval, timeout)
+    finally:
+        conn_ec2.terminate_instances([instance.id])
+
+    show.verbose("Baked %s %s" % (region, arch), ami)
+    return ami
+
+def _wait_for(describe, wanted, failed, sleep, clock, interval, timeout):
+    deadline = clock() + timeout
+    while True:
+        state = describe()
+        if wanted == state:
+            return state
+        if state in failed:
+            raise Exception("%s, instead of %s" % (state, wanted))
+        if clock() > deadline:
+            raise Exception("Still %s after %ds, instead of %s" % (state, timeout, wanted))
+        sleep(interval)
+
+def _try(fn):
+    """(result, None) or (None, exception)"""
+    try:
+        return fn(), None
+    except Exception as e:
+        return None, e
+
+def _account(identity):
+    return identity_account(identity) or "default"
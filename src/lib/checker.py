@@ -3,83 +3,142 @@
 """
 Automatic config tests.
 
-Rules should start with rule_, and are executed in alphabetical order.
-To minimize namespace conflict, we encourage defining utility functions
-under their parents' scope, or into other modules.
+Rules should start with rule_, and declare what they depend on and how
+expensive they are with the @rule decorator. Rules without @rule depend on
+every rule sorted before them, ie., run in alphabetical order. To minimize
+namespace conflict, we encourage defining utility functions under their
+parents' scope, or into other modules.
 
-Should only access `config` and `conn` under session,
-while `tags` and `params` are built accordingly in rule_99.
+chk_session runs OFFLINE rules as soon as their dependencies are met, so
+that bad configs fail before any AWS round trip; AWS-bound rules that are
+ready at the same time run concurrently.
+
+Should only access `config`, `conn` and `cache` under session, while `tags`
+and `params` are built accordingly in rule_99, and `shards` in rule_70. Read subnets, VPCs, route
+tables and IGWs from session["cache"] instead of describing them again.
 
 """
 
 import random
+import re
+import time
 
-from iptools import IpRange
 from boto.exception import EC2ResponseError
-from base64 import urlsafe_b64encode
 
 from .aws_conn import AWSConn
 from .ui import show, ask
-from .config import load_config
+from .keys import create_shared_secret
+from .parallel import run_parallel
+from .trace import span
+from .resources import build_cache
+from .cidr import cidr_range, find_conflicts, CidrIndex
+from .tunnels import shard_config
+from .actuator import client_route_tables
+
+OFFLINE, AWS = "offline", "aws"
+
+def rule(depends=(), cost=OFFLINE):
+    """Declares dependencies (rule names) and cost of a rule"""
+    def _decorate(fn):
+        fn.depends, fn.cost = tuple(depends), cost
+        return fn
+    return _decorate
 
 def chk_session(session):
-    """Run through all tests; stop after first failure"""
+    """Run through all tests; stop after first failure
+
+    Per-rule timings are kept in session["timings"] as {rule name: seconds}.
+    """
     show.output("Checking config")
 
-    for rule in rules:
-        try:
-            show.unless_quiet("Checking", rule[0])
-            assert rule[1](session)
-        except Exception as e:
-            show.verbose(msg = "Config check `%s` failed%s%s" % (
-                rule[0],
-                ", %s" % e if len(str(e)) > 0 else "",
-                (": %s" % rule[1].__doc__.split("\n")[0].strip())
-                    if rule[1].__doc__ else "."
-            ))
+    session["timings"] = {}
+    done, pending = set(), [r[0] for r in rules]
+    fns = dict(rules)
 
+    while pending:
+        ready = [name for name in pending if all(d in done for d in _depends(name, fns))]
+        if not ready:
+            show.error("Config check", "unresolvable rule dependencies: %s" % ", ".join(pending))
             return False
 
-    return True
+        offline = [name for name in ready if OFFLINE == getattr(fns[name], "cost", AWS)]
+        batch = offline[:1] or ready
 
-def cidr_overlaps(cidr1, cidr2):
-    ir1, ir2 = IpRange(cidr1), IpRange(cidr2)
+        for name in batch:
+            show.unless_quiet("Checking", name)
 
-    if ir1.startIp < ir2.startIp:
-        if ir1.endIp < ir2.startIp:
-            return False
-    elif ir1.startIp > ir2.endIp:
-        return False
+        if len(batch) > 1:
+            results = run_parallel(dict(
+                (name, (lambda name=name: _run_rule(name, fns[name], session)))
+                for name in batch))
+        else:
+            results = {batch[0]: _run_rule(batch[0], fns[batch[0]], session)}
 
-    return True
+        for name in batch:
+            error, seconds = results[name]
+            session["timings"][name] = seconds
+            show.verbose("Checked %s" % name, "in %.3fs" % seconds)
 
-def _create_shared_secret():
-    """Creates shared secret with #bits assigned in instavpn.json
+            if error is not None:
+                show.verbose(msg = "Config check `%s` failed%s%s" % (
+                    name,
+                    ", %s" % error if len(str(error)) > 0 else "",
+                    (": %s" % fns[name].__doc__.split("\n")[0].strip())
+                        if fns[name].__doc__ else "."
+                ))
 
-    Uses random.SystemRandom.randint, which pulls randomness from /dev/urandom,
-    and thus system entropy pool when it's available, then falls back to prng
-    if it's empty.
-    """
+                return False
 
-    randint = random.SystemRandom().randint
-    bits = load_config("instavpn.json")["shared_secret_bits"]
-    return urlsafe_b64encode("".join(chr(randint(0, 255)) for _ in xrange(bits/8)))
+            done.add(name)
+            pending.remove(name)
+
+    show.unless_quiet("Config checked", "in %.3fs" % sum(session["timings"].values()))
+    return True
+
+def _run_rule(name, fn, session):
+    """Returns (exception or None, seconds)"""
+    started = time.time()
+    try:
+        with span(name, "rule"):
+            assert fn(session)
+        return None, time.time() - started
+    except Exception as e:
+        return e, time.time() - started
+
+def _depends(name, fns):
+    if hasattr(fns[name], "depends"):
+        return fns[name].depends
+    return [n for n in fns if n < name]
+
+def cidr_overlaps(cidr1, cidr2):
+    (start1, end1), (start2, end2) = cidr_range(cidr1), cidr_range(cidr2)
+    return start1 <= end2 and start2 <= end1
 
 # ============================================================================
 # 00: Integrity and job serial
 
+@rule()
 def rule_00_config_is_dict(session):
     """config should be a dict"""
     return isinstance(session["config"], dict)
 
+@rule(depends=["rule_00_config_is_dict"])
 def rule_01_set_job_id(session):
     """Pick instavpn ID as hex string to identify task
 
     Use randint from random instead of SystemRandom, which is less secure, but
-    does not consume system entropy.
+    does not consume system entropy. An existing deployment is targeted with
+    session["task_id"], either the ID or one of its stack names.
     """
 
-    my_id = "".join("%02x" % random.randint(0,255) for _ in xrange(4))
+    if session.get("task_id"):
+        matched = re.match(r"^(?:instavpn-)?([0-9a-f]+)(?:-(?:client|server)(?:-\d+)?(?:-standby)?)?$",
+            session["task_id"])
+        if not matched:
+            raise Exception("Invalid task ID %s" % session["task_id"])
+        my_id = matched.group(1)
+    else:
+        my_id = "".join("%02x" % random.randint(0,255) for _ in xrange(4))
 
     session["config"]["tags"]["instavpn"] = my_id
     show.output("Instavpn Task ID", "is %s" % my_id)
@@ -89,19 +148,21 @@ def rule_01_set_job_id(session):
 # ============================================================================
 # 20: Bring up environments and connection
 
+@rule(depends=["rule_01_set_job_id"])
 def rule_20_connect(session):
     """Create the `conn` side in session"""
 
     c, my_id = session["config"], session["config"]["tags"]["instavpn"]
 
     session["conn"].update({
-        "server": AWSConn(c["server"]["identity"], my_id),
-        "client": AWSConn(c["client"]["identity"], my_id),
+        "server": AWSConn(c["server"]["identity"], my_id, "server"),
+        "client": AWSConn(c["client"]["identity"], my_id, "client"),
     })
 
     return True
 
 
+@rule(depends=["rule_00_config_is_dict"])
 def rule_20_fill_config_tags_params(session):
     """Fill in session["config"]"""
     session["config"]["tags"]['Service'] = session["config"]["client"]["name"]
@@ -110,18 +171,32 @@ def rule_20_fill_config_tags_params(session):
 
 
 # ============================================================================
-# 40: Tests that rely on AWS connection
+# 30: Resources used by the following rules and post-config
+
+@rule(depends=["rule_20_connect"], cost=AWS)
+def rule_30_prefetch_resources(session):
+    """Fetch subnets, IGWs, and client VPC and route tables"""
+
+    cache = build_cache(session)
+    run_parallel({
+        "server": lambda: cache["server"].prefetch(("igws",)),
+        "client": lambda: cache["client"].prefetch(("vpc", "route_tables", "igws")),
+    })
+
+    return True
+
+# ============================================================================
+# 40: Tests that rely on AWS resources
 
+@rule(depends=["rule_30_prefetch_resources"])
 def rule_40_extend_subnet_cidr(session):
     """Adds subnet CIDR to `subnets` if it's not there"""
 
-    config, conn = session["config"], session["conn"]
+    config, cache = session["config"], session["cache"]
 
-    def append_cidr(config_side, conn_vpc):
+    def append_cidr(config_side, res):
 
-        cidr = conn_vpc.get_all_subnets([
-            config_side["res"]["subnet_id"]
-        ])[0].cidr_block
+        cidr = res.subnet.cidr_block
 
         for user_cidr in config_side["ipsec"]["subnets"]:
             if cidr_overlaps(cidr, user_cidr):
@@ -129,17 +204,18 @@ def rule_40_extend_subnet_cidr(session):
 
         config_side["ipsec"]["subnets"].append(cidr)
 
-    append_cidr(config["server"], conn["server"]("vpc"))
-    append_cidr(config["client"], conn["client"]("vpc"))
+    append_cidr(config["server"], cache["server"])
+    append_cidr(config["client"], cache["client"])
 
     return True
 
+@rule(depends=["rule_30_prefetch_resources"], cost=AWS)
 def rule_40_can_create_sg(session):
     """Authorized to create security group"""
 
     def try_create(session, side):
-        res, conn_vpc = session["config"][side]["res"], session["conn"][side]("vpc")
-        subnet = conn_vpc.get_all_subnets([res["subnet_id"]])[0]
+        conn_vpc = session["conn"][side]("vpc")
+        subnet = session["cache"][side].subnet
 
         try:
             conn_vpc.create_security_group(
@@ -148,94 +224,99 @@ def rule_40_can_create_sg(session):
             if 412 != e.status:
                 raise e
 
-    try_create(session, "server")
-    try_create(session, "client")
+    run_parallel({
+        "server": lambda: try_create(session, "server"),
+        "client": lambda: try_create(session, "client"),
+    })
 
     return True
 
+@rule(depends=["rule_30_prefetch_resources"])
 def rule_40_rtb_and_subnet_in_same_vpc(session):
     """Route table and subnet belongs to the same vpc"""
 
-    conn, conf = session["conn"]["client"], session["config"]["client"]
+    res, conf = session["cache"]["client"], session["config"]["client"]
 
     if conf["res"]["route_table_id"] is None:
         return True
 
-    main_rtb = None
-    subnet = conn("vpc").get_all_subnets([conf["res"]["subnet_id"]])[0]
-    rtb = conn("vpc").get_all_route_tables([conf["res"]["route_table_id"]])[0]
+    rtb = res.route_table(conf["res"]["route_table_id"])
 
-    return rtb.vpc_id == subnet.vpc_id
+    return rtb.vpc_id == res.subnet.vpc_id
 
+@rule(depends=["rule_30_prefetch_resources"])
 def rule_40_igw_available(session):
     """igw attached to both vpcs"""
-    def has_igw(session, side):
-        conn_vpc = session["conn"][side]("vpc")
-        subnet = conn_vpc.get_all_subnets(
-            [session["config"][side]["res"]["subnet_id"]])[0]
+    cache = session["cache"]
 
-        for igw in conn_vpc.get_all_internet_gateways():
-            for att in igw.attachments:
-                if att.vpc_id == subnet.vpc_id:
-                    return True
-        return False
-
-    return has_igw(session, "server") and has_igw(session, "client")
+    return len(cache["server"].igws) > 0 and len(cache["client"].igws) > 0
 
 # ============================================================================
 # 60: Tests with Dependency
 
+@rule(depends=["rule_40_rtb_and_subnet_in_same_vpc", "rule_40_extend_subnet_cidr"])
 def rule_60_rtb_route_compatible(session):
-    """No conflict between existing routes and what we will add"""
-    # Depends on: rule_40_rtb_same_vpc
-
-    # TODO: iterate all rtb associations
-    # if another rule exists for the exact CIDR
-        # if pointing to a black hole
-            # show message and continue
-        # else: error & end
-    # elseif for overlapped (but not equal) CIDR:
-        # error and end
-    # else: pass
+    """Existing routes to server subnets point to an instance, which may be replaced"""
+
+    cidrs = set(session["config"]["server"]["ipsec"]["subnets"])
+    conflicts = ["%s in %s" % (route.destination_cidr_block, rtb.id)
+        for rtb in client_route_tables(session) for route in rtb.routes
+        if route.destination_cidr_block in cidrs and route.instance_id is None]
 
+    if conflicts:
+        raise Exception("Route to %s not through an instance, won't replace it" % ", ".join(conflicts))
     return True
 
+@rule(depends=["rule_40_extend_subnet_cidr"])
 def rule_60_subnet_cidr_conflict(session):
     """Subnet CIDR conflicts"""
-    # Depends on: rule_40_extend_subnet_cidr
-
     config = session["config"]
-
-    pool = []
     cidrs = config["client"]["ipsec"]["subnets"] + config["server"]["ipsec"]["subnets"]
 
-    # todo: rewrite with heap tree ?
-    for cidr in cidrs:
-        for against in pool:
-            if cidr_overlaps(cidr, against):
-                raise Exception("Conflict between subnet (%s, %s)" % (cidr, against))
-        pool.append(cidr)
+    conflicts = find_conflicts(cidrs)
+    if conflicts:
+        raise Exception("Conflict between subnet %s" % ", ".join(
+            "(%s, %s)" % pair for pair in conflicts))
 
     return True
 
+@rule(depends=["rule_40_extend_subnet_cidr"])
 def rule_60_all_server_routable(session):
     """All servers belong to exposed CIDRs from Server"""
-    # Depends on: rule_40_extend_subnet_cidr
-
     conf_server = session["config"]["server"]
-    subnets = [IpRange(sn) for sn in conf_server["ipsec"]["subnets"]]
+    index = CidrIndex(conf_server["ipsec"]["subnets"])
+
+    unreachable = [server['ip'] for server in conf_server["res"]["servers_allowed"]
+        if index.covering(server['ip']) is None]
+
+    if unreachable:
+        raise Exception("Unreachable server %s detected" % ", ".join(unreachable))
+    return True
+
+# ============================================================================
+# 70: Tunnels
+
+@rule(depends=["rule_60_subnet_cidr_conflict", "rule_60_all_server_routable"])
+def rule_70_shard_tunnels(session):
+    """Server subnets can be sharded across `tunnels`, which `ha` needs to be 1"""
+
+    session["shards"] = shard_config(session["config"])
+    if session["config"].get("ha") and len(session["shards"]) > 1:
+        # The monitor pings the server instance, whose subnet is in one shard only
+        raise Exception("ha with %d tunnels: only one of them routes the server instance "
+            "through its tunnel, so the others would always fail over" % len(session["shards"]))
+
+    if len(session["shards"]) > 1:
+        for idx, shard in enumerate(session["shards"], 1):
+            show.verbose("Tunnel %d" % idx, "%s, %d servers" % (
+                " ".join(shard["cidrs"]), len(shard["servers_allowed"])))
 
-    for server in conf_server["res"]["servers_allowed"]:
-        for subnet in subnets:
-            if server['ip'] in subnet:
-                break
-        else:
-            raise Exception("Unreachable server %s detected" % server['ip'])
     return True
 
 # ============================================================================
 # rule 80: Finally
 
+@rule(depends=["rule_01_set_job_id", "rule_20_fill_config_tags_params"])
 def rule_80_create_keys_params(session):
     if 'tags' not in session: session['tags'] = {}
     session["tags"].update(session["config"]["tags"])
@@ -245,11 +326,13 @@ def rule_80_create_keys_params(session):
 
     return True
 
+@rule(depends=[
+    "rule_40_can_create_sg", "rule_40_igw_available", "rule_60_rtb_route_compatible",
+    "rule_60_subnet_cidr_conflict", "rule_60_all_server_routable", "rule_70_shard_tunnels",
+    "rule_80_create_keys_params"])
 def rule_99_fill_tags_params(session):
     def _params(session, side, prefix):
-        conf, conn = session["config"][side], session["conn"][side]
-
-        subnet = conn("vpc").get_all_subnets(conf["res"]["subnet_id"])[0]
+        conf, subnet = session["config"][side], session["cache"][side].subnet
 
         return [
             (prefix + "SharedCIDRs" , " ".join(conf["ipsec"]["subnets"])),
@@ -260,7 +343,7 @@ def rule_99_fill_tags_params(session):
     session["params"] += [
         ("ServerName", "DCS"),
         ("ClientName", session["config"]["tags"]['Service']),
-        ("SharedSecret", _create_shared_secret())
+        ("SharedSecret", session.get("shared_secret") or create_shared_secret())
     ]
 
     session["params"] += _params(session, "server", "Server")
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Integer-interval helpers for IPv4 CIDRs
+
+CIDRs are handled as inclusive (start, end) integer ranges, which avoids
+building iptools.IpRange objects for every comparison.
+"""
+
+import heapq
+from bisect import bisect_right
+
+def ip_to_int(ip):
+    """Dotted IPv4 to integer; short forms are padded, eg., 172.16 = 172.16.0.0"""
+
+    parts = ip.strip().split(".")
+    if not 0 < len(parts) <= 4:
+        raise ValueError("Invalid IPv4 address %s" % ip)
+
+    ret = 0
+    for part in parts + ["0"] * (4 - len(parts)):
+        octet = int(part)
+        if not 0 <= octet <= 255:
+            raise ValueError("Invalid IPv4 address %s" % ip)
+        ret = (ret << 8) | octet
+
+    return ret
+
+def int_to_ip(value):
+    """Integer to dotted IPv4"""
+    return ".".join("%d" % ((value >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+def cidr_prefix(cidr):
+    """Prefix length of a CIDR, 32 for a bare IP"""
+    prefix = cidr.partition("/")[2]
+    return int(prefix) if prefix else 32
+
+def split_cidr(cidr):
+    """Both halves of `cidr`, one bit longer; ValueError for a /32"""
+
+    prefix = cidr_prefix(cidr)
+    if prefix >= 32:
+        raise ValueError("Can't split %s" % cidr)
+
+    start, end = cidr_range(cidr)
+    middle = start + ((end - start + 1) >> 1)
+    return ["%s/%d" % (int_to_ip(start), prefix + 1), "%s/%d" % (int_to_ip(middle), prefix + 1)]
+
+def cidr_range(cidr):
+    """CIDR to inclusive (start, end) integers; host bits are ignored"""
+
+    ip, _, prefix = cidr.partition("/")
+    prefix = int(prefix) if prefix else 32
+    if not 0 <= prefix <= 32:
+        raise ValueError("Invalid CIDR %s" % cidr)
+
+    host = (1 << (32 - prefix)) - 1
+    start = ip_to_int(ip) & ~host & 0xffffffff
+
+    return start, start | host
+
+def find_conflicts(cidrs):
+    """All pairs of overlapping CIDRs, in O(n log n + conflicts)
+
+    Sweeps ranges in order of their start, keeping ranges still open in a
+    min-heap keyed by their end. Returns [(cidr, earlier cidr)], ordered by
+    position of the first then the second CIDR in `cidrs`.
+    """
+
+    ranges = sorted(
+        (cidr_range(cidr) + (idx, cidr) for idx, cidr in enumerate(cidrs)),
+        key = lambda r: (r[0], -r[1]))
+
+    conflicts, active = [], [] # active: heap of (end, idx, cidr)
+
+    for start, end, idx, cidr in ranges:
+        while active and active[0][0] < start:
+            heapq.heappop(active)
+
+        for _, other_idx, other in active:
+            conflicts.append((idx, other_idx) if idx > other_idx else (other_idx, idx))
+
+        heapq.heappush(active, (end, idx, cidr))
+
+    conflicts.sort()
+    return [(cidrs[a], cidrs[b]) for a, b in conflicts]
+
+class CidrIndex(object):
+    """Finds the CIDR covering an IP with a binary search over range bounds
+
+    CIDRs either nest or don't overlap at all; nested ones are folded into
+    the outermost CIDR, leaving disjoint ranges sorted by start.
+    """
+
+    def __init__(self, cidrs):
+        self.starts, self.ends, self.cidrs = [], [], []
+
+        for start, end, cidr in sorted(
+                (cidr_range(cidr) + (cidr,) for cidr in cidrs),
+                key = lambda r: (r[0], -r[1])):
+            if self.ends and end <= self.ends[-1]:
+                continue # Nested
+
+            self.starts.append(start)
+            self.ends.append(end)
+            self.cidrs.append(cidr)
+
+    def covering(self, ip):
+        """The CIDR covering `ip`, None if there is none"""
+        ip = ip_to_int(ip)
+        idx = bisect_right(self.starts, ip) - 1
+
+        if idx >= 0 and ip <= self.ends[idx]:
+            return self.cidrs[idx]
+        return None
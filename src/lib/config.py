@@ -10,6 +10,14 @@ from termcolor import colored
 from .ui import show, ask
 from .io import load_config, load_tpl
 
+# Input formats, shared with the offline validator
+RE_CLIENT_NAME = r"[a-zA-Z0-9\-\_]+"
+RE_SERVER = r"(?:(tcp|udp|all):)?((?:\d{1,3}\.){3}\d{1,3})(?:\:(\d{1,5}))?"
+RE_ROLE_ARN = r"arn:aws:iam::\d{12}:role/.+"
+RE_SUBNET_ID = r"^subnet-[0-9a-f]{8,}$"
+RE_CIDR = r"(\d{1,3}\.){3}\d{1,3}/\d{1,2}"
+RE_ROUTE_TABLE_ID = r"^rtb-[a-z0-9]{8,}$"
+
 #
 # Public functions
 #
@@ -20,6 +28,7 @@ def ask_config():
     show.heading("Shared Config")
     _ask_client_name(config)
     _ask_instance_type(config)
+    _ask_tunnel_profile(config)
     _ask_tags(config)
 
     def _ask_side(config_side):
@@ -42,7 +51,7 @@ def ask_config():
 #
 
 def _ask_client_name(config):
-    config["client"]["name"] = ask.until("Client Name: ", "[a-zA-Z0-9\-\_]+")
+    config["client"]["name"] = ask.until("Client Name: ", RE_CLIENT_NAME)
 
 def _ask_instance_type(config):
     instance_types = load_tpl("main.json")["Parameters"]["InstanceType"]["AllowedValues"]
@@ -60,6 +69,13 @@ def _ask_instance_type(config):
 
     config['params']['InstanceType'] = instance_type
 
+def _ask_tunnel_profile(config):
+    """Throughput tunes IPsec and the kernel for bulk transfers, see main.json"""
+    parameter = load_tpl("main.json")["Parameters"]["TunnelProfile"]
+
+    config['params']['TunnelProfile'] = ask.choose(
+        "Tunnel profile", parameter["AllowedValues"], parameter["Default"], [])
+
 def _ask_tags(config):
     """Ask about tags in `default_config`, that will be pushed to most resources
     created by this script, including EC2 Instance, ENI (automatically via CFN)
@@ -90,7 +106,7 @@ def _ask_dest(servers_allowed):
     while True:
         groups = list(ask.until(
             "Allow access to: ",
-            r'(?:\.|(?:(tcp|udp|all):)?((?:\d{1,3}\.){3}\d{1,3})(?:\:(\d{1,5}))?)',
+            r'(?:\.|%s)' % RE_SERVER,
             return_groups=True))
 
         if groups[1] is None:
@@ -143,7 +159,7 @@ def _ask_access(config_side):
     show.unless_quiet(msg="Enter Role ARN if you access those resources as an IAM Role. "
         "Leave it empty if you don't use IAM Role")
 
-    role_arn = ask.until("Role ARN: ", "arn:aws:iam::\d{12}:role/.+", optional=True)
+    role_arn = ask.until("Role ARN: ", RE_ROLE_ARN, optional=True)
     config_side['identity']['role_arn'] = role_arn
 
 
@@ -152,7 +168,7 @@ def _ask_ec2_vpc(config_side):
     # Subnet
 
     show.unless_quiet(msg="Enter Subnet ID, eg., subnet-3345678.")
-    subnet_id = ask.until("Subnet ID: ", "^subnet-[0-9a-f]{8,}$")
+    subnet_id = ask.until("Subnet ID: ", RE_SUBNET_ID)
     config_side['res']['subnet_id'] = subnet_id
 
 def _ask_subnets(config_side):
@@ -163,7 +179,7 @@ def _ask_subnets(config_side):
     while True:
         sn = ask.until(
             "Routed CIDR [%d]: " % len(config_side['ipsec']['subnets']),
-            r"((\d{1,3}\.){3}\d{1,3}/\d{1,2})\s*|\.$")
+            r"(%s)\s*|\.$" % RE_CIDR)
 
         if sn and '.' != sn:
             config_side['ipsec']['subnets'].append(sn)
@@ -175,5 +191,10 @@ def _ask_route_table(config_side):
         "Client should be responsible to maintain and config that route table. "
         "Example: rtb-12345678. ")
 
-    rt_id = ask.until("Route Table ID:", r"^rtb-[a-z0-9]{8,}$", optional=True)
+    rt_id = ask.until("Route Table ID:", RE_ROUTE_TABLE_ID, optional=True)
     config_side["res"]["route_table_id"] = rt_id
+
+    show.unless_quiet(msg="InstaVPN can also route through the VPN in every route table "
+        "associated with the client VPC.")
+    config_side["res"]["route_all_tables"] = 'y' == ask.yn(
+        "Route in all associated Route Tables ?", default='n').lower()
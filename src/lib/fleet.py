@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Fleet mode: check and provision many VPN pairs from one manifest
+
+Manifest is a json file, either a list of configs or a dict:
+
+    {
+        "configs": ["client-a.json", "client-b.json", {...inline config...}],
+        "jobs": 8,
+        "per_account": 2,
+        "per_region": 4
+    }
+
+Relative paths are resolved against the manifest. Every deployment touches
+an (account, region) pair on each side; at most `per_account` deployments
+run against the same account, and `per_region` against the same region of
+an account. AWS connections are shared across deployments by AWSConn.
+"""
+
+import threading
+import time
+from os.path import dirname, join, basename
+from Queue import Queue
+
+from .ui import show
+from .io import load_json
+from .aws_conn import identity_account
+from .keys import create_shared_secrets
+from .checker import chk_session
+from .actuator import build_world
+
+DEFAULT_LIMITS = {"jobs": 4, "per_account": 2, "per_region": 2}
+
+def load_manifest(filename):
+    """Returns (jobs, limits), where jobs is a list of (name, config)
+
+    Raises ValueError, naming `filename`, if it has no list of configs
+    """
+
+    manifest = load_json(filename)
+    if isinstance(manifest, list):
+        manifest = {"configs": manifest}
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("configs"), list):
+        raise ValueError("`%s` should be a list of configs, or a dict with them under \"configs\"" %
+            getattr(filename, "name", filename))
+
+    limits = dict(DEFAULT_LIMITS)
+    limits.update((k, int(manifest[k])) for k in DEFAULT_LIMITS if manifest.get(k))
+
+    jobs, base = [], "." if hasattr(filename, "read") else dirname(filename)
+    for idx, entry in enumerate(manifest["configs"], 1):
+        if isinstance(entry, dict):
+            jobs.append(("#%d" % idx, entry))
+        else:
+            jobs.append((basename(entry), load_json(join(base, entry))))
+
+    return jobs, limits
+
+def run_fleet(jobs, limits, confirm=None, single_pass=False):
+    """Checks all jobs, then builds the ones passed
+
+    * confirm: called with the number of jobs to build, returns False to stop
+      after the check phase
+    * single_pass: build with allocate_eips and cfn_create, see build_world
+
+    Returns the report, a list of dicts ordered as `jobs`
+    """
+
+    limiter = _Limiter(limits["per_account"], limits["per_region"])
+    secrets = create_shared_secrets(len(jobs))
+    report = [{
+        "name": name, "status": "pending", "task_id": None, "error": None,
+        "seconds": 0.0, "session": {"config": config, "conn": {}, "shared_secret": secret,
+            "single_pass": single_pass}
+    } for (name, config), secret in zip(jobs, secrets)]
+
+    show.heading("Fleet", "checking %d configs" % len(report))
+    _pool(report, _check, limits["jobs"], limiter)
+
+    passed = [r for r in report if "checked" == r["status"]]
+    if passed and (confirm is None or confirm(len(passed))):
+        show.heading("Fleet", "building %d VPNs" % len(passed))
+        _pool(passed, _build, limits["jobs"], limiter)
+
+    for r in report:
+        if "checked" == r["status"]:
+            r["status"] = "skipped"
+        del r["session"]
+
+    return report
+
+def show_report(report):
+    show.heading("Fleet report")
+    for r in report:
+        (show.output if "built" == r["status"] else show.error)(
+            "%-24s %-12s" % (r["name"], r["status"]),
+            "%-9s %7.1fs %s" % (r["task_id"] or "-", r["seconds"], r["error"] or ""))
+
+    failed = len([r for r in report if r["status"] not in ("built", "skipped")])
+    show.output("Fleet:", "%d built, %d failed, %d total" % (
+        len([r for r in report if "built" == r["status"]]), failed, len(report)))
+
+    return 0 == failed
+
+#
+# Internal functions
+#
+
+def _check(r):
+    if chk_session(r["session"]):
+        r["status"] = "checked"
+    else:
+        r["status"] = "check_failed"
+    r["task_id"] = r["session"]["config"].get("tags", {}).get("instavpn")
+
+def _build(r):
+    build_world(r["session"])
+    r["status"] = "built"
+
+def _pool(report, fn, workers, limiter):
+    """Run fn(r) for every entry with at most `workers` threads"""
+
+    queue = Queue()
+    for r in report:
+        queue.put(r)
+
+    def _worker():
+        while True:
+            try:
+                r = queue.get_nowait()
+            except Exception:
+                return
+
+            started = time.time()
+            try:
+                with limiter.hold(r["session"]["config"]):
+                    fn(r)
+            except Exception as e:
+                r["status"] = "%s_failed" % fn.__name__.strip("_")
+                r["error"] = "%s" % e
+            finally:
+                r["seconds"] += time.time() - started
+
+    threads = [threading.Thread(target=_worker) for _ in range(max(1, min(workers, len(report))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    for t in threads:
+        while t.is_alive():
+            t.join(0.2)
+
+class _Limiter(object):
+    """Per-account and per-region concurrency caps"""
+
+    def __init__(self, per_account, per_region):
+        self.per_account, self.per_region = per_account, per_region
+        self._sems = {}
+        self._lock = threading.Lock()
+
+    def _sem(self, key, value):
+        with self._lock:
+            if key not in self._sems:
+                self._sems[key] = threading.BoundedSemaphore(value)
+            return self._sems[key]
+
+    def hold(self, config):
+        keys = set()
+        for side in ("server", "client"):
+            try:
+                identity = config[side]["identity"]
+            except (KeyError, TypeError):
+                continue # Left to the checker
+
+            account = identity_account(identity)
+            keys.add(("account", account))
+            keys.add(("region", account, identity.get("region")))
+
+        # Acquire in a fixed order to avoid deadlocks
+        return _Holding([
+            self._sem(k, self.per_account if "account" == k[0] else self.per_region)
+            for k in sorted(keys)])
+
+class _Holding(object):
+    def __init__(self, sems):
+        self.sems = sems
+
+    def __enter__(self):
+        for sem in self.sems:
+            sem.acquire()
+
+    def __exit__(self, *exc):
+        for sem in reversed(self.sems):
+            sem.release()
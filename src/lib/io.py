@@ -1,27 +1,191 @@
 # -*- coding: utf-8 -*-
 
+import copy
+import hashlib
 import json
+import os
 from os.path import realpath, dirname
 
 __root_path = dirname(dirname(realpath(__file__)))
 
+__tpl_cache = {}    # {tpl_name: (digest, template)}
+__body_cache = {}   # {(digest, MySide, region, params): body}
+
 def load_config(config_name):
     """ Load json config file from /conf/ """
     conf_path = "%s/conf/" % __root_path
     return load_json("%s%s" % (conf_path, config_name))
 
+def save_config(config_name, data):
+    """ Save json config file to /conf/ """
+    with open("%s/conf/%s" % (__root_path, config_name), "w") as fp:
+        json.dump(data, fp, indent = 4, sort_keys = True)
+
 def load_tpl(tpl_name):
-    tpl_path = "%s/cfn-tpl/" % __root_path
-    return load_json("%s%s" % (tpl_path, tpl_name))
+    """ Load CloudFormation template from /cfn-tpl/
+
+        Parsed once per process; the returned dict is shared and should not
+        be modified.
+    """
+    return _parsed_tpl(tpl_name)[1]
+
+def compile_tpl(tpl_name, MySide = None, region = None, params = None):
+    """ Minified template body for one side and region
+
+        Resources and outputs whose Condition is false with `MySide` and
+        `params`, {name: value} of other parameters, are pruned, and Fn::If
+        resolved. Conditions depending on parameters not given are left to
+        CloudFormation. Mappings keyed by AWS::Region are cut down to
+        `region`, and unused ones dropped. {"InstaVPN::File": path} nodes
+        are replaced by the content of /src/<path>. Bodies are memoised by
+        template digest, side, region and params.
+    """
+    digest, tpl = _parsed_tpl(tpl_name)
+    key = (digest, MySide, region, tuple(sorted((params or {}).items())))
+
+    if key not in __body_cache:
+        __body_cache[key] = json.dumps(_prune_tpl(tpl, MySide, region, params),
+            separators = (",", ":"), sort_keys = True)
+
+    return __body_cache[key]
+
+def log_file(filename):
+    """ Path to `filename` under log_path of instavpn.json, which is created
+        if missing; relative log_path is resolved against /src/.
+    """
+    log_path = os.path.join(__root_path, load_config("instavpn.json")["log_path"])
+    if not os.path.isdir(log_path):
+        os.makedirs(log_path)
+    return os.path.normpath(os.path.join(log_path, filename))
 
 def load_json(filename):
     """ Load json from user-supplied filename
 
         Raises exception if the file is unaccessible or malformatted
     """
-    if type(filename) is str:
-        with open(filename) as fp:
-            return json.load(fp)
+    if hasattr(filename, "read"):
+        return json.load(filename)
+
+    with open(filename) as fp:
+        return json.load(fp)
+
+#
+# Internal functions
+#
+
+def _parsed_tpl(tpl_name):
+    """(sha1 of source, template); racing threads parse the same content"""
+    if tpl_name not in __tpl_cache:
+        with open("%s/cfn-tpl/%s" % (__root_path, tpl_name)) as fp:
+            source = fp.read()
+        __tpl_cache[tpl_name] = (hashlib.sha1(source).hexdigest(), json.loads(source))
+
+    return __tpl_cache[tpl_name]
+
+def _prune_tpl(tpl, MySide, region, params = None):
+    tpl = copy.deepcopy(tpl)
+
+    conditions = tpl.get("Conditions", {})
+    if MySide is not None and conditions:
+        known = dict(params or {}, MySide = MySide)
+        values = dict((name, _eval_condition(conditions, name, known)) for name in conditions)
+
+        for section in ("Resources", "Outputs"):
+            for name, entry in tpl.get(section, {}).items():
+                if "Condition" not in entry or values[entry["Condition"]] is None: continue
+                if values[entry["Condition"]]:
+                    del entry["Condition"]
+                else:
+                    del tpl[section][name]
+
+            if section in tpl:
+                tpl[section] = _resolve_ifs(tpl[section], values)
+
+        if not any("Fn::If" in node or "Condition" in node
+                for section in ("Resources", "Outputs") for node in _nodes(tpl.get(section, {}))):
+            del tpl["Conditions"]
+
+    if region is not None:
+        by_region = set(node["Fn::FindInMap"][0] for node in _nodes(tpl.get("Resources", {}))
+            if "Fn::FindInMap" in node and {"Ref": "AWS::Region"} == node["Fn::FindInMap"][1])
+
+        for name in by_region:
+            mapping = tpl["Mappings"][name]
+            if region in mapping:
+                tpl["Mappings"][name] = {region: mapping[region]}
+
+    if "Mappings" in tpl:
+        used = set(node["Fn::FindInMap"][0] for section in ("Resources", "Outputs")
+            for node in _nodes(tpl.get(section, {})) if "Fn::FindInMap" in node)
+        for name in set(tpl["Mappings"]) - used:
+            del tpl["Mappings"][name]
+        if not tpl["Mappings"]:
+            del tpl["Mappings"]
+
+    if "Resources" in tpl:
+        tpl["Resources"] = _inline_files(tpl["Resources"])
+
+    return tpl
+
+def _inline_files(node):
+    """`node` with {"InstaVPN::File": path} replaced by the file content"""
+    if isinstance(node, dict):
+        if "InstaVPN::File" in node and 1 == len(node):
+            with open(os.path.join(__root_path, node["InstaVPN::File"])) as fp:
+                return fp.read()
+        return dict((k, _inline_files(v)) for k, v in node.items())
+    if isinstance(node, list):
+        return [_inline_files(v) for v in node]
+    return node
+
+def _resolve_ifs(node, values):
+    """`node` with Fn::If of known conditions replaced by the chosen value"""
+    if isinstance(node, dict):
+        if "Fn::If" in node and 1 == len(node) and values.get(node["Fn::If"][0]) is not None:
+            return _resolve_ifs(node["Fn::If"][1 if values[node["Fn::If"][0]] else 2], values)
+        return dict((k, _resolve_ifs(v, values)) for k, v in node.items())
+    if isinstance(node, list):
+        return [_resolve_ifs(v, values) for v in node]
+    return node
+
+def _eval_condition(conditions, name, params):
+    """True or False, None if it depends on unknown parameters"""
+
+    def _value(node):
+        if isinstance(node, dict):
+            return params.get(node.get("Ref"))
+        return node
+
+    def _eval(node):
+        (fn, args), = node.items()
+        if "Condition" == fn:
+            return _eval(conditions[args])
+        if "Fn::Equals" == fn:
+            a, b = _value(args[0]), _value(args[1])
+            return None if a is None or b is None else a == b
+        if "Fn::Not" == fn:
+            value = _eval(args[0])
+            return None if value is None else not value
+
+        values = [_eval(arg) for arg in args]
+        if "Fn::Or" == fn:
+            return True if True in values else (None if None in values else False)
+        if "Fn::And" == fn:
+            return False if False in values else (None if None in values else True)
+        return None
+
+    return _eval(conditions[name])
 
-    return json.load(filename)
+def _nodes(node):
+    """All dicts nested in node"""
+    if isinstance(node, dict):
+        yield node
+        children = node.values()
+    elif isinstance(node, list):
+        children = node
+    else:
+        return
 
+    for child in children:
+        for nested in _nodes(child):
+            yield nested
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Key material
+
+Shared secrets are read from os.urandom, the source SystemRandom draws from
+as well, with one call for as many secrets as requested, then encoded as
+urlsafe base64.
+"""
+
+import os
+from base64 import urlsafe_b64encode
+
+from .io import load_config
+
+__bits = []
+
+def secret_bits():
+    """#bits of a shared secret, as assigned in instavpn.json; read once"""
+    if not __bits:
+        __bits.append(load_config("instavpn.json")["shared_secret_bits"])
+    return __bits[0]
+
+def create_shared_secrets(count, bits = None):
+    """`count` shared secrets of `bits` each"""
+
+    size = (bits or secret_bits()) / 8
+    pool = os.urandom(size * count)
+
+    return [urlsafe_b64encode(pool[i:i + size]) for i in xrange(0, size * count, size)]
+
+def create_shared_secret(bits = None):
+    return create_shared_secrets(1, bits)[0]
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+AWS API call metrics
+
+Connections handed out by AWSConn report every API call here, keyed by
+(side, service, region, action): calls, errors, throttling errors, retries
+boto made under the hood, and time spent. `api_metrics` is shared by every
+deployment in the process, eg., all jobs of a fleet run.
+"""
+
+import re
+import threading
+
+from .ui import show
+
+THROTTLING_CODES = frozenset([
+    "Throttling", "ThrottlingException", "ThrottledException", "RequestThrottled",
+    "RequestLimitExceeded", "TooManyRequestsException", "SlowDown",
+    "RequestThrottledException", "PriorRequestNotComplete"])
+
+_RE_CODE = re.compile(r"<Code>([^<]+)</Code>")
+
+def error_code(error):
+    """AWS error code of a boto exception, None if unknown"""
+    return getattr(error, "error_code", None) or getattr(error, "code", None)
+
+def body_error_code(body):
+    """AWS error code in the XML body of an error response, None if unknown"""
+    matched = _RE_CODE.search(body or "")
+    return matched.group(1) if matched else None
+
+def is_throttling(error):
+    return error_code(error) in THROTTLING_CODES
+
+class ApiMetrics(object):
+    """Thread-safe counters of API calls"""
+
+    FIELDS = ("calls", "errors", "throttled", "retries", "seconds", "max_seconds")
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, side, service, region, action, seconds, retries = 0, error = None):
+        """Count one API call; `error` is an exception or error code, if it failed"""
+
+        key = (side, service, region, action)
+        code = error if isinstance(error, basestring) else error_code(error)
+        throttled = error is not None and code in THROTTLING_CODES
+
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = [0, 0, 0, 0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += error is not None
+            stats[2] += throttled
+            stats[3] += retries
+            stats[4] += seconds
+            stats[5] = max(stats[5], seconds)
+
+    def rows(self):
+        """[{side, service, region, action, calls, errors, ...}], sorted by key"""
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._stats.items())
+
+        return [dict(zip(("side", "service", "region", "action") + self.FIELDS, key + tuple(stats)))
+            for key, stats in items]
+
+    def totals(self):
+        """Sums over all rows, {calls, errors, throttled, retries, seconds}"""
+        totals = dict.fromkeys(self.FIELDS[:-1], 0)
+        for row in self.rows():
+            for field in totals:
+                totals[field] += row[field]
+        return totals
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+api_metrics = ApiMetrics()
+
+def show_api_metrics(metrics = api_metrics):
+    """Print metrics as a table, if any call was made"""
+
+    rows = metrics.rows()
+    if not rows:
+        return False
+
+    show.heading("AWS API calls")
+    show.unless_quiet("%-7s %-15s %-15s %-32s" % ("side", "service", "region", "action"),
+        "%6s %6s %6s %6s %9s" % ("calls", "errors", "thrtl", "retry", "seconds"))
+
+    for row in rows:
+        (show.error if row["throttled"] else show.unless_quiet)(
+            "%-7s %-15s %-15s %-32s" % (row["side"] or "-", row["service"], row["region"], row["action"]),
+            "%6d %6d %6d %6d %9.3f" % tuple(row[f] for f in ApiMetrics.FIELDS[:-1]))
+
+    totals = metrics.totals()
+    show.output("Total", "%d calls, %d errors, %d throttled, %d retries, %.3fs" % tuple(
+        totals[f] for f in ApiMetrics.FIELDS[:-1]))
+
+    return True
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Active/standby health monitor, run on both client VPN instances of a tunnel
+
+With `ha`, every tunnel has a standby pair of VPN instances, and client
+routes point to the client instance of one pair, the active one. Both client
+instances run this file as /opt/instavpn/monitor.py, with nothing but Python
+and boto, and check every `interval` seconds:
+
+* the active one, itself: its IPsec SA is established, and its server peer
+  answers ping through the tunnel;
+* the standby one, the active one: it answers ping.
+
+After `threshold` failed checks in a row, routes to the active instance are
+replaced with routes to the other one, provided that one is fit to take over:
+reachable from the active one, healthy itself from the standby one. Each
+failover is logged with its latency, from the last passed check to the last
+route replaced.
+
+Either monitor may move routes, so each one reads which instance is active
+every `refresh` checks and at the start of each failure streak.
+
+post_conf tags each client instance with `instavpn:monitor`, "<other client
+instance ID> <private IP of its server peer>"; the monitor waits for it.
+cfn-init runs it as the instavpn-monitor service, which respawns it should
+it exit.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+TAG = "instavpn:monitor"
+
+class HealthMonitor(object):
+    """Fails routes over between client instances `me` and `other`
+
+    * routes: Routes, or anything with target(me, other) and move(src, dst)
+    * healthy(): whether `me` carries traffic, ie., SA up and peer ping
+    * alive(): whether `other` answers ping
+    * refresh: checks between reading which instance routes point to
+    * clock, sleep, log: injectable for tests and benchmarks
+    """
+
+    def __init__(self, me, other, routes, healthy, alive, threshold = 3, interval = 1.0,
+            refresh = 10, clock = time.time, sleep = time.sleep, log = None):
+        self.me, self.other = me, other
+        self.routes = routes
+        self.healthy, self.alive = healthy, alive
+        self.threshold, self.interval, self.refresh = threshold, interval, refresh
+        self.clock, self.sleep = clock, sleep
+        self.log = log or (lambda msg: None)
+
+        self.active = None
+        self.checks = 0
+        self.failures = 0
+        self.last_ok = None
+        self.failovers = []
+
+    def check(self):
+        """One check; returns the failover if routes were moved, else None"""
+
+        if self.active is None or 0 == self.checks % self.refresh:
+            self._read_active()
+        self.checks += 1
+
+        now = self.clock()
+        if self.last_ok is None:
+            self.last_ok = now
+
+        # The other monitor may have moved routes since they were last read
+        if self._passes() or (0 == self.failures and self._read_active() and self._passes()):
+            self.failures, self.last_ok = 0, now
+            return None
+
+        self.failures += 1
+        self.log("%s failed %d of %d checks" % (self.active, self.failures, self.threshold))
+        if self.failures < self.threshold:
+            return None
+
+        # Never fail over to an instance that can't carry traffic either
+        target = self.other if self.me == self.active else self.me
+        if not (self.alive() if self.other == target else self.healthy()):
+            self.log("%s is unfit to take over, routes left to %s" % (target, self.active))
+            return None
+
+        moved = self.routes.move(self.active, target)
+        done = self.clock()
+
+        failover = {"at": done, "from": self.active, "to": target, "routes": moved,
+            "latency": done - self.last_ok}
+        self.failovers.append(failover)
+        self.log("Failed over from %(from)s to %(to)s, %(routes)d routes in %(latency).1fs" % failover)
+
+        self.active, self.failures, self.last_ok = target, 0, done
+        return failover
+
+    def _passes(self):
+        return self.healthy() if self.me == self.active else self.alive()
+
+    def _read_active(self):
+        """Reads which instance is active, returns whether that changed"""
+
+        active = self.routes.target(self.me, self.other)
+        if active == self.active:
+            return False
+
+        self.log("%s is active" % active)
+        self.active, self.failures = active, 0
+        return True
+
+    def run(self, checks = None):
+        """Check every `interval` seconds, `checks` times or forever"""
+
+        done = 0
+        while checks is None or done < checks:
+            started = self.clock()
+            try:
+                self.check()
+            except Exception as e:
+                self.log("Check failed: %s" % e)
+            done += 1
+            self.sleep(max(0, self.interval - (self.clock() - started)))
+
+class Routes(object):
+    """Client routes to either client instance, through a boto VPC connection"""
+
+    def __init__(self, conn_vpc):
+        self.conn_vpc = conn_vpc
+
+    def target(self, me, other):
+        """The instance routes point to: `me` if any route does, else `other`"""
+        return me if self._tables(me) else other
+
+    def move(self, src, dst):
+        """Replaces every route to `src` with one to `dst`, returns #routes"""
+
+        moved = 0
+        for rtb in self._tables(src):
+            for route in rtb.routes:
+                if src == route.instance_id:
+                    self.conn_vpc.replace_route(rtb.id, route.destination_cidr_block, instance_id = dst)
+                    moved += 1
+        return moved
+
+    def _tables(self, instance_id):
+        return self.conn_vpc.get_all_route_tables(filters = {"route.instance-id": instance_id})
+
+def ping(ip, timeout = 1):
+    """Whether `ip` answers a single ping within `timeout` seconds"""
+    with open(os.devnull, "w") as devnull:
+        return 0 == subprocess.call(["ping", "-c", "1", "-W", str(timeout), ip],
+            stdout = devnull, stderr = devnull)
+
+def sa_established(status = None):
+    """Whether `ipsec status`, or `status` as its output, shows an IPsec SA"""
+    if status is None:
+        status = subprocess.Popen(["ipsec", "status"], stdout = subprocess.PIPE,
+            stderr = subprocess.STDOUT).communicate()[0]
+    return "IPsec SA established" in status
+
+def wait_for_peers(conn_vpc, me, interval = 10, sleep = time.sleep, log = None):
+    """(other instance ID, server peer IP, other instance IP), once `me` is
+    tagged; errors reading them are logged and retried every `interval`"""
+
+    log = log or (lambda msg: None)
+    while True:
+        try:
+            tags = conn_vpc.get_all_tags(filters = {"resource-id": me, "key": TAG})
+            if tags:
+                other, peer_ip = tags[0].value.split()
+                other_ip = conn_vpc.get_all_instances(instance_ids = [other])[0].instances[0].private_ip_address
+                return other, peer_ip, other_ip
+            log("Waiting for tag %s" % TAG)
+        except Exception as e:
+            log("Can't read tag %s: %s" % (TAG, e))
+        sleep(interval)
+
+def main(argv):
+    """monitor.py --region=REGION, on a client VPN instance"""
+
+    from optparse import OptionParser
+    import boto.utils
+    import boto.vpc
+
+    parser = OptionParser(usage = "%prog --region=REGION [--interval=S] [--threshold=N]")
+    parser.add_option("--region")
+    parser.add_option("--interval", type = "float", default = 1.0)
+    parser.add_option("--threshold", type = "int", default = 3)
+    options, _ = parser.parse_args(argv)
+
+    me = boto.utils.get_instance_metadata()["instance-id"]
+    conn_vpc = boto.vpc.connect_to_region(options.region)
+
+    other, peer_ip, other_ip = wait_for_peers(conn_vpc, me, log = _log)
+    _log("Monitoring %s, peer %s, other instance %s (%s)" % (me, peer_ip, other, other_ip))
+
+    HealthMonitor(me, other, Routes(conn_vpc),
+        healthy = lambda: sa_established() and ping(peer_ip),
+        alive = lambda: ping(other_ip),
+        threshold = options.threshold, interval = options.interval,
+        log = _log).run()
+
+def _log(msg):
+    sys.stdout.write("%s %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), msg))
+    sys.stdout.flush()
+
+if "__main__" == __name__:
+    main(sys.argv[1:])
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal thread helpers
+
+Tasks touching both sides of a VPN usually spend their time waiting on AWS,
+so plain threads are good enough. Exceptions raised in a task are re-raised
+in the calling thread once every task has finished, with the traceback of
+the thread they were raised in.
+"""
+
+import sys
+import threading
+
+def run_parallel(tasks):
+    """Run `tasks`, a dict of {key: callable}, concurrently
+
+    Returns {key: result}. If any of the tasks fails, the first exception (in
+    key order) is re-raised after all tasks have finished.
+    """
+
+    results, errors = {}, {}
+
+    def _run(key, fn):
+        try:
+            results[key] = fn()
+        except BaseException:
+            errors[key] = sys.exc_info()
+
+    if len(tasks) <= 1:
+        for key, fn in tasks.items():
+            results[key] = fn()
+        return results
+
+    threads = []
+    for key, fn in sorted(tasks.items()):
+        t = threading.Thread(target=_run, args=(key, fn), name="instavpn-%s" % key)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    for t in threads:
+        # join() with timeout keeps the main thread responsive to Ctrl-C
+        while t.is_alive():
+            t.join(0.2)
+
+    for key in sorted(errors):
+        exc_type, exc_value, exc_tb = errors[key]
+        raise exc_type, exc_value, exc_tb
+
+    return results
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Session-scoped snapshot of AWS network resources
+
+One SideResources per side lives in session["cache"]. Each resource type is
+fetched with a single filtered describe call, on first use or by prefetch(),
+and kept until invalidate() is called after a mutation.
+"""
+
+import threading
+
+from .parallel import run_parallel
+
+class SideResources(object):
+    """Subnet, VPC, route tables and internet gateways of one side"""
+
+    _fetchers = {
+        "subnet": lambda self: self.conn("vpc").get_all_subnets([self.subnet_id])[0],
+        "vpc": lambda self: self.conn("vpc").get_all_vpcs([self.subnet.vpc_id])[0],
+        "route_tables": lambda self: self.conn("vpc").get_all_route_tables(
+            filters = {"vpc-id": self.subnet.vpc_id}),
+        "igws": lambda self: self.conn("vpc").get_all_internet_gateways(
+            filters = {"attachment.vpc-id": self.subnet.vpc_id}),
+    }
+
+    def __init__(self, conn, subnet_id):
+        self.conn = conn
+        self.subnet_id = subnet_id
+
+        self._values = {}
+        self._locks = dict((name, threading.Lock()) for name in self._fetchers)
+
+    def __getattr__(self, name):
+        if name not in self._fetchers:
+            raise AttributeError(name)
+        return self._get(name)
+
+    def _get(self, name):
+        if name in self._values:
+            return self._values[name]
+
+        with self._locks[name]:
+            if name not in self._values:
+                self._values[name] = self._fetchers[name](self)
+            return self._values[name]
+
+    def prefetch(self, names = ("vpc", "route_tables", "igws")):
+        """Fetch `names` concurrently, after the subnet they depend on"""
+        self._get("subnet")
+        run_parallel(dict((name, (lambda name=name: self._get(name))) for name in names))
+        return self
+
+    def invalidate(self, *names):
+        """Forget `names`, or everything, after resources were mutated"""
+        for name in names or list(self._values):
+            self._values.pop(name, None)
+
+    def route_table(self, rtb_id):
+        """Route table by ID; looked up outside of the VPC if it's not in there"""
+        for rtb in self.route_tables:
+            if rtb.id == rtb_id:
+                return rtb
+
+        return self.conn("vpc").get_all_route_tables([rtb_id])[0]
+
+def build_cache(session):
+    """Creates session["cache"], one SideResources per side"""
+
+    session["cache"] = dict(
+        (side, SideResources(session["conn"][side], session["config"][side]["res"]["subnet_id"]))
+        for side in ("server", "client"))
+
+    return session["cache"]
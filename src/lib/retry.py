@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Retries and client-side rate limiting of AWS calls
+
+Every connection handed out by AWSConn draws a token from the bucket of its
+(account, region) before each request, so concurrent deployments share one
+request rate per account and region. Throttling halves the rate of that
+bucket, which then grows back with every successful request.
+
+Requests failing with a retryable error code are re-issued after a jittered
+exponential backoff ("full jitter": uniform in [0, min(cap, base * 2^n)]).
+Throttled requests were never processed, so any of them is retried; other
+server errors only for idempotent requests, see idempotent().
+"""
+
+import random
+import threading
+import time
+from itertools import count
+
+from .metrics import THROTTLING_CODES, error_code
+
+RETRYABLE_CODES = THROTTLING_CODES | frozenset([
+    "InternalError", "InternalFailure", "ServiceUnavailable", "Unavailable",
+    "RequestTimeout", "RequestTimeoutException"])
+
+# Actions that read, and parameters that make a write idempotent
+IDEMPOTENT_PREFIXES = ("Describe", "Get", "List")
+CLIENT_TOKENS = ("ClientToken", "ClientRequestToken")
+
+# Requests per second, and burst, per (account, region)
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 20
+
+class TokenBucket(object):
+    """Thread-safe token bucket; callers beyond the burst wait their turn"""
+
+    def __init__(self, rate = DEFAULT_RATE, burst = DEFAULT_BURST,
+            clock = time.time, sleep = time.sleep):
+        self.max_rate = self.rate = float(rate)
+        self.burst = burst
+        self.min_rate = self.rate / 16
+        self.clock, self.sleep = clock, sleep
+
+        self.tokens = float(burst)
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting if needed; returns seconds waited"""
+
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Going below zero reserves a slot, so waiters are served in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def throttled(self):
+        """AWS throttled a request: halve the rate"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        """Grow the rate back, additively"""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def bucket(account, region):
+    """The TokenBucket shared by every caller of (account, region)"""
+
+    key = (account, region)
+    if key not in _buckets:
+        with _buckets_lock:
+            _buckets.setdefault(key, TokenBucket())
+    return _buckets[key]
+
+class RetryPolicy(object):
+    """Which errors to retry, how often, and how long to back off"""
+
+    def __init__(self, max_attempts = 6, base = 0.5, cap = 20,
+            sleep = time.sleep, rand = random.random):
+        self.max_attempts = max_attempts
+        self.base, self.cap = base, cap
+        self.sleep, self.rand = sleep, rand
+
+    def retryable(self, code, idempotent = True):
+        """Whether to retry `code`; server errors only if the request is idempotent"""
+        return code in THROTTLING_CODES or (idempotent and code in RETRYABLE_CODES)
+
+    def delay(self, attempt):
+        """Backoff after the `attempt`-th failure, counting from 1"""
+        return self.rand() * min(self.cap, self.base * 2 ** (attempt - 1))
+
+    def call(self, fn, retry_on = None):
+        """fn(), retried on retryable errors, or errors `retry_on(e)` accepts"""
+
+        for attempt in count(1):
+            try:
+                return fn()
+            except Exception as e:
+                if attempt >= self.max_attempts or not (
+                        self.retryable(error_code(e)) or (retry_on and retry_on(e))):
+                    raise
+            self.sleep(self.delay(attempt))
+
+default_policy = RetryPolicy()
+
+def idempotent(action, params = None):
+    """Whether re-issuing `action` with `params`, the query parameters, can't
+    change anything twice: a read, or a write carrying a client token"""
+    return action.startswith(IDEMPOTENT_PREFIXES) or \
+        (isinstance(params, dict) and any(token in params for token in CLIENT_TOKENS))
+
+def retry(fn, retry_on = None):
+    """fn() with the default policy"""
+    return default_policy.call(fn, retry_on)
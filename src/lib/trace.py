@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Tracing of config checks, actuator phases and AWS calls
+
+Spans are recorded once enable() is called, and exported either as Chrome
+trace events (chrome://tracing, Perfetto) or as a flat summary per span
+name. While disabled, span() returns a shared no-op context manager and
+@traced functions are called straight away, so instrumented code only pays
+for a flag check.
+"""
+
+import functools
+import json
+import threading
+import time
+
+FORMATS = ("chrome", "summary")
+
+_enabled = False
+_epoch = 0.0
+_events = [] # [(name, cat, started, seconds, thread name, args)]
+
+class _Span(object):
+    __slots__ = ("name", "cat", "args", "started")
+
+    def __init__(self, name, cat, args):
+        self.name, self.cat, self.args = name, cat, args
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.time() - self.started
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+
+        # list.append is atomic, no lock needed across threads
+        _events.append((self.name, self.cat, self.started, seconds,
+            threading.current_thread().name, self.args))
+        return False
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(name, cat = "instavpn", **args):
+    """Context manager timing the enclosed block as `name`"""
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(name, cat, args)
+
+def traced(cat):
+    """Decorator timing every call of a function, as its name"""
+    def _decorate(fn):
+        @functools.wraps(fn)
+        def _traced(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Span(fn.__name__, cat, {}):
+                return fn(*args, **kwargs)
+        return _traced
+    return _decorate
+
+def enable():
+    """Start recording, dropping earlier spans"""
+    global _enabled, _epoch
+    del _events[:]
+    _epoch, _enabled = time.time(), True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def chrome_trace():
+    """Recorded spans as Chrome trace-event JSON object"""
+
+    tids, events = {}, []
+    for name, cat, started, seconds, thread, args in sorted(_events, key = lambda e: e[2]):
+        if thread not in tids:
+            tids[thread] = len(tids) + 1
+            events.append({"ph": "M", "name": "thread_name", "pid": 1, "tid": tids[thread],
+                "args": {"name": thread}})
+
+        events.append({"ph": "X", "name": name, "cat": cat, "pid": 1, "tid": tids[thread],
+            "ts": int((started - _epoch) * 1e6), "dur": int(seconds * 1e6), "args": args})
+
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+def summary():
+    """{"seconds": since enable(), "spans": [{name, cat, count, total, max}]}
+
+    Spans are ordered by total time, descending.
+    """
+
+    spans = {}
+    for name, cat, started, seconds, thread, args in list(_events):
+        entry = spans.setdefault((cat, name), {"name": name, "cat": cat,
+            "count": 0, "total": 0.0, "max": 0.0})
+        entry["count"] += 1
+        entry["total"] += seconds
+        entry["max"] = max(entry["max"], seconds)
+
+    return {"seconds": time.time() - _epoch,
+        "spans": sorted(spans.values(), key = lambda e: -e["total"])}
+
+def export(filename, fmt = "chrome"):
+    """Write recorded spans to `filename` in one of FORMATS"""
+    with open(filename, "w") as fp:
+        json.dump(chrome_trace() if "chrome" == fmt else summary(), fp, indent = 1)
+    return filename
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Horizontal scaling: `tunnels` pairs of VPN instances in one deployment
+
+Server destinations are sharded across tunnels. Every prefix of
+server.ipsec.subnets is carried by exactly one tunnel, whose instances it is
+routed to from the client side; servers_allowed go to the SG of the tunnel
+whose prefixes cover them. Every tunnel carries all client subnets.
+
+Prefixes weigh their size, or server.ipsec.weights ({cidr: weight}, 1 for
+the ones left out) if any weights are declared. While there are fewer
+prefixes than tunnels, the heaviest one is split in halves, each with half
+its weight. Prefixes are then placed heaviest first on the least loaded
+tunnel, which is within 4/3 of the best possible balance.
+"""
+
+from .cidr import cidr_range, cidr_prefix, split_cidr, CidrIndex
+
+def tunnel_count(config):
+    """Tunnels of a config, 1 unless set"""
+    return int(config.get("tunnels") or 1)
+
+def shard(cidrs, tunnels, weights = None):
+    """[[cidr]] of each of `tunnels`, none of them empty
+
+    Raises ValueError if there are too few addresses to go around.
+    """
+
+    items = [(_weight(cidr, weights), cidr) for cidr in cidrs]
+
+    while len(items) < tunnels:
+        splittable = [item for item in items if cidr_prefix(item[1]) < 32]
+        if not splittable:
+            raise ValueError("Can't shard %s across %d tunnels" % (" ".join(cidrs), tunnels))
+
+        heaviest = max(splittable, key = lambda item: (item[0], -cidr_range(item[1])[0]))
+        items.remove(heaviest)
+        items += [(heaviest[0] / 2, half) for half in split_cidr(heaviest[1])]
+
+    shards, loads = [[] for _ in range(tunnels)], [0.0] * tunnels
+    for weight, cidr in sorted(items, key = lambda item: (-item[0], cidr_range(item[1])[0])):
+        idx = min(range(tunnels), key = lambda k: (loads[k], k))
+        shards[idx].append(cidr)
+        loads[idx] += weight
+
+    return [sorted(cidrs, key = lambda cidr: cidr_range(cidr)[0]) for cidrs in shards]
+
+def shard_config(config):
+    """[{"cidrs": [cidr], "servers_allowed": [dest]}] of each tunnel of `config`"""
+
+    server = config["server"]
+    shards = shard(server["ipsec"]["subnets"], tunnel_count(config), server["ipsec"].get("weights"))
+
+    owner = dict((cidr, idx) for idx, cidrs in enumerate(shards) for cidr in cidrs)
+    index = CidrIndex(owner)
+
+    servers = [[] for _ in shards]
+    for dest in server["res"]["servers_allowed"]:
+        cidr = index.covering(dest["ip"])
+        if cidr is None:
+            raise ValueError("Server %s not in server.ipsec.subnets" % dest["ip"])
+        servers[owner[cidr]].append(dest)
+
+    return [{"cidrs": cidrs, "servers_allowed": dests} for cidrs, dests in zip(shards, servers)]
+
+def _weight(cidr, weights):
+    if weights:
+        return float(weights.get(cidr, 1))
+    start, end = cidr_range(cidr)
+    return float(end - start + 1)
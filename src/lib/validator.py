@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Offline config validator, for configs kept in git and checked in CI
+
+Checks configs without connecting to AWS: structure against
+conf/default_config.json, fields against the formats asked by the
+interactive UI, and the CIDR rules that don't need AWS resources. Every
+error of a config is reported, instead of stopping at the first one.
+
+Server reachability is only a warning offline, as rule_40_extend_subnet_cidr
+later adds the server subnet CIDR fetched from AWS.
+"""
+
+import json
+import os
+import re
+import sys
+from multiprocessing import Pool, cpu_count
+
+from .io import load_config, load_tpl
+from .cidr import ip_to_int, cidr_range, find_conflicts, CidrIndex
+from .config import (RE_CLIENT_NAME, RE_SERVER, RE_ROLE_ARN, RE_SUBNET_ID, RE_CIDR,
+    RE_ROUTE_TABLE_ID)
+
+SIDES = ("server", "client")
+
+def validate_config(config):
+    """Returns (errors, warnings) of a parsed config, as lists of strings"""
+
+    if not isinstance(config, dict):
+        return ["config should be a dict"], []
+
+    errors, warnings, broken = [], [], []
+
+    for path, types in _schema():
+        if any(path[:len(b)] == b for b in broken):
+            continue # Reported on its parent
+
+        value = _get(config, path)
+        if value is _MISSING:
+            errors.append("%s: missing" % ".".join(path))
+        elif not isinstance(value, types):
+            errors.append("%s: should be %s" % (".".join(path), " or ".join(
+                "null" if type(None) is t else t.__name__ for t in types)))
+        else:
+            continue
+        broken.append(path)
+
+    for path, match, optional in _fields():
+        value = _get(config, path)
+        if value is _MISSING or not isinstance(value, (basestring, type(None))):
+            continue # Reported by schema
+        if value is None or "" == value:
+            if not optional:
+                errors.append("%s: required" % ".".join(path))
+        elif not match(value):
+            errors.append("%s: invalid value %s" % (".".join(path), value))
+
+    for name in ("InstanceType", "TunnelProfile"):
+        value = _get(config, ("params", name))
+        if value not in (None, _MISSING) and value not in _allowed_values(name):
+            errors.append("params.%s: invalid value %s" % (name, value))
+
+    tunnels = config.get("tunnels")
+    if tunnels is not None and (isinstance(tunnels, bool) or not isinstance(tunnels, int) or tunnels < 1):
+        errors.append("tunnels: should be a positive integer")
+
+    if config.get("ha") not in (None, True, False):
+        errors.append("ha: should be true or false")
+
+    weights = _get(config, ("server", "ipsec", "weights"))
+    if weights is not _MISSING and not (isinstance(weights, dict) and all(
+            isinstance(w, (int, float)) and not isinstance(w, bool) and w > 0 for w in weights.values())):
+        errors.append("server.ipsec.weights: should map CIDRs to positive numbers")
+
+    servers = _get(config, ("server", "res", "servers_allowed"))
+    if isinstance(servers, list):
+        errors += _check_servers(servers)
+
+    subnets = {}
+    for side in SIDES:
+        cidrs = _get(config, (side, "ipsec", "subnets"))
+        if isinstance(cidrs, list):
+            subnets[side], side_errors = _check_cidrs("%s.ipsec.subnets" % side, cidrs)
+            errors += side_errors
+
+    if 2 == len(subnets):
+        conflicts = find_conflicts(subnets["client"] + subnets["server"])
+        if conflicts:
+            errors.append("Conflict between subnet %s" % ", ".join(
+                "(%s, %s)" % pair for pair in conflicts))
+
+    if "server" in subnets and isinstance(servers, list):
+        index = CidrIndex(subnets["server"])
+        unreachable = [server["ip"] for server in servers if isinstance(server, dict)
+            and _valid_ip(server.get("ip")) and index.covering(server["ip"]) is None]
+        if unreachable:
+            warnings.append("Server %s not in server.ipsec.subnets, unless in the server subnet" %
+                ", ".join(unreachable))
+
+    return errors, warnings
+
+def validate_paths(paths, jobs = None):
+    """Validates configs under `paths`, returns [(name, errors, warnings)]
+
+    A path is a json config, a directory searched for *.json, a .ndjson or
+    .jsonl file with one config per line, or `-` for NDJSON on stdin.
+    Configs are validated in `jobs` processes, one per core by default.
+    """
+
+    sources = list(_sources(paths))
+    jobs = min(jobs or cpu_count(), len(sources))
+
+    if jobs <= 1:
+        return map(_validate_source, sources)
+
+    pool = Pool(jobs)
+    try:
+        return pool.map(_validate_source, sources, chunksize = max(1, len(sources) / (jobs * 4)))
+    finally:
+        pool.terminate()
+
+#
+# Internal functions
+#
+
+_MISSING = object()
+
+__compiled = {}
+
+def _compiled(name, build):
+    """Build once per process"""
+    if name not in __compiled:
+        __compiled[name] = build()
+    return __compiled[name]
+
+def _schema():
+    """[(path, accepted types)] of conf/default_config.json
+
+    Empty dicts, eg., tags, are free-form; null defaults accept strings.
+    """
+
+    def _walk(node, path):
+        if isinstance(node, dict):
+            yield path, (dict,)
+            if node:
+                for k, v in sorted(node.items()):
+                    for entry in _walk(v, path + (k,)):
+                        yield entry
+        elif isinstance(node, list):
+            yield path, (list,)
+        elif isinstance(node, bool):
+            yield path, (bool,)
+        else:
+            yield path, (basestring, type(None))
+
+    return _compiled("schema",
+        lambda: [entry for entry in _walk(load_config("default_config.json"), ()) if entry[0]])
+
+def _fields():
+    """[(path, match, optional)], with formats of the interactive UI"""
+
+    def _build():
+        m = lambda pattern: re.compile(r"^\s*%s\s*$" % pattern).match
+
+        fields = [(("client", "name"), m(RE_CLIENT_NAME), False),
+            (("client", "res", "route_table_id"), m(RE_ROUTE_TABLE_ID), True)]
+        for side in SIDES:
+            fields += [((side, "res", "subnet_id"), m(RE_SUBNET_ID), False),
+                ((side, "identity", "role_arn"), m(RE_ROLE_ARN), True)]
+        return fields
+
+    return _compiled("fields", _build)
+
+def _allowed_values(name):
+    """AllowedValues of main.json parameter `name`"""
+    return _compiled("allowed_values", lambda: dict((k, set(v["AllowedValues"]))
+        for k, v in load_tpl("main.json")["Parameters"].items() if "AllowedValues" in v))[name]
+
+def _get(config, path):
+    for key in path:
+        if not isinstance(config, dict) or key not in config:
+            return _MISSING
+        config = config[key]
+    return config
+
+def _valid_ip(ip):
+    try:
+        ip_to_int(ip)
+        return 4 == len(ip.split("."))
+    except (AttributeError, ValueError):
+        return False
+
+def _check_servers(servers):
+    match = _compiled("server", lambda: re.compile(r"^\s*%s\s*$" % RE_SERVER).match)
+    errors = []
+
+    for idx, server in enumerate(servers):
+        prefix = "server.res.servers_allowed[%d]" % idx
+        if not isinstance(server, dict) or set(server) != set(["proto", "ip", "port"]):
+            errors.append("%s: should be {proto, ip, port}" % prefix)
+            continue
+
+        proto, ip, port = server["proto"], server["ip"], "%s" % server["port"]
+        if proto not in ("tcp", "udp", "all"):
+            errors.append("%s: invalid proto %s" % (prefix, proto))
+        if not _valid_ip(ip) or not match(ip):
+            errors.append("%s: invalid ip %s" % (prefix, ip))
+        if "all" != port and not (port.isdigit() and int(port) <= 65535):
+            errors.append("%s: invalid port %s" % (prefix, port))
+        if "all" == proto and "all" != port:
+            errors.append("%s: port must be `all` if proto = `all`" % prefix)
+
+    return errors
+
+def _check_cidrs(path, cidrs):
+    """Returns (valid cidrs, errors)"""
+    match = _compiled("cidr", lambda: re.compile(r"^\s*%s\s*$" % RE_CIDR).match)
+    valid, errors = [], []
+
+    for cidr in cidrs:
+        try:
+            if not match(cidr):
+                raise ValueError(cidr)
+            cidr_range(cidr)
+            valid.append(cidr)
+        except (TypeError, ValueError):
+            errors.append("%s: invalid CIDR %s" % (path, cidr))
+
+    return valid, errors
+
+def _sources(paths):
+    """(name, json text) of every config under `paths`"""
+
+    def _lines(name, fp):
+        for lineno, line in enumerate(fp, 1):
+            if line.strip():
+                yield "%s:%d" % (name, lineno), line
+
+    for path in paths:
+        if "-" == path:
+            for source in _lines("<stdin>", sys.stdin):
+                yield source
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    if filename.endswith(".json"):
+                        with open(os.path.join(root, filename)) as fp:
+                            yield os.path.join(root, filename), fp.read()
+        elif path.endswith((".ndjson", ".jsonl")):
+            with open(path) as fp:
+                for source in _lines(path, fp):
+                    yield source
+        else:
+            with open(path) as fp:
+                yield path, fp.read()
+
+def _validate_source(source):
+    name, text = source
+    try:
+        config = json.loads(text)
+    except ValueError as e:
+        return name, ["invalid json: %s" % e], []
+
+    return (name,) + validate_config(config)
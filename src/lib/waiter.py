@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+CloudFormation stack waiter
+
+Tails `describe_stack_events` from the last seen event, instead of polling
+the whole stack at a fixed interval. Polling backs off while nothing happens
+(eg., waiting for WaitConditions), and snaps back to `min_interval` as soon
+as new events show up, since the stack usually completes right after its
+last resource does.
+"""
+
+import time
+
+from .metrics import error_code
+
+STATE_OK = ('CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS')
+STATE_FAILED = ('CREATE_FAILED', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE',
+    'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED', 'UPDATE_ROLLBACK_COMPLETE',
+    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'DELETE_IN_PROGRESS', 'DELETE_COMPLETE')
+STATE_UPDATABLE = ('CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE')
+
+def stack_missing(e):
+    """Whether CloudFormation raised `e` as the stack doesn't exist (anymore)"""
+    return "ValidationError" == error_code(e) and "does not exist" in (getattr(e, "message", None) or "")
+
+class StackWaiter(object):
+    """Waits for a single stack to reach a terminal state
+
+    * on_event: called with every new StackEvent, oldest first
+    * timeout: seconds wait() gives the stack before raising
+    * sleep, clock: injectable for tests and benchmarks
+    """
+
+    def __init__(self, conn_cfn, stack_name, on_event=None,
+            min_interval=2, max_interval=10, backoff=2, timeout=3600,
+            sleep=time.sleep, clock=time.time):
+        self.conn_cfn = conn_cfn
+        self.stack_name = stack_name
+        self.on_event = on_event
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.sleep = sleep
+        self.clock = clock
+
+        self.last_event_id = None
+        self.api_calls = 0
+
+    def mark(self):
+        """Skip events emitted so far, eg., before calling update_stack"""
+        events = self._describe()
+        if events:
+            self.last_event_id = events[0].event_id
+        return self
+
+    def wait(self):
+        """Blocks until the stack is done; returns the final stack status
+
+        Raises Exception if the stack failed or is being rolled back, or is
+        still in progress after `timeout` seconds.
+        """
+        return self._wait(STATE_OK, STATE_FAILED)
+
+    def wait_deleted(self):
+        """Blocks until the stack is deleted, eg., after stack.delete()
+
+        Returns DELETE_COMPLETE, also once the stack no longer exists by its
+        name. Raises Exception if the deletion failed, or is still in
+        progress after `timeout` seconds.
+        """
+        return self._wait(('DELETE_COMPLETE', ), ('DELETE_FAILED', ), gone = 'DELETE_COMPLETE')
+
+    def _wait(self, ok, failed, gone = None):
+        interval = self.min_interval
+        deadline = self.clock() + self.timeout
+
+        while True:
+            try:
+                events = self._new_events()
+            except Exception as e:
+                if gone is None or not stack_missing(e):
+                    raise
+                return gone
+
+            for event in events:
+                if self.on_event:
+                    self.on_event(event)
+
+                if not self._is_stack_event(event):
+                    continue
+
+                if event.resource_status in ok:
+                    return event.resource_status
+
+                if event.resource_status in failed:
+                    raise Exception("Stack (%s) failed with %s, may require manual cleanup." % (
+                        self.stack_name, event.resource_status))
+
+            if events:
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+
+            if self.clock() >= deadline:
+                raise Exception("Stack (%s) still in progress after %ds, may require manual cleanup." % (
+                    self.stack_name, self.timeout))
+
+            self.sleep(min(interval, max(0, deadline - self.clock())))
+
+    def _is_stack_event(self, event):
+        return "AWS::CloudFormation::Stack" == event.resource_type and \
+            event.logical_resource_id == event.stack_name
+
+    def _describe(self, next_token=None):
+        self.api_calls += 1
+        return self.conn_cfn.describe_stack_events(self.stack_name, next_token)
+
+    def _new_events(self):
+        """Events after `last_event_id`, oldest first
+
+        Pages are fetched (newest first) until the last seen event shows up.
+        """
+
+        new, next_token = [], None
+
+        while True:
+            page = self._describe(next_token)
+
+            for event in page:
+                if event.event_id == self.last_event_id:
+                    break
+                new.append(event)
+            else:
+                next_token = getattr(page, "next_token", None)
+                if next_token:
+                    continue
+            break
+
+        if new:
+            self.last_event_id = new[0].event_id
+
+        new.reverse()
+        return new
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the offline checker rules. Run from src/:
+
+    python ../test/bench_checker.py
+"""
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from iptools import IpRange
+
+from lib.cidr import find_conflicts, CidrIndex
+
+# Legacy implementations can't finish large inputs in reasonable time; their
+# timing is extrapolated from the largest size measured.
+LEGACY_MAX = 1000
+
+def prefixes(n):
+    """n non-overlapping /28s, the worst case for the legacy loop"""
+    return ["10.%d.%d.%d/28" % (i >> 12 & 0xff, i >> 4 & 0xff, (i & 0xf) << 4) for i in range(n)]
+
+def legacy_cidr_overlaps(cidr1, cidr2):
+    ir1, ir2 = IpRange(cidr1), IpRange(cidr2)
+
+    if ir1.startIp < ir2.startIp:
+        if ir1.endIp < ir2.startIp:
+            return False
+    elif ir1.startIp > ir2.endIp:
+        return False
+
+    return True
+
+def legacy_subnet_cidr_conflict(cidrs):
+    pool = []
+    for cidr in cidrs:
+        for against in pool:
+            if legacy_cidr_overlaps(cidr, against):
+                return [(cidr, against)]
+        pool.append(cidr)
+    return []
+
+def legacy_all_server_routable(subnets, servers):
+    subnets = [IpRange(sn) for sn in subnets]
+    unreachable = []
+    for server in servers:
+        for subnet in subnets:
+            if server in subnet:
+                break
+        else:
+            unreachable.append(server)
+    return unreachable
+
+def all_server_routable(subnets, servers):
+    index = CidrIndex(subnets)
+    return [server for server in servers if index.covering(server) is None]
+
+def servers(n, subnets):
+    """n IPs, spread over the subnets from the last one, plus one unreachable"""
+    return ["%s%d" % (subnets[-1 - i % len(subnets)].rsplit(".", 1)[0] + ".", 1 + i % 14)
+        for i in range(n - 1)] + ["192.168.0.1"]
+
+def timed(fn, *args):
+    started = time.time()
+    fn(*args)
+    return time.time() - started
+
+def bench(title, legacy, current, inputs, complexity):
+    print(title)
+    print("%10s %14s %14s" % ("n", "legacy (s)", "current (s)"))
+
+    measured = None
+    for n, args in inputs:
+        if n <= LEGACY_MAX:
+            legacy_s = timed(legacy, *args)
+            measured = (n, legacy_s)
+            legacy_str = "%14.4f" % legacy_s
+        else:
+            legacy_str = "%13.1f~" % (measured[1] * complexity(n) / complexity(measured[0]))
+
+        print("%10d %s %14.4f" % (n, legacy_str, timed(current, *args)))
+    print("")
+
+def main():
+    sizes = (10, 1000, 100000)
+
+    bench("rule_60_subnet_cidr_conflict (~: extrapolated)",
+        legacy_subnet_cidr_conflict, find_conflicts,
+        [(n, (prefixes(n),)) for n in sizes], lambda n: n * n)
+
+    subnets = prefixes(1000)
+    bench("rule_60_all_server_routable, 1000 subnets (~: extrapolated)",
+        legacy_all_server_routable, all_server_routable,
+        [(n, (subnets, servers(n, subnets))) for n in sizes], lambda n: n)
+
+if "__main__" == __name__:
+    main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Failover benchmark: how long client routes point to a dead active instance
+before the standby monitor of lib/monitor.py moves them. Run from src/:
+
+    python ../test/bench_failover.py [--latency=S] [--probe-timeout=S]
+        [--tables=N] [--routes=N] [--trials=N]
+
+The active client instance dies at a random time; the standby one pings it
+every `interval` seconds, each failed ping taking `probe_timeout`, and moves
+every route to itself after `threshold` failed checks in a row, through a
+FakeEC2 answering each call in `latency` seconds. Outage is from the death
+of the active instance to the last route replaced, in simulated seconds.
+"""
+
+import os
+import random
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_aws import FakeClock, FakeEC2, StandIn
+
+INTERVALS = (0.5, 1.0, 2.0)
+THRESHOLDS = (2, 3, 5)
+
+DEFAULTS = {
+    "latency": 0.05,        # seconds per API call
+    "probe_timeout": 1.0,   # seconds a ping to a dead instance takes
+    "tables": 3,            # client route tables
+    "routes": 4,            # routes to the active instance per table
+    "trials": 200,
+}
+
+def trial(interval, threshold, latency, probe_timeout, tables, routes, rand):
+    """Returns (outage, latency measured by the monitor, API calls)"""
+
+    from lib.monitor import HealthMonitor, Routes
+
+    clock = FakeClock()
+    ec2 = FakeEC2(clock)
+    vpc = ec2.add_vpc("10.0.0.0/16")
+    for _ in range(tables):
+        rtb = ec2.add_route_table(vpc)
+        for i in range(routes):
+            ec2.create_route(rtb.id, "172.16.%d.0/24" % i, instance_id = "i-active")
+    ec2.calls.clear()
+
+    died = 60 + rand() * interval * 10
+
+    def alive():
+        if clock.now < died:
+            return True
+        clock.sleep(probe_timeout)
+        return False
+
+    monitor = HealthMonitor("i-standby", "i-active", Routes(StandIn(ec2, clock, latency)),
+        healthy = lambda: True, alive = alive, threshold = threshold, interval = interval,
+        clock = clock.time, sleep = clock.sleep)
+    while not monitor.failovers:
+        monitor.run(1)
+
+    failover, = monitor.failovers
+    return failover["at"] - died, failover["latency"], sum(ec2.calls.values())
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def main(argv):
+    options = dict(DEFAULTS)
+    for arg in argv:
+        name, value = arg[2:].replace("-", "_").split("=", 1)
+        options[name] = float(value) if name in ("latency", "probe_timeout") else int(value)
+
+    print("latency %(latency).3fs, ping timeout %(probe_timeout).1fs, %(tables)d route tables "
+        "of %(routes)d routes, %(trials)d trials" % options)
+    print("%8s %9s %10s %10s %10s %12s %8s" % ("interval", "threshold", "outage p50", "p99", "max",
+        "measured p50", "calls"))
+
+    trials = options.pop("trials")
+    rand = random.Random(0).random
+    for interval in INTERVALS:
+        for threshold in THRESHOLDS:
+            results = [trial(interval, threshold, rand = rand, **options) for _ in range(trials)]
+            outages, measured, calls = zip(*results)
+            print("%8.1f %9d %10.2f %10.2f %10.2f %12.2f %8d" % (interval, threshold,
+                percentile(outages, 50), percentile(outages, 99), max(outages),
+                percentile(measured, 50), max(calls)))
+
+if "__main__" == __name__:
+    main(sys.argv[1:])
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end provisioning benchmark: chk_session and build_world of 1, 10 and
+100 deployments, run as a fleet against FakeAWS. Run from src/:
+
+    python ../test/bench_provision.py [--latency=S] [--rate=N] [--speedup=X]
+        [--jobs=N] [--single-pass=1] [--tunnels=N] [--raising=1] [DEPLOYMENTS...]
+
+Every deployment has its own client account, behind an assumed role, and
+shares one server account. Simulated time runs `speedup` times faster than
+the wall clock; times are reported in simulated seconds. Each size runs in
+a subprocess, so that peak RSS is its own. With --raising=1, EC2 raises its
+throttling as 503 RequestLimitExceeded, like boto does once its own retries
+are exhausted, instead of answering with an error response.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_aws import FakeAWS, ScaledClock
+
+SIZES = (1, 10, 100)
+
+DEFAULTS = {
+    "latency": 0.05,    # seconds per API call
+    "rate": 20,         # requests per second per account and region, 0 for no throttling
+    "speedup": 100,
+    "jobs": 25,         # concurrent deployments, also per account and per region
+    "single_pass": 0,   # build_world with allocate_eips and cfn_create
+    "tunnels": 1,       # instance pairs per deployment
+    "raising": 0,       # EC2 throttling raised rather than answered
+}
+
+HUB = "111111111111"
+CLIENT_REGIONS = ("us-east-1", "us-west-2", "eu-west-1")
+
+def deployments(world, n, tunnels = 1):
+    """n configs, with their VPCs, subnets and route tables in `world`"""
+
+    ec2 = world.region(HUB, "us-east-1")["ec2"]
+    hub_vpc = ec2.add_vpc("10.0.0.0/16")
+    hub_subnet = ec2.add_subnet(hub_vpc, "10.0.0.0/24")
+
+    configs = []
+    for i in range(n):
+        account, region = "2%011d" % i, CLIENT_REGIONS[i % len(CLIENT_REGIONS)]
+        ec2 = world.region(account, region)["ec2"]
+        vpc = ec2.add_vpc("172.16.0.0/16")
+        subnet = ec2.add_subnet(vpc, "172.16.1.0/24")
+        rtb = ec2.add_route_table(vpc, [subnet.id])
+
+        configs.append(("client-%03d" % i, {
+            "server": {
+                "name": "DCS",
+                "identity": {"region": "us-east-1", "role_arn": None,
+                    "cred": {"access": HUB, "secret": "secret", "session": None}},
+                "res": {"subnet_id": hub_subnet.id, "servers_allowed": [
+                    {"proto": "tcp", "ip": "10.0.0.10", "port": "443"}]},
+                "ipsec": {"subnets": []},
+            },
+            "client": {
+                "name": "client%03d" % i,
+                "identity": {"region": region,
+                    "role_arn": "arn:aws:iam::%s:role/instavpn" % account,
+                    "cred": {"access": "bench", "secret": "secret", "session": None}},
+                "res": {"subnet_id": subnet.id, "route_table_id": rtb.id,
+                    "route_all_tables": False},
+                "ipsec": {"subnets": []},
+            },
+            "params": {"InstanceType": "t2.micro"},
+            "tags": {},
+            "tunnels": tunnels,
+        }))
+
+    return configs
+
+def run(n, latency = DEFAULTS["latency"], rate = DEFAULTS["rate"],
+        speedup = DEFAULTS["speedup"], jobs = DEFAULTS["jobs"], single_pass = DEFAULTS["single_pass"],
+        tunnels = DEFAULTS["tunnels"], raising = DEFAULTS["raising"]):
+    """Check and build n deployments, returns the measurements as a dict"""
+
+    import lib.actuator
+    import lib.retry
+    from lib.aws_conn import AWSConn, identity_account
+    from lib.fleet import run_fleet
+    from lib.metrics import api_metrics
+    from lib.waiter import StackWaiter
+
+    clock = ScaledClock(speedup)
+    world = FakeAWS(clock, latency, rate = rate or None, burst = 2 * (rate or 1), raising = bool(raising))
+    configs = deployments(world, n, tunnels)
+
+    # Every sleep of the tool runs on the simulated clock
+    TokenBucket = lib.retry.TokenBucket
+    patched = [
+        (AWSConn, "_connect", lambda self, service, cred: world.connect(
+            identity_account(self.identity), self.identity["region"], service)),
+        (AWSConn, "retry_policy", lib.retry.RetryPolicy(sleep = clock.sleep)),
+        (lib.retry, "default_policy", lib.retry.RetryPolicy(sleep = clock.sleep)),
+        (lib.retry, "TokenBucket", lambda: TokenBucket(clock = clock.time, sleep = clock.sleep)),
+        (lib.actuator, "StackWaiter", lambda *args, **kwargs: StackWaiter(
+            sleep = clock.sleep, clock = clock.time, *args, **kwargs)),
+    ]
+    saved = [(obj, name, obj.__dict__[name]) for obj, name, _ in patched]
+
+    AWSConn.clear()
+    lib.retry._buckets.clear()
+    api_metrics.reset()
+    for obj, name, value in patched:
+        setattr(obj, name, value)
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    started = clock.time()
+    try:
+        report = run_fleet(configs, {"jobs": jobs, "per_account": jobs, "per_region": jobs},
+            single_pass = bool(single_pass))
+    finally:
+        seconds = clock.time() - started
+        sys.stdout = stdout
+        for obj, name, value in saved:
+            setattr(obj, name, value)
+
+    totals = api_metrics.totals()
+    return {
+        "deployments": n,
+        "built": len([r for r in report if "built" == r["status"]]),
+        "errors": sorted(set(r["error"] for r in report if r["error"])),
+        "seconds": seconds,
+        "calls": totals["calls"],
+        "throttled": world.throttled(),
+        "retries": totals["retries"],
+        "by_action": world.calls(),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+    }
+
+def main(argv):
+    options, sizes = dict(DEFAULTS), []
+    for arg in argv:
+        if arg.startswith("--"):
+            name, value = arg[2:].replace("-", "_").split("=", 1)
+            options[name] = float(value) if "latency" == name else int(value)
+        else:
+            sizes.append(int(arg))
+
+    if 1 == len(sizes) and os.environ.get("BENCH_PROVISION_CHILD"):
+        print(json.dumps(run(sizes[0], **options)))
+        return
+
+    print("latency %(latency).3fs, %(rate)d req/s per account and region, "
+        "%(jobs)d jobs, %(speedup)dx, %(tunnels)d tunnels" % options +
+        (", single pass" if options["single_pass"] else "") +
+        (", EC2 throttling raised" if options["raising"] else ""))
+    print("%6s %6s %10s %8s %10s %8s %8s %12s" % ("deploy", "built", "seconds", "calls",
+        "calls/dep", "thrtl", "retries", "peak RSS MB"))
+
+    env = dict(os.environ, BENCH_PROVISION_CHILD = "1")
+    for n in sizes or SIZES:
+        started = time.time()
+        r = json.loads(subprocess.check_output([sys.executable, os.path.abspath(__file__)] +
+            [a for a in argv if a.startswith("--")] + [str(n)], env = env))
+
+        print("%6d %6d %10.1f %8d %10.1f %8d %8d %12.1f   (%.1fs real)" % (n, r["built"],
+            r["seconds"], r["calls"], r["calls"] / float(n), r["throttled"], r["retries"],
+            r["peak_rss_mb"], time.time() - started))
+        for error in r["errors"]:
+            print("       %s" % error)
+
+if "__main__" == __name__:
+    main(sys.argv[1:])
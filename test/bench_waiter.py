@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark: fixed-interval polling vs. event-tailing StackWaiter
+
+Runs on the virtual clock in fake_aws; numbers are simulated seconds and
+API calls, not wall-clock. Run from src/:
+
+    python ../test/bench_waiter.py
+"""
+
+import os
+import random
+import sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from lib.waiter import StackWaiter
+from fake_aws import FakeClock, FakeCloudFormation
+
+# (name, legacy interval, waiter max_interval, resources)
+SCENARIOS = [
+    ("eip", 3, 5, [
+        ("ServerDummyEIP", "AWS::EC2::EIP", 15),
+    ]),
+    ("main", 10, 15, [
+        ("ServerSG", "AWS::EC2::SecurityGroup", 5),
+        ("ServerENI", "AWS::EC2::NetworkInterface", 5),
+        ("ServerEIPAssoc", "AWS::EC2::EIPAssociation", 15),
+        ("ServerVPN", "AWS::EC2::Instance", 45),
+        ("ServerWaitHandle", "AWS::CloudFormation::WaitConditionHandle", 1),
+        ("ServerWaitCondition", "AWS::CloudFormation::WaitCondition", 240),
+    ]),
+]
+
+def legacy(cfn, clock, interval):
+    """The loop _wait_cfn used to run, for a single stack"""
+    stack = cfn.describe_stacks("stack")[0]
+    done = False
+    while not done:
+        stack.update()
+        done = stack.stack_status == "CREATE_COMPLETE"
+        clock.sleep(interval)
+
+def tailing(cfn, clock, max_interval):
+    StackWaiter(cfn, "stack", max_interval=max_interval,
+        sleep=clock.sleep, clock=clock.time).wait()
+
+RUNS = 200
+
+def run(fn, resources, arg):
+    clock = FakeClock()
+    cfn = FakeCloudFormation(clock, resources)
+    cfn.create_stack("stack")
+    calls = sum(cfn.calls.values())
+    fn(cfn, clock, arg)
+    return clock.now - cfn.stacks["stack"].completed_at, sum(cfn.calls.values()) - calls
+
+def jitter(resources, rnd):
+    """Resource durations vary +-50% between runs"""
+    return [(r, t, seconds * rnd.uniform(0.5, 1.5)) for r, t, seconds in resources]
+
+def main():
+    print("%-6s %-8s %14s %14s %10s" % (
+        "stack", "waiter", "detect avg(s)", "detect max(s)", "API calls"))
+
+    for name, interval, max_interval, resources in SCENARIOS:
+        for label, fn, arg in (("legacy", legacy, interval), ("tailing", tailing, max_interval)):
+            rnd = random.Random(42)
+            results = [run(fn, jitter(resources, rnd), arg) for _ in range(RUNS)]
+            latencies = [r[0] for r in results]
+
+            print("%-6s %-8s %14.2f %14.2f %10.1f" % (name, label,
+                sum(latencies) / len(latencies), max(latencies),
+                sum(r[1] for r in results) / float(len(results))))
+
+if "__main__" == __name__:
+    main()
@@ -0,0 +1,761 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the AWS APIs used by InstaVPN
+
+Runs on a virtual clock so that tests and benchmarks measure API behaviour
+rather than wall-clock sleeps. Only the calls InstaVPN makes are modelled.
+
+FakeAWS puts the fakes of every account and region behind StandIn, which
+gives them boto's make_request funnel with per-call latency and throttling,
+so that AWSConn instruments them like real connections.
+"""
+
+import itertools
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+class FakeClock(object):
+    """Virtual clock; `sleep` advances time instantly"""
+
+    def __init__(self, now = 0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class ScaledClock(object):
+    """Wall clock running `speedup` times faster, for concurrent benchmarks
+
+    Threads sleep for real, so that they interleave like they would against
+    AWS, in 1/speedup of the simulated time.
+    """
+
+    def __init__(self, speedup = 100.0):
+        self.speedup = float(speedup)
+        self.started = time.time()
+
+    @property
+    def now(self):
+        return (time.time() - self.started) * self.speedup
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speedup)
+
+class ResultSet(list):
+    next_token = None
+
+class Output(object):
+    def __init__(self, key, value):
+        self.key, self.value = key, value
+
+class Parameter(object):
+    def __init__(self, key, value):
+        self.key, self.value = key, value
+
+class StackEvent(object):
+    def __init__(self, event_id, stack, logical_id, resource_type, status, timestamp):
+        self.event_id = event_id
+        self.stack_id = stack.stack_id
+        self.stack_name = stack.stack_name
+        self.logical_resource_id = logical_id
+        self.physical_resource_id = stack.stack_id if logical_id == stack.stack_name else logical_id
+        self.resource_type = resource_type
+        self.resource_status = status
+        self.resource_status_reason = None
+        self.timestamp = timestamp
+
+class FakeStack(object):
+    def __init__(self, cfn, stack_name, parameters, tags, template = None):
+        self.connection = cfn
+        self.template = template
+        self.stack_name = stack_name
+        self.stack_id = "arn:aws:cloudformation:fake:000000000000:stack/%s/%d" % (
+            stack_name, next(cfn.ids))
+        self.parameters = [Parameter(p[0], p[1]) for p in parameters]
+        self.tags = tags
+        self.timeline = [] # [(timestamp, StackEvent)]
+        self.outputs = []
+        self.deleted_at = None
+
+    @property
+    def stack_status(self):
+        status = None
+        for ts, event in self.timeline:
+            if ts > self.connection.clock.now: break
+            if event.logical_resource_id == self.stack_name:
+                status = event.resource_status
+        return status
+
+    def update(self):
+        self.connection.calls["DescribeStacks"] += 1
+        return self
+
+    def delete(self):
+        self.connection.delete_stack(self.stack_name)
+
+class FakeCloudFormation(object):
+    """CloudFormation with scripted stack transitions
+
+    * resources: [(logical_id, resource_type, seconds)] created in sequence
+    * outputs: [(key, value)], or outputs(stack, keys) with the output keys
+      of the stack template
+    * durations: {resource_type: seconds}; when set, resources are taken
+      from the stack template instead
+    * fail_at: logical id of the resource that fails, if any
+    * fail_stack: name of the only stack failing at `fail_at`, if set
+    * delete_seconds: how long stacks take to delete; gone right away if 0
+    """
+
+    page_size = 100
+
+    def __init__(self, clock, resources = None, outputs = None, fail_at = None, durations = None,
+            delete_seconds = 0, fail_stack = None):
+        self.clock = clock
+        self.fail_stack = fail_stack
+        self.delete_seconds = delete_seconds
+        self.resources = resources or [("Resource", "AWS::EC2::EIP", 10)]
+        self.outputs = outputs or []
+        self.durations = durations
+        self.fail_at = fail_at
+        self.stacks = {}
+        self.ids = itertools.count(1)
+        self.calls = dict.fromkeys(
+            ["CreateStack", "UpdateStack", "DeleteStack", "DescribeStacks",
+            "DescribeStackEvents"], 0)
+
+    def _schedule(self, stack, action):
+        t = self.clock.now
+
+        def _event(logical_id, rtype, status):
+            stack.timeline.append((t, StackEvent(
+                "%s-%d" % (stack.stack_name, next(self.ids)),
+                stack, logical_id, rtype, status, t)))
+
+        _event(stack.stack_name, "AWS::CloudFormation::Stack", "%s_IN_PROGRESS" % action)
+
+        for logical_id, rtype, seconds in self._resources(stack):
+            _event(logical_id, rtype, "CREATE_IN_PROGRESS")
+            t += seconds
+
+            if logical_id == self.fail_at and self.fail_stack in (None, stack.stack_name):
+                _event(logical_id, rtype, "CREATE_FAILED")
+                t += 1
+                _event(stack.stack_name, "AWS::CloudFormation::Stack",
+                    "ROLLBACK_IN_PROGRESS" if "CREATE" == action else "UPDATE_ROLLBACK_IN_PROGRESS")
+                return False
+
+            _event(logical_id, rtype, "CREATE_COMPLETE")
+
+        t += 1
+        _event(stack.stack_name, "AWS::CloudFormation::Stack", "%s_COMPLETE" % action)
+        stack.completed_at = t
+        stack.outputs = [Output(k, v) for k, v in self._outputs(stack)]
+        return True
+
+    def _resources(self, stack):
+        if self.durations is None or not stack.template:
+            return self.resources
+        return [(logical_id, res["Type"], self.durations.get(res["Type"], 1))
+            for logical_id, res in sorted(json.loads(stack.template)["Resources"].items())]
+
+    def _outputs(self, stack):
+        if not callable(self.outputs):
+            return self.outputs
+        return self.outputs(stack, sorted(json.loads(stack.template or "{}").get("Outputs", {})))
+
+    def create_stack(self, stack_name, template_body = None, parameters = None, tags = None, **kwargs):
+        self.calls["CreateStack"] += 1
+        self._check_capabilities(template_body, kwargs.get("capabilities"))
+        stack = FakeStack(self, stack_name, parameters or [], tags or {}, template_body)
+        self.stacks[stack_name] = stack
+        self._schedule(stack, "CREATE")
+        return stack.stack_id
+
+    def update_stack(self, stack_name, template_body = None, parameters = None,
+            use_previous_template = False, **kwargs):
+        self.calls["UpdateStack"] += 1
+        stack = self._get(stack_name)
+        self._check_capabilities(stack.template if use_previous_template else template_body,
+            kwargs.get("capabilities"))
+        rollback = (stack.template, stack.parameters)
+        if not use_previous_template:
+            stack.template = template_body
+        previous = dict((p.key, p.value) for p in stack.parameters)
+        stack.parameters = [Parameter(p[0], previous.get(p[0]) if len(p) > 2 and p[2] else p[1])
+            for p in parameters or []]
+        if not self._schedule(stack, "UPDATE"):
+            stack.template, stack.parameters = rollback
+        return stack.stack_id
+
+    def get_template(self, stack_name_or_id):
+        self.calls["GetTemplate"] = self.calls.get("GetTemplate", 0) + 1
+        return {"GetTemplateResponse": {"GetTemplateResult": {
+            "TemplateBody": self._get(stack_name_or_id).template or "{}"}}}
+
+    def describe_stack_resource(self, stack_name_or_id, logical_resource_id):
+        """Resolved cfn-init metadata of the VPN instance: its secrets file, and
+        the cfn-hup hook if the stack template has one"""
+
+        self.calls["DescribeStackResource"] = self.calls.get("DescribeStackResource", 0) + 1
+        stack = self._get(stack_name_or_id)
+        secret = dict((p.key, p.value) for p in stack.parameters).get("SharedSecret")
+        files = {"/etc/ipsec.d/instavpn.secrets": {"content": '1.1.1.1 2.2.2.2: PSK "%s"\n\n' % secret}}
+        if "/etc/cfn/hooks.d/instavpn-psk.conf" in (stack.template or ""):
+            files["/etc/cfn/hooks.d/instavpn-psk.conf"] = {"content": "[instavpn-psk]\n"}
+
+        return {"DescribeStackResourceResponse": {"DescribeStackResourceResult": {"StackResourceDetail": {
+            "LogicalResourceId": logical_resource_id,
+            "Metadata": json.dumps({"AWS::CloudFormation::Init": {"config": {"files": files}}})}}}}
+
+    def delete_stack(self, stack_name_or_id):
+        self.calls["DeleteStack"] += 1
+        stack = self._get(stack_name_or_id)
+
+        t = self.clock.now
+        for ts, status in ((t, "DELETE_IN_PROGRESS"), (t + self.delete_seconds, "DELETE_COMPLETE")):
+            stack.timeline.append((ts, StackEvent("%s-%d" % (stack.stack_name, next(self.ids)),
+                stack, stack.stack_name, "AWS::CloudFormation::Stack", status, ts)))
+        stack.deleted_at = t + self.delete_seconds
+        if not self.delete_seconds:
+            self.stacks.pop(stack.stack_name)
+
+    def exists(self, stack_name):
+        """Whether `stack_name` exists, ie., isn't deleted yet"""
+        try:
+            return bool(self._get(stack_name))
+        except Exception:
+            return False
+
+    def describe_stacks(self, stack_name_or_id = None, next_token = None):
+        self.calls["DescribeStacks"] += 1
+        return ResultSet([self._get(stack_name_or_id)])
+
+    def describe_stack_events(self, stack_name_or_id = None, next_token = None):
+        self.calls["DescribeStackEvents"] += 1
+
+        stack = self._get(stack_name_or_id)
+        events = [e for ts, e in stack.timeline if ts <= self.clock.now]
+        events.reverse()
+
+        start = int(next_token or 0)
+        ret = ResultSet(events[start:start + self.page_size])
+        if start + self.page_size < len(events):
+            ret.next_token = str(start + self.page_size)
+        return ret
+
+    def _check_capabilities(self, template_body, capabilities):
+        """Templates with IAM resources need CAPABILITY_IAM"""
+        if '"AWS::IAM::' in (template_body or "") and "CAPABILITY_IAM" not in (capabilities or []):
+            from boto.exception import BotoServerError
+            raise BotoServerError(400, "Bad Request", "<ErrorResponse><Error><Type>Sender</Type>"
+                "<Code>InsufficientCapabilitiesException</Code><Message>Requires capabilities : "
+                "[CAPABILITY_IAM]</Message></Error></ErrorResponse>")
+
+    def _get(self, stack_name_or_id):
+        for stack in self.stacks.values():
+            if stack_name_or_id in (stack.stack_name, stack.stack_id):
+                if stack.deleted_at is None or stack.deleted_at > self.clock.now:
+                    return stack
+                self.stacks.pop(stack.stack_name)
+                break
+        from boto.exception import BotoServerError
+        raise BotoServerError(400, "Bad Request", "<ErrorResponse><Error><Type>Sender</Type>"
+            "<Code>ValidationError</Code><Message>Stack with id %s does not exist</Message>"
+            "</Error></ErrorResponse>" % stack_name_or_id)
+
+#
+# EC2 / VPC
+#
+
+class Obj(object):
+    """Attribute bag standing for boto resource objects"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class FakeEC2(object):
+    """EC2 and VPC connections share one fake, as boto's VPCConnection
+    extends EC2Connection.
+
+    `vpc_size` adds that many unrelated subnets, route tables and IGWs in
+    other VPCs, which unfiltered describe calls have to wade through.
+
+    Instances are running `boot_seconds` after launch, and stop themselves
+    `stop_seconds` after launch if their UserData powers off; images are
+    available `image_seconds` after being created.
+    """
+
+    boot_seconds, stop_seconds, image_seconds = 30, 600, 300
+
+    def __init__(self, clock = None, vpc_size = 0):
+        self.clock = clock or FakeClock()
+        self.calls = {}
+        self.ids = itertools.count(1)
+
+        self.vpcs, self.subnets, self.route_tables, self.igws, self.sgs = {}, {}, {}, {}, {}
+        self.addresses, self.instances, self.images = {}, {}, {}
+        self.tags = {} # {resource id: {key: value}}
+        self.in_use = lambda allocation_id: False # whether an ENI holds the address
+
+        for i in range(vpc_size):
+            vpc = self.add_vpc("10.%d.0.0/16" % (i % 256))
+            self.add_subnet(vpc, "10.%d.0.0/24" % (i % 256))
+
+    def _call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _id(self, prefix):
+        return "%s-%08x" % (prefix, next(self.ids))
+
+    # Fixtures
+
+    def add_vpc(self, cidr, igw = True):
+        vpc = Obj(id = self._id("vpc"), cidr_block = cidr)
+        self.vpcs[vpc.id] = vpc
+
+        main = Obj(id = self._id("rtb"), vpc_id = vpc.id, routes = [
+            Obj(destination_cidr_block = cidr, gateway_id = "local", instance_id = None)
+        ], associations = [Obj(id = self._id("rtbassoc"), main = True, subnet_id = None)])
+        self.route_tables[main.id] = main
+
+        if igw:
+            gw = Obj(id = self._id("igw"), attachments = [Obj(vpc_id = vpc.id)])
+            self.igws[gw.id] = gw
+
+        return vpc
+
+    def add_subnet(self, vpc, cidr):
+        subnet = Obj(id = self._id("subnet"), vpc_id = vpc.id, cidr_block = cidr)
+        self.subnets[subnet.id] = subnet
+        return subnet
+
+    def add_route_table(self, vpc, subnet_ids = ()):
+        rtb = Obj(id = self._id("rtb"), vpc_id = vpc.id, routes = [
+            Obj(destination_cidr_block = vpc.cidr_block, gateway_id = "local", instance_id = None)
+        ], associations = [
+            Obj(id = self._id("rtbassoc"), main = False, subnet_id = sid) for sid in subnet_ids])
+        self.route_tables[rtb.id] = rtb
+        return rtb
+
+    def add_security_group(self, vpc):
+        sg = Obj(id = self._id("sg"), vpc_id = vpc.id, rules_egress = [
+            Obj(ip_protocol = "-1", from_port = None, to_port = None,
+                grants = [Obj(cidr_ip = "0.0.0.0/0")])
+        ], rules = [])
+        sg.authorize = lambda ip_protocol = None, from_port = None, to_port = None, cidr_ip = None: \
+            self._call("AuthorizeSecurityGroupIngress") or sg.rules.append(
+                Obj(ip_protocol = str(ip_protocol), from_port = from_port, to_port = to_port,
+                    grants = [Obj(cidr_ip = cidr_ip)])) or True
+        self.sgs[sg.id] = sg
+        return sg
+
+    # Describe
+
+    def _select(self, pool, ids, filters, attrs):
+        ret = ResultSet(pool[i] for i in ids) if ids else ResultSet(pool.values())
+        for name, value in (filters or {}).items():
+            ret = ResultSet(o for o in ret if value in attrs[name](o))
+        return ret
+
+    def get_all_vpcs(self, vpc_ids = None, filters = None):
+        self._call("DescribeVpcs")
+        return self._select(self.vpcs, vpc_ids, filters, {})
+
+    def get_all_subnets(self, subnet_ids = None, filters = None):
+        self._call("DescribeSubnets")
+        if isinstance(subnet_ids, basestring): subnet_ids = [subnet_ids]
+        return self._select(self.subnets, subnet_ids, filters, {
+            "vpc-id": lambda o: [o.vpc_id]})
+
+    def get_all_route_tables(self, route_table_ids = None, filters = None):
+        self._call("DescribeRouteTables")
+        return self._select(self.route_tables, route_table_ids, filters, {
+            "vpc-id": lambda o: [o.vpc_id],
+            "association.subnet-id": lambda o: [a.subnet_id for a in o.associations],
+            "route.instance-id": lambda o: [r.instance_id for r in o.routes]})
+
+    def get_all_internet_gateways(self, internet_gateway_ids = None, filters = None):
+        self._call("DescribeInternetGateways")
+        return self._select(self.igws, internet_gateway_ids, filters, {
+            "attachment.vpc-id": lambda o: [a.vpc_id for a in o.attachments]})
+
+    def get_all_security_groups(self, groupnames = None, group_ids = None, filters = None):
+        self._call("DescribeSecurityGroups")
+        return self._select(self.sgs, group_ids, filters, {})
+
+    # Mutations
+
+    def create_security_group(self, name, description, vpc_id = None, dry_run = False):
+        self._call("CreateSecurityGroup")
+        if dry_run:
+            from boto.exception import EC2ResponseError
+            raise EC2ResponseError(412, "Precondition Failed", "DryRunOperation")
+        return self.add_security_group(self.vpcs[vpc_id])
+
+    def allocate_address(self, domain = None, dry_run = False):
+        self._call("AllocateAddress")
+        n = next(self.ids)
+        address = Obj(public_ip = "198.51.%d.%d" % (n >> 8 & 0xff, n & 0xff),
+            allocation_id = self._id("eipalloc"), domain = domain)
+        self.addresses[address.allocation_id] = address
+        return address
+
+    def release_address(self, public_ip = None, allocation_id = None, dry_run = False):
+        self._call("ReleaseAddress")
+        if self.in_use(allocation_id):
+            from boto.exception import EC2ResponseError
+            raise EC2ResponseError(400, "Bad Request", "<Response><Errors><Error>"
+                "<Code>InvalidIPAddress.InUse</Code><Message>Address %s is in use.</Message>"
+                "</Error></Errors></Response>" % allocation_id)
+        del self.addresses[allocation_id]
+        return True
+
+    def _instance_state(self, instance):
+        age = self.clock.now - instance.launched
+        if instance.terminated:
+            return "terminated"
+        if age < self.boot_seconds:
+            return "pending"
+        if "shutdown -h" in (instance.user_data or "") and age >= self.stop_seconds:
+            return "stopped"
+        return "running"
+
+    def add_instance(self, private_ip_address):
+        """A running instance, eg., the VPN instance of a stack"""
+        instance = Obj(id = self._id("i"), image_id = None, instance_type = None, user_data = None,
+            kwargs = {}, launched = self.clock.now - self.boot_seconds, terminated = False,
+            private_ip_address = private_ip_address)
+        self.instances[instance.id] = instance
+        return instance
+
+    def _instance(self, instance):
+        return Obj(id = instance.id, image_id = instance.image_id,
+            instance_type = instance.instance_type, state = self._instance_state(instance),
+            private_ip_address = getattr(instance, "private_ip_address", None))
+
+    def run_instances(self, image_id, instance_type = None, user_data = None, **kwargs):
+        self._call("RunInstances")
+        instance = Obj(id = self._id("i"), image_id = image_id, instance_type = instance_type,
+            user_data = user_data, kwargs = kwargs, launched = self.clock.now, terminated = False)
+        self.instances[instance.id] = instance
+        return Obj(instances = [self._instance(instance)])
+
+    def get_all_instances(self, instance_ids = None, filters = None):
+        self._call("DescribeInstances")
+        return ResultSet(Obj(instances = [self._instance(i)])
+            for i in self._select(self.instances, instance_ids, filters, {}))
+
+    def terminate_instances(self, instance_ids = None):
+        self._call("TerminateInstances")
+        for instance_id in instance_ids:
+            self.instances[instance_id].terminated = True
+        return [self._instance(self.instances[i]) for i in instance_ids]
+
+    def create_image(self, instance_id, name, description = None, **kwargs):
+        self._call("CreateImage")
+        if self._instance_state(self.instances[instance_id]) not in ("running", "stopped"):
+            raise Exception("IncorrectInstanceState")
+        image = Obj(id = self._id("ami"), name = name, description = description,
+            instance_id = instance_id, created = self.clock.now)
+        self.images[image.id] = image
+        return image.id
+
+    def get_all_images(self, image_ids = None, owners = None, filters = None):
+        self._call("DescribeImages")
+        return ResultSet(Obj(id = i.id, name = i.name, state = "available"
+            if self.clock.now - i.created >= self.image_seconds else "pending")
+            for i in self._select(self.images, image_ids, filters, {}))
+
+    def create_tags(self, resource_ids, tags, dry_run = False):
+        self._call("CreateTags")
+        for resource_id in resource_ids:
+            self.tags.setdefault(resource_id, {}).update(tags)
+        return True
+
+    def get_all_tags(self, filters = None, max_results = None):
+        self._call("DescribeTags")
+        tags = ResultSet(Obj(res_id = res_id, name = k, value = v)
+            for res_id, kv in sorted(self.tags.items()) for k, v in sorted(kv.items()))
+        attrs = {"resource-id": lambda o: [o.res_id], "key": lambda o: [o.name]}
+        for name, value in (filters or {}).items():
+            tags = ResultSet(o for o in tags if value in attrs[name](o))
+        return tags
+
+    def _route(self, rtb_id, cidr):
+        for route in self.route_tables[rtb_id].routes:
+            if route.destination_cidr_block == cidr:
+                return route
+        return None
+
+    def create_route(self, route_table_id, destination_cidr_block, gateway_id = None, instance_id = None):
+        self._call("CreateRoute")
+        if self._route(route_table_id, destination_cidr_block):
+            raise Exception("RouteAlreadyExists")
+        self.route_tables[route_table_id].routes.append(Obj(
+            destination_cidr_block = destination_cidr_block,
+            gateway_id = gateway_id, instance_id = instance_id))
+        return True
+
+    def replace_route(self, route_table_id, destination_cidr_block, gateway_id = None, instance_id = None):
+        self._call("ReplaceRoute")
+        route = self._route(route_table_id, destination_cidr_block)
+        route.gateway_id, route.instance_id = gateway_id, instance_id
+        return True
+
+    def delete_route(self, route_table_id, destination_cidr_block):
+        self._call("DeleteRoute")
+        route = self._route(route_table_id, destination_cidr_block)
+        self.route_tables[route_table_id].routes.remove(route)
+        return True
+
+    def authorize_security_group_egress(self, group_id, ip_protocol, from_port = None,
+            to_port = None, src_group_id = None, cidr_ip = None):
+        self._call("AuthorizeSecurityGroupEgress")
+        self.sgs[group_id].rules_egress.append(Obj(ip_protocol = ip_protocol,
+            from_port = from_port, to_port = to_port, grants = [Obj(cidr_ip = cidr_ip)]))
+        return True
+
+    def revoke_security_group_egress(self, group_id, ip_protocol, from_port = None,
+            to_port = None, src_group_id = None, cidr_ip = None):
+        self._call("RevokeSecurityGroupEgress")
+        sg = self.sgs[group_id]
+        sg.rules_egress = [r for r in sg.rules_egress if not (
+            r.ip_protocol == ip_protocol and r.from_port == from_port and
+            r.to_port == to_port and r.grants[0].cidr_ip == cidr_ip)]
+        return True
+
+    def get_status(self, action, params, path = '/', parent = None, verb = 'GET'):
+        """Raw EC2 query, only batched security group egress rules"""
+        self._call(action)
+        sg = self.sgs[params["GroupId"]]
+
+        i = 1
+        while "IpPermissions.%d.IpProtocol" % i in params:
+            prefix = "IpPermissions.%d." % i
+            j = 1
+            while "%sIpRanges.%d.CidrIp" % (prefix, j) in params:
+                rule = (params[prefix + "IpProtocol"], params.get(prefix + "FromPort"),
+                    params.get(prefix + "ToPort"), params["%sIpRanges.%d.CidrIp" % (prefix, j)])
+
+                if "AuthorizeSecurityGroupEgress" == action:
+                    sg.rules_egress.append(Obj(ip_protocol = rule[0], from_port = rule[1],
+                        to_port = rule[2], grants = [Obj(cidr_ip = rule[3])]))
+                else:
+                    sg.rules_egress = [r for r in sg.rules_egress if rule != (
+                        r.ip_protocol, r.from_port, r.to_port, r.grants[0].cidr_ip)]
+                j += 1
+            i += 1
+
+        return True
+
+def fake_conn(**services):
+    """AWSConn stand-in: fake_conn(vpc=ec2, ec2=ec2, cloudformation=cfn)"""
+    return lambda service: services[service]
+
+#
+# STS
+#
+
+class FakeSTS(object):
+    """Assumed-role credentials valid for an hour, of the role's account"""
+
+    def __init__(self):
+        self.calls = {"AssumeRole": 0}
+        self.ids = itertools.count(1)
+
+    def assume_role(self, role_arn, role_session_name, **kwargs):
+        self.calls["AssumeRole"] += 1
+        n = next(self.ids)
+        return Obj(credentials = Obj(
+            access_key = "ASIA%s%04d" % (role_arn.split(":")[4], n),
+            secret_key = "secret-%d" % n,
+            session_token = "token-%d" % n,
+            expiration = (datetime.utcnow() + timedelta(hours = 1)).strftime("%Y-%m-%dT%H:%M:%SZ")))
+
+#
+# API funnel: latency and throttling
+#
+
+THROTTLING_BODY = ("<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code>"
+    "<Message>Rate exceeded</Message></Error></ErrorResponse>")
+
+# What EC2 raises once boto's own retries of 503 responses are exhausted
+REQUEST_LIMIT_BODY = ("<Response><Errors><Error><Code>RequestLimitExceeded</Code>"
+    "<Message>Request limit exceeded.</Message></Error></Errors></Response>")
+
+class Response(object):
+    """What make_request returns; `result` is the fake's return value"""
+
+    def __init__(self, status, body = "", result = None):
+        self.status = status
+        self.reason = "OK" if status < 400 else "Bad Request"
+        self.body, self.result = body, result
+
+    def read(self):
+        return self.body
+
+class RateLimit(object):
+    """AWS-side request rate of an account and region; requests over it are throttled"""
+
+    def __init__(self, clock, rate, burst):
+        self.clock, self.rate, self.burst = clock, float(rate), burst
+        self.tokens, self.updated = float(burst), clock.time()
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = self.clock.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+
+            self.throttled += 1
+            return False
+
+class StandIn(object):
+    """A fake behind boto's make_request funnel
+
+    Public methods of `fake` are sent through make_request(action, thunk),
+    which takes `latency` seconds of `clock` and may answer with a
+    throttling error response, raised as BotoServerError like boto does.
+    With `raising`, throttling is raised by make_request itself, a 503
+    RequestLimitExceeded, like boto's EC2 connection does.
+    AWSConn replaces make_request on the instance to instrument it.
+    """
+
+    def __init__(self, fake, clock, latency = 0, limit = None, raising = False):
+        self.fake, self.clock = fake, clock
+        self.latency, self.limit = latency, limit
+        self.raising = raising
+
+    def make_request(self, action, thunk):
+        self.clock.sleep(self.latency)
+        if self.limit is not None and not self.limit.allow():
+            if self.raising:
+                from boto.exception import BotoServerError
+                raise BotoServerError(503, "Service Unavailable", REQUEST_LIMIT_BODY)
+            return Response(400, THROTTLING_BODY)
+        return Response(200, result = thunk())
+
+    def __getattr__(self, name):
+        attr = getattr(self.fake, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def _api(*args, **kwargs):
+            action = args[0] if "get_status" == name else _action(name)
+            response = self.make_request(action, lambda: attr(*args, **kwargs))
+            if response.status >= 400:
+                from boto.exception import BotoServerError
+                raise BotoServerError(response.status, response.reason, response.read())
+            return response.result
+
+        return _api
+
+def _action(name):
+    """AWS action of a boto method, eg., get_all_vpcs to DescribeVpcs"""
+    if name.startswith("get_all_"):
+        name = "describe_" + name[len("get_all_"):]
+    return "".join(word.capitalize() for word in name.split("_"))
+
+#
+# Accounts and regions
+#
+
+# Seconds to create a resource, a serialized approximation of CloudFormation
+DURATIONS = {
+    "AWS::EC2::EIP": 5,
+    "AWS::EC2::SecurityGroup": 3,
+    "AWS::EC2::NetworkInterface": 5,
+    "AWS::EC2::EIPAssociation": 3,
+    "AWS::EC2::Instance": 45,
+    "AWS::CloudFormation::WaitConditionHandle": 1,
+    "AWS::CloudFormation::WaitCondition": 240,
+}
+
+class FakeAWS(object):
+    """Fakes of every (account, region), handed out by connect()
+
+    * latency: seconds per API call
+    * durations: {resource_type: seconds} of stack transitions
+    * rate, burst: requests per second and burst per account and region
+      before AWS throttles; None for no throttling
+    * raising: EC2 throttling is raised as 503 RequestLimitExceeded rather
+      than answered as an error response
+
+    EC2 and VPC share one FakeEC2 per region. Stacks output SGs created in
+    the VPC passed as <MySide>VPCId, and made-up EIPs and instance IDs.
+    """
+
+    def __init__(self, clock, latency = 0, durations = None, rate = None, burst = 20, raising = False):
+        self.clock, self.latency = clock, latency
+        self.durations = DURATIONS if durations is None else durations
+        self.rate, self.burst = rate, burst
+        self.raising = raising
+        self.regions = {} # {(account, region): {service: fake, "limit": RateLimit}}
+        self._lock = threading.Lock()
+
+    def region(self, account, region):
+        """Fakes of (account, region), created on first use"""
+
+        key = (account, region)
+        with self._lock:
+            if key not in self.regions:
+                ec2 = FakeEC2(self.clock)
+                self.regions[key] = {
+                    "ec2": ec2,
+                    "cloudformation": FakeCloudFormation(self.clock,
+                        outputs = self._outputs(ec2), durations = self.durations),
+                    "sts": FakeSTS(),
+                    "limit": None if self.rate is None else RateLimit(self.clock, self.rate, self.burst),
+                }
+            return self.regions[key]
+
+    def connect(self, account, region, service):
+        fakes = self.region(account, region)
+        ec2 = service in ("ec2", "vpc")
+        return StandIn(fakes["ec2" if ec2 else service], self.clock,
+            self.latency, fakes["limit"], raising = self.raising and ec2)
+
+    def calls(self):
+        """{action: calls made to the fakes}, all accounts and regions"""
+        totals = {}
+        for fakes in self.regions.values():
+            for service in ("ec2", "cloudformation", "sts"):
+                for action, n in fakes[service].calls.items():
+                    totals[action] = totals.get(action, 0) + n
+        return totals
+
+    def throttled(self):
+        return sum(fakes["limit"].throttled for fakes in self.regions.values() if fakes["limit"])
+
+    @staticmethod
+    def _outputs(ec2):
+        def _values(stack, keys):
+            params = dict((p.key, p.value) for p in stack.parameters)
+            values = []
+            for key in keys:
+                if key.endswith("SGId"):
+                    value = ec2.add_security_group(ec2.vpcs[params[key[:-len("SGId")] + "VPCId"]]).id
+                elif key.endswith("EIPId"):
+                    value = ec2._id("eipalloc")
+                elif key.endswith("EIP"):
+                    n = next(ec2.ids)
+                    value = "198.51.%d.%d" % (n >> 8 & 0xff, n & 0xff)
+                else:
+                    value = ec2._id("i")
+                values.append((key, value))
+            return values
+        return _values
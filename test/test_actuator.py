@@ -2,9 +2,479 @@
 
 import unittest
 from lib.actuator import *
+from lib.actuator import _pc_server_sg, _sg_rule, _pc_client_rtb, _route_diff, plan_world, rotate_psk
 
-class TestActuator(unittest.TestCase):
-    def test_should_implement(self):
-        """Should implement it someday"""
-        pass
+from fake_aws import FakeClock, FakeCloudFormation, FakeEC2, Obj, Output, fake_conn
 
+class TestServerSG(unittest.TestCase):
+    def setUp(self):
+        self.ec2 = FakeEC2()
+        self.sg = self.ec2.add_security_group(self.ec2.add_vpc("10.0.0.0/16"))
+
+    def session(self, servers_allowed):
+        return {
+            "conn": {"server": fake_conn(ec2 = self.ec2)},
+            "stacks": {"server": Obj(outputs = [Output("ServerSGId", self.sg.id)])},
+            "config": {"server": {"res": {"servers_allowed": servers_allowed}}},
+        }
+
+    def rules(self):
+        return sorted(_sg_rule(r.ip_protocol, r.from_port, r.to_port, r.grants[0].cidr_ip)
+            for r in self.sg.rules_egress)
+
+    def test_batched(self):
+        """Default rule revoked and all destinations granted in two requests"""
+
+        servers = [{"proto": "tcp", "ip": "10.1.%d.%d" % (i / 250, i % 250), "port": "443"}
+            for i in range(80)] + [{"proto": "all", "ip": "10.2.0.1", "port": "all"}]
+
+        _pc_server_sg(self.session(servers))
+
+        self.assertEqual(self.ec2.calls, {"DescribeSecurityGroups": 1,
+            "RevokeSecurityGroupEgress": 1, "AuthorizeSecurityGroupEgress": 2})
+        self.assertEqual(81, len(self.rules()))
+        self.assertIn(("-1", None, None, "10.2.0.1/32"), self.rules())
+
+    def test_diff(self):
+        """Unchanged rules are neither revoked nor granted again"""
+
+        servers = [{"proto": "tcp", "ip": "10.1.0.1", "port": "443"},
+            {"proto": "udp", "ip": "10.1.0.2", "port": "all"}]
+        _pc_server_sg(self.session(servers))
+
+        self.ec2.calls.clear()
+        _pc_server_sg(self.session(servers[1:] + [{"proto": "tcp", "ip": "10.1.0.3", "port": "22"}]))
+
+        self.assertEqual(self.ec2.calls, {"DescribeSecurityGroups": 1,
+            "RevokeSecurityGroupEgress": 1, "AuthorizeSecurityGroupEgress": 1})
+        self.assertEqual(self.rules(), [
+            ("tcp", 22, 22, "10.1.0.3/32"), ("udp", 0, 65535, "10.1.0.2/32")])
+
+        self.ec2.calls.clear()
+        _pc_server_sg(self.session(servers[1:] + [{"proto": "tcp", "ip": "10.1.0.3", "port": "22"}]))
+        self.assertEqual(self.ec2.calls, {"DescribeSecurityGroups": 1})
+
+class ClientVPCFixture(object):
+    def setUp(self):
+        self.ec2 = FakeEC2()
+        self.vpc = self.ec2.add_vpc("10.0.0.0/16")
+        self.subnets = [self.ec2.add_subnet(self.vpc, "10.0.%d.0/24" % i) for i in range(3)]
+        self.rtbs = [self.ec2.add_route_table(self.vpc, [sn.id]) for sn in self.subnets]
+        self.ec2.add_route_table(self.vpc) # Not associated
+
+    def session(self, route_all_tables = True, instance_id = "i-1"):
+        from lib.resources import SideResources
+
+        conn = fake_conn(vpc = self.ec2)
+        return {
+            "conn": {"client": conn},
+            "cache": {"client": SideResources(conn, self.subnets[0].id)},
+            "stacks": {"client": Obj(outputs = [Output("ClientInstanceId", instance_id)])},
+            "config": {
+                "server": {"ipsec": {"subnets": ["172.16.0.0/24", "172.16.1.0/24"]}},
+                "client": {"res": {"route_table_id": self.rtbs[0].id,
+                    "route_all_tables": route_all_tables}},
+            },
+        }
+
+    def routes(self, rtb):
+        return sorted((r.destination_cidr_block, r.instance_id) for r in rtb.routes if r.instance_id)
+
+class TestClientRoutes(ClientVPCFixture, unittest.TestCase):
+    def test_reconcile(self):
+        """Minimal changes on every associated route table"""
+
+        self.ec2.create_route(self.rtbs[1].id, "172.16.0.0/24", instance_id = "i-old")
+        self.ec2.create_route(self.rtbs[2].id, "172.16.0.0/24", instance_id = "i-1")
+        self.ec2.calls.clear()
+
+        _pc_client_rtb(self.session())
+
+        expected = [("172.16.0.0/24", "i-1"), ("172.16.1.0/24", "i-1")]
+        main = [rtb for rtb in self.ec2.route_tables.values() if rtb.associations and rtb.associations[0].main][0]
+        for rtb in self.rtbs + [main]:
+            self.assertEqual(expected, self.routes(rtb))
+
+        self.assertEqual(1, self.ec2.calls["ReplaceRoute"])
+        self.assertEqual(6, self.ec2.calls["CreateRoute"])
+
+        # Rerun is a no-op, besides describing route tables
+        self.ec2.calls.clear()
+        _pc_client_rtb(self.session())
+        self.assertEqual(self.ec2.calls, {"DescribeSubnets": 1, "DescribeRouteTables": 1})
+
+    def test_configured_table_only(self):
+        _pc_client_rtb(self.session(route_all_tables = False))
+        self.assertEqual(2, len(self.routes(self.rtbs[0])))
+        self.assertEqual([], self.routes(self.rtbs[1]))
+
+    def test_route_diff(self):
+        routes = [Obj(destination_cidr_block = cidr, instance_id = iid) for cidr, iid in [
+            ("10.0.0.0/16", None), ("172.16.0.0/24", "i-1"), ("172.16.1.0/24", "i-0"),
+            ("172.16.9.0/24", "i-1")]]
+        self.assertEqual(
+            (["172.16.2.0/24"], ["172.16.1.0/24"], ["172.16.9.0/24"]),
+            _route_diff(routes, {"172.16.0.0/24": "i-1", "172.16.1.0/24": "i-1", "172.16.2.0/24": "i-1"}))
+
+class TestPlan(ClientVPCFixture, unittest.TestCase):
+    def test_plan_world(self):
+        """Plan describes parameters, SG and route changes without mutating AWS"""
+
+        session = self.session()
+        session.update({"tags": {"instavpn": "cafe"}, "params": [("SharedSecret", "s3cr3t")]})
+        session["config"]["server"]["res"] = {"servers_allowed": [
+            {"proto": "tcp", "ip": "172.16.0.5", "port": "443"}]}
+        self.ec2.create_route(self.rtbs[1].id, "172.16.0.0/24", instance_id = "i-old")
+        self.ec2.calls.clear()
+
+        plan = plan_world(session)
+
+        self.assertEqual(set(self.ec2.calls), set(["DescribeSubnets", "DescribeVpcs", "DescribeRouteTables"]))
+        self.assertEqual("instavpn-cafe-client", plan["stacks"]["client"]["name"])
+        self.assertIn(["SharedSecret", "****"], plan["stacks"]["server"]["update"]["parameters"])
+        self.assertIn(["ServerEIP", "<ServerEIP>"], plan["stacks"]["server"]["update"]["parameters"])
+        self.assertEqual(plan["server_sg"], {
+            "revoke": [("-1", None, None, "0.0.0.0/0")],
+            "authorize": [("tcp", 443, 443, "172.16.0.5/32")]})
+        self.assertEqual(plan["client_routes"][self.rtbs[1].id], {
+            "create": ["172.16.1.0/24"], "replace": ["172.16.0.0/24"], "delete": []})
+
+    def test_plan_single_pass(self):
+        session = self.session()
+        session.update({"tags": {"instavpn": "cafe"}, "params": [], "single_pass": True})
+        session["config"]["server"]["res"] = {"servers_allowed": []}
+
+        stacks = plan_world(session)["stacks"]
+
+        self.assertEqual(["<ClientEIP>"], stacks["client"]["allocate"])
+        self.assertEqual("main.json", stacks["client"]["create"]["template"])
+        self.assertIn(["EIPAllocation", "Imported"], stacks["client"]["create"]["parameters"])
+        self.assertNotIn("update", stacks["client"])
+
+class TestUpdate(ClientVPCFixture, unittest.TestCase):
+    """Updating an existing deployment, targeted by task ID"""
+
+    def setUp(self):
+        ClientVPCFixture.setUp(self)
+
+        import lib.actuator
+        from lib.waiter import StackWaiter
+
+        self.clock = FakeClock()
+        self.actuator, self.StackWaiter = lib.actuator, lib.actuator.StackWaiter
+        lib.actuator.StackWaiter = lambda *args, **kwargs: StackWaiter(
+            sleep = self.clock.sleep, clock = self.clock.time, *args, **kwargs)
+
+        self.server_sg = self.ec2.add_security_group(self.vpc)
+        self.client_sg = self.ec2.add_security_group(self.vpc)
+
+        self.cfn = {}
+        for side, MySide, outputs in (
+                ("server", "Server", [("ServerSGId", self.server_sg.id)]),
+                ("client", "Client", [("ClientSGId", self.client_sg.id), ("ClientInstanceId", "i-1")])):
+            cfn = self.cfn[side] = FakeCloudFormation(self.clock, outputs = outputs)
+            cfn.create_stack("instavpn-cafe-%s" % side, template_body = self.template(MySide), parameters = [
+                ("ServerName", "DCS"), ("ClientName", "svc"), ("SharedSecret", "old"),
+                ("ServerEIP", "1.1.1.1"), ("ServerEIPId", "eipalloc-1"),
+                ("ClientEIP", "2.2.2.2"), ("ClientEIPId", "eipalloc-2"), ("MySide", MySide)])
+        self.clock.sleep(60)
+
+    def tearDown(self):
+        self.actuator.StackWaiter = self.StackWaiter
+
+    def template(self, MySide):
+        """main.json as the update compiles it, ie., already up to date"""
+        from lib.io import compile_tpl
+        return compile_tpl("main.json", MySide, None, TEMPLATE_PARAMS)
+
+    def session(self, client_name = "svc"):
+        session = ClientVPCFixture.session(self)
+        session.update({
+            "task_id": "instavpn-cafe-client",
+            "tags": {"instavpn": "cafe"},
+            "params": [("ServerName", "DCS"), ("ClientName", client_name), ("SharedSecret", "new")],
+            "conn": {
+                "server": fake_conn(ec2 = self.ec2, cloudformation = self.cfn["server"]),
+                "client": fake_conn(vpc = self.ec2, cloudformation = self.cfn["client"]),
+            },
+        })
+        session["config"]["server"]["res"] = {"servers_allowed": [
+            {"proto": "tcp", "ip": "172.16.0.5", "port": "443"}]}
+        return session
+
+    def parameters(self, side):
+        return dict((p.key, p.value) for p in self.cfn[side].stacks["instavpn-cafe-%s" % side].parameters)
+
+    def test_in_place(self):
+        """Unchanged parameters skip update_stack, SG and routes are synced in place"""
+
+        build_world(self.session())
+
+        self.assertEqual([0, 0], [cfn.calls["UpdateStack"] for cfn in self.cfn.values()])
+        self.assertEqual([0, 0], [cfn.calls["CreateStack"] - 1 for cfn in self.cfn.values()])
+        self.assertEqual([("tcp", 443, 443, "172.16.0.5/32")], [
+            _sg_rule(r.ip_protocol, r.from_port, r.to_port, r.grants[0].cidr_ip)
+            for r in self.server_sg.rules_egress])
+        self.assertEqual(2, len(self.routes(self.rtbs[0])))
+
+        # Client SG ingress is not authorized twice
+        build_world(self.session())
+        self.assertEqual(1, self.ec2.calls["AuthorizeSecurityGroupIngress"])
+
+    def test_changed_params(self):
+        """Changed parameters update both stacks, keeping EIPs and SharedSecret"""
+
+        build_world(self.session(client_name = "svc2"))
+
+        for side in ("server", "client"):
+            self.assertEqual(1, self.cfn[side].calls["UpdateStack"])
+            self.assertEqual("svc2", self.parameters(side)["ClientName"])
+            self.assertEqual("old", self.parameters(side)["SharedSecret"])
+            self.assertEqual("1.1.1.1", self.parameters(side)["ServerEIP"])
+
+    def test_boot_params_kept(self):
+        """TunnelProfile only applies at boot: updates keep the one the stack has, with a warning"""
+
+        import lib.actuator
+
+        session = self.session()
+        session["params"].append(("TunnelProfile", "Throughput"))
+
+        self.assertEqual({"TunnelProfile": ["Default", "Throughput"]},
+            plan_world(session)["stacks"]["client"]["ignored"])
+
+        shown, output = [], lib.actuator.show.__dict__["output"]
+        lib.actuator.show.output = staticmethod(lambda title = None, msg = None, **kwargs: shown.append((title, msg)))
+        try:
+            build_world(session)
+        finally:
+            lib.actuator.show.output = output
+
+        self.assertEqual([0, 0], [cfn.calls["UpdateStack"] for cfn in self.cfn.values()])
+        self.assertNotIn("TunnelProfile", self.parameters("client"))
+        self.assertEqual(["instavpn-cafe-client", "instavpn-cafe-server"], sorted(
+            msg.split(" on ")[1].split(",")[0] for title, msg in shown if "Not applied" == title))
+
+    def test_template_pushed(self):
+        """Stacks built from an older main.json are updated, parameters unchanged"""
+
+        for cfn in self.cfn.values():
+            cfn.stacks.values()[0].template = "{}"
+
+        self.assertEqual({"template": ["previous", "main.json"]},
+            plan_world(self.session())["stacks"]["client"]["update"]["changed"])
+
+        build_world(self.session())
+        self.assertEqual([1, 1], [cfn.calls["UpdateStack"] for cfn in self.cfn.values()])
+        self.assertEqual("old", self.parameters("client")["SharedSecret"])
+
+        build_world(self.session())
+        self.assertEqual([1, 1], [cfn.calls["UpdateStack"] for cfn in self.cfn.values()])
+
+    def test_rotate_psk(self):
+        """Parameter-only update on both stacks, with the same new secret"""
+
+        rotate_psk(self.session())
+
+        server, client = self.parameters("server"), self.parameters("client")
+        self.assertNotEqual("old", server["SharedSecret"])
+        self.assertEqual(server["SharedSecret"], client["SharedSecret"])
+        self.assertEqual(("svc", "1.1.1.1", "Client"),
+            (client["ClientName"], client["ServerEIP"], client["MySide"]))
+        self.assertEqual([1, 1], [cfn.calls["UpdateStack"] for cfn in self.cfn.values()])
+
+    def test_rotate_psk_before_cfn_hup(self):
+        """Stacks without the cfn-hup hook are refused, until -t pushes the template"""
+
+        for cfn in self.cfn.values():
+            cfn.stacks.values()[0].template = "{}"
+
+        self.assertRaisesRegexp(Exception, "update it with -t first", rotate_psk, self.session())
+        self.assertEqual([0, 0], [cfn.calls["UpdateStack"] for cfn in self.cfn.values()])
+
+        build_world(self.session())
+        self.assertEqual([1, 1], [cfn.calls["UpdateStack"] for cfn in self.cfn.values()])
+        self.assertEqual("old", self.parameters("client")["SharedSecret"])
+
+        rotate_psk(self.session())
+        self.assertNotEqual("old", self.parameters("client")["SharedSecret"])
+
+    def test_rotate_psk_failed(self):
+        """A side that failed is rolled back, and the other one gets its previous secret back"""
+
+        self.cfn["server"].fail_at = "Resource"
+
+        self.assertRaisesRegexp(Exception, "PSK rotation failed on instavpn-cafe-server", rotate_psk, self.session())
+        self.assertEqual(["old", "old"], [self.parameters(side)["SharedSecret"] for side in ("server", "client")])
+        self.assertEqual(2, self.cfn["client"].calls["UpdateStack"])
+
+    def test_traced(self):
+        """Actuator phases show up in traces"""
+        from lib import trace
+
+        trace.enable()
+        try:
+            build_world(self.session(client_name = "svc2"))
+        finally:
+            trace.disable()
+
+        names = set(s["name"] for s in trace.summary()["spans"])
+        self.assertTrue(set(["build_world", "cfn_update", "wait_cfn", "post_conf",
+            "_pc_server_sg", "_pc_client_rtb", "apply_routes"]) <= names)
+
+    def test_single_pass_failed(self):
+        """Stacks are deleted and EIPs released when a side fails"""
+
+        session = self.session()
+        session.update({"task_id": None, "tags": {"instavpn": "beef"}, "single_pass": True})
+        session["conn"]["client"] = fake_conn(vpc = self.ec2, ec2 = self.ec2,
+            cloudformation = self.cfn["client"])
+        self.cfn["client"].fail_at = "Resource"
+
+        # The server EIP stays in use until its stack is deleted, minutes later
+        server = self.cfn["server"]
+        server.delete_seconds = 300
+        self.ec2.in_use = lambda allocation_id: server.exists("instavpn-beef-server") and \
+            ("ServerEIPId", allocation_id) in [(p.key, p.value) for p in server.stacks["instavpn-beef-server"].parameters]
+
+        started = self.clock.now
+        self.assertRaises(Exception, build_world, session)
+
+        self.assertEqual(2, self.ec2.calls["AllocateAddress"])
+        self.assertEqual({}, self.ec2.addresses)
+        self.assertEqual(2, self.ec2.calls["ReleaseAddress"])
+        self.assertGreaterEqual(self.clock.now - started, 300)
+        self.assertNotIn("instavpn-beef-server", self.cfn["server"].stacks)
+        self.assertIn("EIPAllocation", [p.key for p in self.cfn["client"].stacks["instavpn-beef-client"].parameters])
+
+    def shards(self, session):
+        session["params"].append(("ServerSharedCIDRs", "172.16.0.0/24 172.16.1.0/24"))
+        session["shards"] = [
+            {"cidrs": ["172.16.0.0/24"], "servers_allowed": [{"proto": "tcp", "ip": "172.16.0.5", "port": "443"}]},
+            {"cidrs": ["172.16.1.0/24"], "servers_allowed": [{"proto": "udp", "ip": "172.16.1.5", "port": "53"}]}]
+        return session
+
+    def test_tunnel_failed(self):
+        """A new deployment keeps no stack or EIP of the tunnels that made it when one fails"""
+
+        session = self.shards(self.session())
+        session.update({"task_id": None, "tags": {"instavpn": "beef"}, "single_pass": True})
+        session["conn"]["client"] = fake_conn(vpc = self.ec2, ec2 = self.ec2,
+            cloudformation = self.cfn["client"])
+        self.cfn["client"].fail_at, self.cfn["client"].fail_stack = "Resource", "instavpn-beef-client-2"
+
+        self.assertRaises(Exception, build_world, session)
+
+        self.assertEqual(4, self.ec2.calls["AllocateAddress"])
+        self.assertEqual({}, self.ec2.addresses)
+        self.assertEqual(["instavpn-cafe-server"], sorted(self.cfn["server"].stacks))
+        self.assertEqual(["instavpn-beef-client-2", "instavpn-cafe-client"], sorted(self.cfn["client"].stacks))
+
+    def test_tunnel_failed_update(self):
+        """An existing deployment keeps its stacks when a tunnel fails, and says so"""
+
+        import lib.actuator
+
+        session = self.shards(self.session())
+        self.cfn["client"].fail_at, self.cfn["client"].fail_stack = "Resource", "instavpn-cafe-client-2"
+
+        shown, error = [], lib.actuator.show.__dict__["error"]
+        lib.actuator.show.error = staticmethod(lambda title = None, msg = None, **kwargs: shown.append((title, msg)))
+        try:
+            self.assertRaises(Exception, build_world, session)
+        finally:
+            lib.actuator.show.error = error
+
+        # The new tunnel's server stack is deleted with its failed client one
+        self.assertEqual(["instavpn-cafe-server"], sorted(self.cfn["server"].stacks))
+        left, = [msg for title, msg in shown if "Stacks left in place" == title]
+        self.assertTrue(left.startswith("instavpn-cafe-client, instavpn-cafe-client-2, instavpn-cafe-server;"))
+        self.assertEqual(0, self.ec2.calls.get("ReplaceRoute", 0) + self.ec2.calls.get("CreateRoute", 0))
+
+    def test_tunnel_added(self):
+        """A second tunnel gets its own stacks, its shard of servers and routes"""
+
+        sgs = {"ServerSGId": self.ec2.add_security_group(self.vpc).id,
+            "ClientSGId": self.ec2.add_security_group(self.vpc).id}
+        values = dict(sgs, ServerEIP = "3.3.3.3", ServerEIPId = "eipalloc-3",
+            ClientEIP = "4.4.4.4", ClientEIPId = "eipalloc-4", ClientInstanceId = "i-2", ServerInstanceId = "i-3")
+        first = {"ServerSGId": self.server_sg.id, "ClientSGId": self.client_sg.id, "ClientInstanceId": "i-1"}
+        for cfn in self.cfn.values():
+            cfn.outputs = lambda stack, keys: [(k, (values if stack.stack_name.endswith("-2") else
+                dict(values, **first))[k]) for k in keys]
+
+        session = self.shards(self.session())
+
+        plan = plan_world(session)
+        self.assertEqual("instavpn-cafe-client-2", plan["tunnels"][0]["stacks"]["client"]["name"])
+        self.assertEqual(["172.16.1.0/24"], plan["tunnels"][0]["server_cidrs"])
+        self.assertEqual({"create": ["172.16.0.0/24", "172.16.1.0/24"], "replace": [], "delete": []},
+            plan["client_routes"][self.rtbs[0].id])
+
+        build_world(session)
+
+        stack = self.cfn["server"].stacks["instavpn-cafe-server-2"]
+        self.assertEqual("172.16.1.0/24", dict((p.key, p.value) for p in stack.parameters)["ServerSharedCIDRs"])
+        self.assertEqual("172.16.0.0/24", self.parameters("server")["ServerSharedCIDRs"])
+        self.assertEqual([("172.16.0.0/24", "i-1"), ("172.16.1.0/24", "i-2")], self.routes(self.rtbs[0]))
+        self.assertEqual([("udp", 53, 53, "172.16.1.5/32")], [
+            _sg_rule(r.ip_protocol, r.from_port, r.to_port, r.grants[0].cidr_ip)
+            for r in self.ec2.sgs[sgs["ServerSGId"]].rules_egress])
+        self.assertEqual([("tcp", 443, 443, "172.16.0.5/32")], [
+            _sg_rule(r.ip_protocol, r.from_port, r.to_port, r.grants[0].cidr_ip)
+            for r in self.server_sg.rules_egress])
+
+    def test_standby_added(self):
+        """`ha` adds a standby pair with the monitor; routes stay on the active
+        pair, or on the standby one once failed over, and both clients are tagged"""
+
+        servers = [self.ec2.add_instance("10.0.0.10"), self.ec2.add_instance("10.0.0.20")]
+        clients = [self.ec2.add_instance("10.0.1.10"), self.ec2.add_instance("10.0.1.20")]
+        self.cfn["server"].stacks["instavpn-cafe-server"].outputs.append(
+            Output("ServerInstanceId", servers[0].id))
+        self.cfn["client"].stacks["instavpn-cafe-client"].outputs = [
+            Output("ClientSGId", self.client_sg.id), Output("ClientInstanceId", clients[0].id)]
+
+        values = {"ServerSGId": self.ec2.add_security_group(self.vpc).id,
+            "ClientSGId": self.ec2.add_security_group(self.vpc).id,
+            "ServerEIP": "3.3.3.3", "ServerEIPId": "eipalloc-3", "ClientEIP": "4.4.4.4", "ClientEIPId": "eipalloc-4",
+            "ServerInstanceId": servers[1].id, "ClientInstanceId": clients[1].id}
+        for cfn in self.cfn.values():
+            cfn.outputs = lambda stack, keys: [(k, values[k]) for k in keys]
+
+        session = self.session()
+        session["config"]["ha"] = True
+
+        plan = plan_world(session)
+        self.assertEqual("instavpn-cafe-client-standby", plan["tunnels"][0]["stacks"]["client"]["name"])
+        self.assertTrue(plan["tunnels"][0]["standby"])
+        self.assertIn(["HealthMonitor", "Enabled"], plan["tunnels"][0]["stacks"]["client"]["update"]["parameters"])
+        self.assertEqual({"create": ["172.16.0.0/24", "172.16.1.0/24"], "replace": [], "delete": []},
+            plan["client_routes"][self.rtbs[0].id])
+
+        build_world(session)
+
+        standby = self.cfn["client"].stacks["instavpn-cafe-client-standby"]
+        self.assertEqual("Enabled", dict((p.key, p.value) for p in standby.parameters)["HealthMonitor"])
+        self.assertIn("ClientMonitorProfile", standby.template)
+        self.assertNotIn("HealthMonitor", self.parameters("client"))
+        self.assertEqual([("172.16.0.0/24", clients[0].id), ("172.16.1.0/24", clients[0].id)],
+            self.routes(self.rtbs[0]))
+        self.assertEqual({"instavpn:monitor": "%s 10.0.0.10" % clients[1].id}, self.ec2.tags[clients[0].id])
+        self.assertEqual({"instavpn:monitor": "%s 10.0.0.20" % clients[0].id}, self.ec2.tags[clients[1].id])
+
+        # Routes the monitor failed over are left to the standby client
+        self.ec2.replace_route(self.rtbs[0].id, "172.16.0.0/24", instance_id = clients[1].id)
+        build_world(session)
+        self.assertEqual([("172.16.0.0/24", clients[1].id), ("172.16.1.0/24", clients[0].id)],
+            self.routes(self.rtbs[0]))
+
+    def test_plan(self):
+        plan = plan_world(self.session(client_name = "svc2"))
+
+        self.assertEqual({"ClientName": ["svc", "svc2"]}, plan["stacks"]["client"]["update"]["changed"])
+        self.assertEqual(plan["server_sg"]["revoke"], [("-1", None, None, "0.0.0.0/0")])
+        self.assertEqual(plan["client_sg"]["authorize"], [("-1", None, None, "10.0.0.0/16")])
+        self.assertEqual([0, 0], [cfn.calls["UpdateStack"] for cfn in self.cfn.values()])
+
+        self.assertEqual(None, plan_world(self.session())["stacks"]["server"]["update"])
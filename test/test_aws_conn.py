@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+import lib.retry
+from lib.aws_conn import AWSConn, identity_account
+
+class FakeCredentials(object):
+    def __init__(self, n, expiration):
+        self.access_key = "access-%d" % n
+        self.secret_key = "secret"
+        self.session_token = "token"
+        self.expiration = expiration
+
+class FakeSTS(object):
+    def __init__(self):
+        self.calls = 0
+
+    def assume_role(self, role_arn, role_session_name):
+        self.calls += 1
+        ret = FakeCredentials(self.calls, "1970-01-01T01:00:00Z") # 3600
+        return type("AssumedRole", (object,), {"credentials": ret})
+
+class TestAWSConn(unittest.TestCase):
+    def setUp(self):
+        self.sts, self.now, self.built = FakeSTS(), 0, []
+
+        def _connect(conn, service, cred):
+            if "sts" == service:
+                return self.sts
+            self.built.append((service, cred.get("access")))
+            return object()
+
+        self._orig = AWSConn._connect, AWSConn._clock
+        AWSConn._connect = _connect
+        AWSConn._clock = staticmethod(lambda: self.now)
+        AWSConn.clear()
+
+        self.identity = {
+            "region": "us-east-1",
+            "role_arn": "arn:aws:iam::123456789012:role/vpn",
+            "cred": {"access": "a", "secret": "s", "session": None}
+        }
+
+    def tearDown(self):
+        AWSConn._connect, AWSConn._clock = self._orig
+        AWSConn.clear()
+
+    def test_role_shared_across_services_and_threads(self):
+        """One assume_role per identity, one connection per service"""
+
+        conns = []
+        def _use():
+            conn = AWSConn(dict(self.identity), "cafe")
+            conns.extend([conn("ec2"), conn("vpc"), conn("cloudformation")])
+
+        threads = [threading.Thread(target=_use) for _ in range(8)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        self.assertEqual(1, self.sts.calls)
+        self.assertEqual(3, len(self.built))
+        self.assertEqual(3, len(set(id(c) for c in conns)))
+
+    def test_refresh_before_expiry(self):
+        """Credentials and connections are renewed ahead of expiry"""
+
+        conn = AWSConn(self.identity, "cafe")
+        first = conn("ec2")
+
+        self.now = 3000
+        self.assertIs(first, conn("ec2"))
+        self.assertEqual(1, self.sts.calls)
+
+        self.now = 3400
+        self.assertIsNot(first, conn("ec2"))
+        self.assertEqual(2, self.sts.calls)
+        self.assertEqual(("ec2", "access-2"), self.built[-1])
+
+    def test_unparsed_expiration(self):
+        """Expiration boto can't parse is taken as the shortest session, on the same clock"""
+        from lib.aws_conn import _parse_expiration
+
+        self.now = 5000
+        self.assertEqual(5900, _parse_expiration(None))
+        self.assertEqual(1388534400, _parse_expiration("2014-01-01T00:00:00Z"))
+
+    def test_identity_account(self):
+        self.assertEqual("123456789012", identity_account(self.identity))
+        self.assertEqual("a", identity_account(dict(self.identity, role_arn=None)))
+
+class RaisingConn(object):
+    """boto connection raising RequestLimitExceeded `failures` times"""
+
+    def __init__(self, failures, status = 503, code = "RequestLimitExceeded"):
+        self.failures, self.status, self.code = failures, status, code
+        self.requests = 0
+        self.num_retries = 6
+
+    def make_request(self, action, *args, **kwargs):
+        from boto.exception import BotoServerError
+
+        self.requests += 1
+        if self.requests <= self.failures:
+            raise BotoServerError(self.status, "Service Unavailable", "<Response><Errors><Error>"
+                "<Code>%s</Code><Message>Request limit exceeded.</Message></Error></Errors></Response>" % self.code)
+        return "ok"
+
+class TestRaisedErrors(unittest.TestCase):
+    """Errors boto raises instead of returning, eg., EC2 throttling after boto's own retries"""
+
+    def setUp(self):
+        self.sleeps = []
+        self._orig = AWSConn._connect, AWSConn.retry_policy
+        AWSConn.retry_policy = lib.retry.RetryPolicy(sleep = self.sleeps.append, rand = lambda: 1)
+        AWSConn.clear()
+        lib.retry._buckets.clear()
+
+        self.identity = {"region": "us-east-1", "role_arn": None,
+            "cred": {"access": "raising", "secret": "s", "session": None}}
+
+    def tearDown(self):
+        AWSConn._connect, AWSConn.retry_policy = self._orig
+        AWSConn.clear()
+        lib.retry._buckets.clear()
+
+    def connect(self, fake):
+        AWSConn.clear()
+        AWSConn._connect = lambda conn, service, cred: fake
+        return AWSConn(self.identity)("ec2")
+
+    def test_throttling_retried(self):
+        """Raised throttling halves the bucket, backs off, and is retried"""
+
+        fake = RaisingConn(2)
+        self.assertEqual("ok", self.connect(fake).make_request("DescribeRouteTables"))
+
+        self.assertEqual(3, fake.requests)
+        self.assertEqual([0.5, 1.0], self.sleeps)
+        self.assertLess(lib.retry.bucket("raising", "us-east-1").rate, lib.retry.DEFAULT_RATE)
+
+    def test_reraised(self):
+        """Raised once attempts run out, or right away when not retryable"""
+        from boto.exception import BotoServerError
+
+        fake = RaisingConn(100)
+        self.assertRaises(BotoServerError, self.connect(fake).make_request, "DescribeRouteTables")
+        self.assertEqual(AWSConn.retry_policy.max_attempts, fake.requests)
+
+        fake = RaisingConn(100, status = 400, code = "InvalidRouteTableID.NotFound")
+        self.assertRaises(BotoServerError, self.connect(fake).make_request, "DescribeRouteTables")
+        self.assertEqual(1, fake.requests)
+
+    def test_boto_retries_off(self):
+        """Every retry is made here, through the token bucket"""
+
+        fake = RaisingConn(0)
+        self.connect(fake)
+        self.assertEqual(0, fake.num_retries)
+
+    def test_server_errors_idempotent_only(self):
+        """Server errors are retried for reads and client-token writes; throttling for any call"""
+        from boto.exception import BotoServerError
+
+        for action, params, requests in (("DescribeStacks", {}, 2), ("CreateStack", {}, 1),
+                ("RunInstances", {"ClientToken": "t"}, 2)):
+            fake = RaisingConn(1, code = "ServiceUnavailable")
+            conn = self.connect(fake)
+            try:
+                conn.make_request(action, params)
+            except BotoServerError:
+                pass
+            self.assertEqual(requests, fake.requests, action)
+
+        fake = RaisingConn(1)
+        self.assertEqual("ok", self.connect(fake).make_request("CreateStack", {}))
+        self.assertEqual(2, fake.requests)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import lib.bake
+from lib.aws_conn import AWSConn
+from lib.bake import bake, bake_image, baked_image, BUILD_SCRIPT
+from lib.io import load_tpl
+
+from fake_aws import FakeClock, FakeEC2, StandIn
+
+STOCK = load_tpl("main.json")["Mappings"]["AWSRegionArch2AMI"]
+
+class TestBakeImage(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.ec2 = FakeEC2(self.clock)
+
+    def bake_image(self, **kwargs):
+        return bake_image(self.ec2, "us-east-1", "64HVM", "subnet-1",
+            sleep = self.clock.sleep, clock = self.clock.time, **kwargs)
+
+    def test_baked(self):
+        """An image of the stopped builder, which is then terminated"""
+
+        ami = self.bake_image()
+
+        builder, = self.ec2.instances.values()
+        self.assertEqual(STOCK["us-east-1"]["64HVM"], builder.image_id)
+        self.assertEqual(BUILD_SCRIPT, builder.user_data)
+        self.assertEqual(builder.id, self.ec2.images[ami].instance_id)
+        self.assertGreaterEqual(self.ec2.images[ami].created, self.ec2.stop_seconds)
+        self.assertTrue(builder.terminated)
+
+    def test_timeout(self):
+        """A builder that never stops is terminated, without an image"""
+
+        self.ec2.stop_seconds = 3600
+        with self.assertRaises(Exception):
+            self.bake_image(timeout = 900)
+
+        self.assertEqual({}, self.ec2.images)
+        self.assertTrue(all(i.terminated for i in self.ec2.instances.values()))
+
+class TestBake(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.ec2 = {}
+        self.saved = []
+
+        def _connect(conn, service, cred):
+            region = conn.identity["region"]
+            return StandIn(self.ec2.setdefault(region, FakeEC2(self.clock)), self.clock)
+
+        self.patched = [(AWSConn, "_connect", _connect),
+            (lib.bake, "baked_amis", lambda: {"default": {"eu-west-1": {"64": "ami-0old0000"}}}),
+            (lib.bake, "save_config", lambda name, data: self.saved.append((name, data)))]
+        self.restore = [(obj, name, obj.__dict__[name]) for obj, name, _ in self.patched]
+        for obj, name, value in self.patched:
+            setattr(obj, name, value)
+        AWSConn.clear()
+
+    def tearDown(self):
+        for obj, name, value in self.restore:
+            setattr(obj, name, value)
+        AWSConn.clear()
+
+    def test_bake(self):
+        """One builder per account and region, new images merged into the saved ones"""
+
+        identity = lambda region: {"region": region, "role_arn": None, "cred": {}}
+        baked, errors = bake([(identity("us-east-1"), "subnet-1"), (identity("us-east-1"), "subnet-2"),
+            (identity("eu-west-1"), "subnet-3")], sleep = self.clock.sleep, clock = self.clock.time, interval = 60)
+
+        self.assertEqual({}, errors)
+        self.assertEqual(["eu-west-1", "us-east-1"], sorted(baked["default"]))
+        self.assertEqual([1, 1], [len(ec2.instances) for ec2 in self.ec2.values()])
+
+        (name, amis), = self.saved
+        self.assertEqual(lib.bake.BAKED_AMI, name)
+        self.assertEqual("ami-0old0000", amis["default"]["eu-west-1"]["64"])
+        self.assertEqual(baked["default"]["eu-west-1"]["64HVM"], amis["default"]["eu-west-1"]["64HVM"])
+
+    def test_baked_image(self):
+        amis = {"123456789012": {"us-east-1": {"64HVM": "ami-0bake000"}}}
+        identity = {"region": "us-east-1", "role_arn": "arn:aws:iam::123456789012:role/instavpn"}
+
+        self.assertEqual("ami-0bake000", baked_image(identity, "t2.micro", amis))
+        self.assertIsNone(baked_image(identity, "m1.small", amis))
+        self.assertIsNone(baked_image(dict(identity, region = "us-west-2"), "t2.micro", amis))
+        self.assertIsNone(baked_image(identity, "x9.unknown", amis))
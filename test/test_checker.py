@@ -4,6 +4,16 @@ import unittest
 from lib.checker import *
 
 class TestChecker(unittest.TestCase):
+    def test_rule_01_set_job_id(self):
+        """Task ID is taken from session, either as ID or stack name"""
+
+        for task_id in ("cafe1234", "instavpn-cafe1234-server"):
+            session = {"config": {"tags": {}}, "task_id": task_id}
+            self.assertTrue(rule_01_set_job_id(session))
+            self.assertEqual("cafe1234", session["config"]["tags"]["instavpn"])
+
+        self.assertRaises(Exception, rule_01_set_job_id, {"config": {"tags": {}}, "task_id": "vpn-1"})
+
     def test_rule_60_all_server_routable(self):
         """"""
 
@@ -34,3 +44,152 @@ class TestChecker(unittest.TestCase):
                 ['10.0.0.0/8'],
                 ['10.0.0.0', '10.255.254.255', '172.19.20.20']
             ))
+
+        self.assertRaisesRegexp(
+            Exception, r"Unreachable server 9\.0\.0\.1, 172\.19\.20\.20 detected", fp,
+            session(
+                ['10.0.0.0/8', '10.1.0.0/16'],
+                ['9.0.0.1', '10.1.2.3', '172.19.20.20']
+            ))
+
+    def test_rule_60_rtb_route_compatible(self):
+        """Routes to server subnets through an instance are replaced, not through a gateway"""
+        from lib.resources import SideResources
+        from fake_aws import FakeEC2
+
+        ec2 = FakeEC2()
+        vpc = ec2.add_vpc("10.0.0.0/16")
+        subnet = ec2.add_subnet(vpc, "10.0.1.0/24")
+        rtb = ec2.add_route_table(vpc, [subnet.id])
+        ec2.create_route(rtb.id, "172.16.0.0/24", instance_id = "i-old")
+        ec2.create_route(rtb.id, "0.0.0.0/0", gateway_id = "igw-1")
+
+        def session(route_all_tables):
+            return {"cache": {"client": SideResources(lambda service: ec2, subnet.id)},
+                "config": {"server": {"ipsec": {"subnets": ["172.16.0.0/24", "172.16.1.0/24"]}},
+                    "client": {"res": {"route_table_id": rtb.id, "route_all_tables": route_all_tables}}}}
+
+        self.assertTrue(rule_60_rtb_route_compatible(session(True)))
+
+        main, = [r for r in ec2.route_tables.values() if r.vpc_id == vpc.id and r.associations[0].main]
+        ec2.create_route(main.id, "172.16.1.0/24", gateway_id = "vgw-1")
+        self.assertTrue(rule_60_rtb_route_compatible(session(False)))
+        self.assertRaisesRegexp(Exception, r"Route to 172\.16\.1\.0/24 in %s not through an instance" % main.id,
+            rule_60_rtb_route_compatible, session(True))
+
+    def test_rule_70_shard_tunnels(self):
+        """`ha` takes a single tunnel, the one pinging the server instance"""
+
+        def session(tunnels, ha):
+            return {"config": {"tunnels": tunnels, "ha": ha, "server": {
+                "ipsec": {"subnets": ["10.0.0.0/24", "10.1.0.0/24"]},
+                "res": {"servers_allowed": [{"proto": "tcp", "ip": "10.1.0.5", "port": "443"}]}}}}
+
+        self.assertTrue(rule_70_shard_tunnels(session(2, False)))
+        self.assertTrue(rule_70_shard_tunnels(session(1, True)))
+        self.assertRaisesRegexp(Exception, "ha with 2 tunnels", rule_70_shard_tunnels, session(2, True))
+
+class TestChkSession(unittest.TestCase):
+    def setUp(self):
+        import lib.checker
+        self.module, self._rules = lib.checker, lib.checker.rules
+        self.log = []
+
+    def tearDown(self):
+        self.module.rules = self._rules
+
+    def make_rules(self, failing=()):
+        import time as _time
+
+        def _fn(name, seconds=0):
+            def _rule(session):
+                self.log.append(("start", name))
+                _time.sleep(seconds)
+                self.log.append(("end", name))
+                return name not in failing
+            return _rule
+
+        return [
+            ("rule_00_offline", rule()(_fn("rule_00_offline"))),
+            ("rule_40_aws_a", rule(depends=["rule_00_offline"], cost=AWS)(_fn("rule_40_aws_a", 0.1))),
+            ("rule_40_aws_b", rule(depends=["rule_00_offline"], cost=AWS)(_fn("rule_40_aws_b", 0.1))),
+            ("rule_60_offline", rule(depends=["rule_40_aws_a"])(_fn("rule_60_offline"))),
+            ("rule_70_offline", rule(depends=["rule_00_offline"])(_fn("rule_70_offline"))),
+            ("rule_80_legacy", _fn("rule_80_legacy")),
+        ]
+
+    def test_order(self):
+        """Offline rules first, ready AWS rules concurrently, legacy rules last"""
+
+        self.module.rules = self.make_rules()
+        session = {}
+        self.assertTrue(chk_session(session))
+
+        self.assertEqual(self.log[:4], [
+            ("start", "rule_00_offline"), ("end", "rule_00_offline"),
+            ("start", "rule_70_offline"), ("end", "rule_70_offline")])
+        self.assertEqual(set(self.log[4:6]), set([("start", "rule_40_aws_a"), ("start", "rule_40_aws_b")]))
+        self.assertEqual(self.log[-2:], [("start", "rule_80_legacy"), ("end", "rule_80_legacy")])
+        self.assertEqual(6, len(session["timings"]))
+
+    def test_fail_fast(self):
+        """AWS rules are skipped when an offline rule fails"""
+
+        self.module.rules = self.make_rules(failing=["rule_70_offline"])
+        self.assertFalse(chk_session({}))
+        self.assertNotIn(("start", "rule_40_aws_a"), self.log)
+
+class TestCidr(unittest.TestCase):
+    def test_cidr_range(self):
+        from lib.cidr import cidr_range
+        self.assertEqual((0xac100000, 0xac1fffff), cidr_range("172.16/12"))
+        self.assertEqual((0x0a000000, 0x0affffff), cidr_range("10.1.2.3/8"))
+        self.assertEqual((0x0a010203, 0x0a010203), cidr_range("10.1.2.3/32"))
+        self.assertRaises(ValueError, cidr_range, "10.0.0.256/24")
+
+    def test_find_conflicts(self):
+        """Same pairs as comparing every CIDR against every earlier one, with iptools"""
+        import random
+        from iptools import IpRange
+        from lib.cidr import find_conflicts
+
+        def overlaps(cidr1, cidr2):
+            ir1, ir2 = IpRange(cidr1), IpRange(cidr2)
+            return ir1.startIp <= ir2.endIp and ir2.startIp <= ir1.endIp
+
+        rnd = random.Random(7)
+        cidrs = ["10.%d.%d.0/%d" % (rnd.randint(0, 3), rnd.randint(0, 255), rnd.randint(14, 26))
+            for _ in range(200)]
+
+        expected = [(cidr, against) for i, cidr in enumerate(cidrs) for against in cidrs[:i]
+            if overlaps(cidr, against)]
+
+        self.assertTrue(expected)
+        self.assertEqual(expected, find_conflicts(cidrs))
+
+    def test_cidr_index(self):
+        """Covering CIDR, nested ones fold into the outermost"""
+        from lib.cidr import CidrIndex
+
+        index = CidrIndex(["10.1.0.0/16", "10.0.0.0/8", "192.168.1.0/24", "172.16/12"])
+        self.assertEqual("10.0.0.0/8", index.covering("10.1.2.3"))
+        self.assertEqual("10.0.0.0/8", index.covering("10.255.255.255"))
+        self.assertEqual("172.16/12", index.covering("172.31.0.1"))
+        self.assertEqual("192.168.1.0/24", index.covering("192.168.1.0"))
+        self.assertIsNone(index.covering("192.168.2.0"))
+        self.assertIsNone(index.covering("9.255.255.255"))
+        self.assertIsNone(CidrIndex([]).covering("10.0.0.1"))
+
+    def test_rule_60_subnet_cidr_conflict(self):
+        """Reports every conflicting pair"""
+
+        def session(client, server):
+            return {"config": {"client": {"ipsec": {"subnets": client}},
+                "server": {"ipsec": {"subnets": server}}}}
+
+        fp = rule_60_subnet_cidr_conflict
+
+        self.assertTrue(fp(session(["10.0.0.0/16"], ["10.1.0.0/16", "172.16/12"])))
+        self.assertRaisesRegexp(
+            Exception, r"\(10\.0\.1\.0/24, 10\.0\.0\.0/16\), \(172\.16\.0\.0/24, 172\.16/12\)", fp,
+            session(["10.0.0.0/16", "172.16/12"], ["10.0.1.0/24", "172.16.0.0/24"]))
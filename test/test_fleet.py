@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+import lib.fleet
+from lib.fleet import run_fleet
+
+def config(account, region="us-east-1"):
+    identity = {"region": region, "role_arn": "arn:aws:iam::%s:role/vpn" % account, "cred": {}}
+    return {"server": {"identity": identity}, "client": {"identity": identity}}
+
+class TestFleet(unittest.TestCase):
+    def setUp(self):
+        self.running, self.peak = {}, {}
+        self.lock = threading.Lock()
+        self._orig = lib.fleet.chk_session, lib.fleet.build_world
+
+        def _chk(session):
+            session["config"]["tags"] = {"instavpn": "cafe"}
+            return "bad" not in session["config"]
+
+        def _build(session):
+            account = session["config"]["server"]["identity"]["role_arn"]
+            with self.lock:
+                self.running[account] = self.running.get(account, 0) + 1
+                self.peak[account] = max(self.peak.get(account, 0), self.running[account])
+            time.sleep(0.05)
+            with self.lock:
+                self.running[account] -= 1
+
+        lib.fleet.chk_session, lib.fleet.build_world = _chk, _build
+
+    def tearDown(self):
+        lib.fleet.chk_session, lib.fleet.build_world = self._orig
+
+    def test_run_fleet(self):
+        """Caps concurrency per account, reports every job"""
+
+        jobs = [("a%d" % i, config("111111111111")) for i in range(6)] + \
+            [("b%d" % i, config("222222222222")) for i in range(6)]
+        bad = config("111111111111")
+        bad["bad"] = True
+        jobs.append(("bad", bad))
+
+        report = run_fleet(jobs, {"jobs": 8, "per_account": 2, "per_region": 4})
+
+        self.assertEqual([r["name"] for r in report], [name for name, _ in jobs])
+        self.assertEqual(12, len([r for r in report if "built" == r["status"]]))
+        self.assertEqual("check_failed", report[-1]["status"])
+        self.assertEqual(2, max(self.peak.values()))
+
+    def test_manifest_without_configs(self):
+        """The error names the manifest"""
+        import os, tempfile
+        from lib.fleet import load_manifest
+
+        fd, filename = tempfile.mkstemp(suffix = ".json")
+        try:
+            os.write(fd, '{"per_account": 2}')
+            os.close(fd)
+            self.assertRaisesRegexp(ValueError, "`%s` should be a list of configs" % filename,
+                load_manifest, filename)
+        finally:
+            os.remove(filename)
+
+    def test_confirm(self):
+        """Nothing is built when the fleet is not confirmed"""
+
+        report = run_fleet([("a", config("1"))],
+            {"jobs": 1, "per_account": 1, "per_region": 1}, confirm=lambda n: False)
+        self.assertEqual("skipped", report[0]["status"])
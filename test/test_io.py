@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+from lib.io import compile_tpl, load_tpl
+from lib.io import _nodes
+
+KNOWN = {"EIPAllocation": "Stack", "BakedImageId": "", "TunnelProfile": "Default",
+    "HealthMonitor": "Disabled"}
+
+def render(node):
+    """Text of a resolved Fn::Join or Fn::Base64, with Refs as <Name>"""
+    if isinstance(node, basestring):
+        return node
+    if "Ref" in node:
+        return "<%s>" % node["Ref"]
+    if "Fn::Base64" in node:
+        return render(node["Fn::Base64"])
+    separator, parts = node["Fn::Join"]
+    return separator.join(render(part) for part in parts)
+
+class TestCompileTpl(unittest.TestCase):
+    def refs(self, tpl):
+        return set(node["Ref"] for node in _nodes(tpl) if "Ref" in node)
+
+    def test_pruned_to_side(self):
+        """Only resources and outputs of one side, with every Ref still resolvable"""
+
+        for MySide in ("Server", "Client"):
+            tpl = json.loads(compile_tpl("main.json", MySide, "us-east-1", KNOWN))
+
+            self.assertTrue(all(name.startswith(MySide) for name in tpl["Resources"]))
+            self.assertTrue(all(name.startswith(MySide) for name in tpl["Outputs"]))
+            self.assertNotIn("Conditions", tpl)
+            self.assertEqual({"us-east-1"}, set(tpl["Mappings"]["AWSRegionArch2AMI"]))
+
+            declared = set(tpl["Parameters"]) | set(tpl["Resources"])
+            self.assertEqual(set(), set(r for r in self.refs(tpl) if not r.startswith("AWS::")) - declared)
+
+    def test_imported_eip(self):
+        """EIPs allocated beforehand leave the DummyEIP out, unknown parameters keep it conditional"""
+
+        tpl = json.loads(compile_tpl("main.json", "Server", "us-east-1",
+            dict(KNOWN, EIPAllocation = "Imported")))
+        self.assertNotIn("ServerDummyEIP", tpl["Resources"])
+        self.assertIn("ServerEIPAssoc", tpl["Resources"])
+        self.assertNotIn("Conditions", tpl)
+
+        tpl = json.loads(compile_tpl("main.json", "Server", "us-east-1"))
+        self.assertEqual("ServerAllocatesEIP", tpl["Resources"]["ServerDummyEIP"]["Condition"])
+        self.assertNotIn("Condition", tpl["Resources"]["ServerVPN"])
+        self.assertIn("Conditions", tpl)
+
+    def test_baked_image(self):
+        """A baked image replaces the stock AMI, and the UserData only configures"""
+
+        def user_data(tpl):
+            return json.dumps(tpl["Resources"]["ClientVPN"]["Properties"]["UserData"])
+
+        stock = json.loads(compile_tpl("main.json", "Client", "us-east-1", KNOWN))
+        baked = json.loads(compile_tpl("main.json", "Client", "us-east-1",
+            dict(KNOWN, BakedImageId = "ami-0bake000")))
+
+        self.assertEqual({"Ref": "BakedImageId"}, baked["Resources"]["ClientVPN"]["Properties"]["ImageId"])
+        self.assertIn("yum", user_data(stock))
+        self.assertNotIn("yum", user_data(baked))
+        self.assertIn("cfn-init", user_data(baked))
+        self.assertIn("cfn-signal", user_data(baked))
+        self.assertEqual(["900", "300"], [tpl["Resources"]["ClientWaitCondition"]["Properties"]["Timeout"]
+            for tpl in (stock, baked)])
+        self.assertNotIn("Mappings", baked)
+        self.assertNotIn("Fn::If", json.dumps(baked))
+
+        declared = set(baked["Parameters"]) | set(baked["Resources"])
+        self.assertEqual(set(), set(r for r in self.refs(baked) if not r.startswith("AWS::")) - declared)
+
+    def test_tunnel_profile(self):
+        """Throughput renders ciphers, rekey, MSS clamping and sysctls; Default none of them"""
+
+        for MySide in ("Server", "Client"):
+            for BakedImageId in ("", "ami-0bake000"):
+                rendered = {}
+                for profile in ("Default", "Throughput"):
+                    tpl = json.loads(compile_tpl("main.json", MySide, "us-east-1",
+                        dict(KNOWN, BakedImageId = BakedImageId, TunnelProfile = profile)))
+                    vpn = tpl["Resources"]["%sVPN" % MySide]
+                    files = vpn["Metadata"]["AWS::CloudFormation::Init"]["config"]["files"]
+
+                    self.assertNotIn("Conditions", tpl)
+                    rendered[profile] = dict((name, render(files[name]["content"])) for name in
+                        ("/etc/ipsec.d/instavpn.conf", "/etc/sysctl.d/60-instavpn.conf"))
+                    rendered[profile]["UserData"] = render(vpn["Properties"]["UserData"])
+
+                conf, sysctl, user_data = [rendered["Throughput"][k] for k in
+                    ("/etc/ipsec.d/instavpn.conf", "/etc/sysctl.d/60-instavpn.conf", "UserData")]
+                self.assertIn("\tphase2alg=aes_gcm128-null\n", conf)
+                self.assertIn("\tike=aes128-sha2_256;modp2048\n", conf)
+                self.assertIn("\tsalifetime=8h\n", conf)
+                self.assertIn("\trekeymargin=10m\n", conf)
+                self.assertTrue(conf.endswith("\tauto=start\n\n"))
+                self.assertIn("net.core.rmem_max = 16777216\n", sysctl)
+                self.assertIn("net.netfilter.nf_conntrack_max = 262144\n", sysctl)
+                self.assertIn("sysctl -e -p /etc/sysctl.d/60-instavpn.conf\n", user_data)
+                self.assertIn("-j TCPMSS --set-mss 1360\n", user_data)
+                self.assertLess(user_data.index("TCPMSS"), user_data.index("service ipsec restart"))
+
+                conf, sysctl, user_data = [rendered["Default"][k] for k in
+                    ("/etc/ipsec.d/instavpn.conf", "/etc/sysctl.d/60-instavpn.conf", "UserData")]
+                self.assertNotIn("phase2alg", conf)
+                self.assertNotIn("lifetime", conf)
+                self.assertNotIn("=", sysctl)
+                self.assertNotIn("TCPMSS", user_data)
+                self.assertNotIn("sysctl -e -p", user_data)
+
+    def test_health_monitor(self):
+        """Enabled on client side: the monitor file, its IAM role, and the service running it"""
+
+        for BakedImageId in ("", "ami-0bake000"):
+            body = compile_tpl("main.json", "Client", "us-east-1",
+                dict(KNOWN, BakedImageId = BakedImageId, HealthMonitor = "Enabled"))
+            tpl = json.loads(body)
+            vpn = tpl["Resources"]["ClientVPN"]
+            init = vpn["Metadata"]["AWS::CloudFormation::Init"]["config"]
+            files, services = init["files"], init["services"]["sysvinit"]
+
+            self.assertLess(len(body), 51200)
+            self.assertEqual("AWS::IAM::Role", tpl["Resources"]["ClientMonitorRole"]["Type"])
+            self.assertEqual({"Ref": "ClientMonitorProfile"}, vpn["Properties"]["IamInstanceProfile"])
+            self.assertIn("class HealthMonitor", files["/opt/instavpn/monitor.py"]["content"])
+            self.assertIn("python /opt/instavpn/monitor.py --region <AWS::Region>",
+                render(files["/etc/init.d/instavpn-monitor"]["content"]))
+            self.assertEqual(["cfn-hup", "instavpn-monitor", "ipsec"], sorted(services))
+            self.assertEqual(["ec2:ReplaceRoute"], [statement["Action"] for statement in
+                tpl["Resources"]["ClientMonitorRole"]["Properties"]["Policies"][0]["PolicyDocument"]["Statement"]
+                if "*" != statement["Resource"]][0])
+            self.assertNotIn("monitor.py", render(vpn["Properties"]["UserData"]))
+
+        disabled = json.loads(compile_tpl("main.json", "Client", "us-east-1", KNOWN))
+        vpn = disabled["Resources"]["ClientVPN"]
+        self.assertNotIn("ClientMonitorRole", disabled["Resources"])
+        self.assertEqual({"Ref": "AWS::NoValue"}, vpn["Properties"]["IamInstanceProfile"])
+        self.assertNotIn("instavpn-monitor", vpn["Metadata"]["AWS::CloudFormation::Init"]["config"]["services"]["sysvinit"])
+
+        server = json.loads(compile_tpl("main.json", "Server", "us-east-1", dict(KNOWN, HealthMonitor = "Enabled")))
+        self.assertNotIn("AWS::IAM::", json.dumps(server))
+
+    def test_unresolved(self):
+        """Without a side, conditions are left to CloudFormation"""
+
+        tpl = json.loads(compile_tpl("main.json"))
+        self.assertEqual(set(load_tpl("main.json")["Resources"]), set(tpl["Resources"]))
+        self.assertIn("Conditions", tpl)
+
+        tpl = json.loads(compile_tpl("eip.json", "TestBoth"))
+        self.assertEqual(set(["ServerDummyEIP", "ClientDummyEIP"]), set(tpl["Resources"]))
+
+    def test_memoised(self):
+        self.assertIs(load_tpl("main.json"), load_tpl("main.json"))
+        self.assertIs(compile_tpl("eip.json", "Server", "us-west-2"),
+            compile_tpl("eip.json", "Server", "us-west-2"))
+        self.assertLess(len(compile_tpl("main.json", "Server", "us-west-2")),
+            len(json.dumps(load_tpl("main.json"))) * 2 / 3)
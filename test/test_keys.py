@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from base64 import urlsafe_b64decode
+
+from lib.keys import create_shared_secret, create_shared_secrets, secret_bits
+
+class TestKeys(unittest.TestCase):
+    def test_bits(self):
+        self.assertEqual(secret_bits() / 8, len(urlsafe_b64decode(create_shared_secret())))
+        self.assertEqual(16, len(urlsafe_b64decode(create_shared_secret(128))))
+
+    def test_bulk(self):
+        secrets = create_shared_secrets(100, 256)
+        self.assertEqual(100, len(set(secrets)))
+        self.assertTrue(all(32 == len(urlsafe_b64decode(s)) for s in secrets))
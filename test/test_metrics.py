@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from lib.aws_conn import AWSConn
+from lib.metrics import ApiMetrics, api_metrics, is_throttling
+
+class FakeResponse(object):
+    def __init__(self, status, body = ""):
+        self.status, self.body = status, body
+
+    def read(self):
+        return self.body
+
+class FakeAuth(object):
+    def add_auth(self, request, **kwargs):
+        pass
+
+class FakeBotoConn(object):
+    """Signs once per attempt, as boto's _mexe does"""
+
+    def __init__(self, script):
+        self._auth_handler = FakeAuth()
+        self.script = list(script) # [(attempts, response or exception)]
+
+    def make_request(self, action, params = None, path = '/', verb = 'GET'):
+        attempts, ret = self.script.pop(0)
+        for _ in range(attempts):
+            self._auth_handler.add_auth(None)
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+THROTTLED = ("<Response><Errors><Error><Code>RequestLimitExceeded</Code>"
+    "<Message>Request limit exceeded.</Message></Error></Errors></Response>")
+
+class TestApiMetrics(unittest.TestCase):
+    def setUp(self):
+        from lib.retry import RetryPolicy
+
+        api_metrics.reset()
+        self.sleeps = []
+        self._policy, AWSConn.retry_policy = AWSConn.retry_policy, RetryPolicy(sleep = self.sleeps.append)
+
+    def tearDown(self):
+        api_metrics.reset()
+        AWSConn.retry_policy = self._policy
+
+    def test_instrumented(self):
+        """Calls, boto retries, errors and throttling per side, service, region and action"""
+
+        conn = AWSConn({"region": "us-west-2"}, "cafe", "client")._instrument(FakeBotoConn([
+            (1, FakeResponse(200)), (3, FakeResponse(200)), (1, FakeResponse(503, THROTTLED)),
+            (1, FakeResponse(200)), (1, IOError("reset"))]), "ec2")
+
+        for _ in range(3):
+            self.assertEqual(200, conn.make_request("DescribeRouteTables").status)
+        self.assertRaises(IOError, conn.make_request, "CreateRoute")
+
+        # Throttled request was retried once after a backoff
+        self.assertEqual(1, len(self.sleeps))
+
+        rows = dict((r["action"], r) for r in api_metrics.rows())
+        self.assertEqual(("client", "ec2", "us-west-2"), (rows["CreateRoute"]["side"],
+            rows["CreateRoute"]["service"], rows["CreateRoute"]["region"]))
+        self.assertEqual((4, 1, 1, 3), tuple(rows["DescribeRouteTables"][f]
+            for f in ("calls", "errors", "throttled", "retries")))
+        self.assertEqual((1, 1, 0), tuple(rows["CreateRoute"][f]
+            for f in ("calls", "errors", "throttled")))
+        self.assertEqual(5, api_metrics.totals()["calls"])
+
+    def test_is_throttling(self):
+        from boto.exception import EC2ResponseError
+        self.assertTrue(is_throttling(EC2ResponseError(503, "Unavailable", THROTTLED)))
+        self.assertFalse(is_throttling(ValueError()))
+
+    def test_record(self):
+        metrics = ApiMetrics()
+        metrics.record("server", "cloudformation", "us-east-1", "DescribeStacks", 0.5, error = "Throttling")
+        metrics.record("server", "cloudformation", "us-east-1", "DescribeStacks", 1.5)
+
+        row, = metrics.rows()
+        self.assertEqual((2, 1, 1, 2.0, 1.5), tuple(row[f]
+            for f in ("calls", "errors", "throttled", "seconds", "max_seconds")))
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from lib.monitor import HealthMonitor, Routes, TAG, sa_established, wait_for_peers
+
+from fake_aws import FakeClock, FakeEC2, StandIn
+
+CIDRS = ("172.16.0.0/24", "172.16.1.0/24")
+
+class TestHealthMonitor(unittest.TestCase):
+    """Both client instances, i-a active and i-b standby, against a FakeEC2"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.ec2 = FakeEC2(self.clock)
+        vpc = self.ec2.add_vpc("10.0.0.0/16")
+        self.rtbs = [self.ec2.add_route_table(vpc) for _ in range(2)]
+        for rtb in self.rtbs:
+            for cidr in CIDRS:
+                self.ec2.create_route(rtb.id, cidr, instance_id = "i-a")
+            self.ec2.create_route(rtb.id, "192.168.0.0/16", instance_id = "i-nat")
+
+    def monitor(self, me, healthy, alive, threshold = 3):
+        return HealthMonitor(me, "i-b" if "i-a" == me else "i-a",
+            Routes(StandIn(self.ec2, self.clock, latency = 0.05)), healthy, alive,
+            threshold = threshold, interval = 1.0, clock = self.clock.time, sleep = self.clock.sleep)
+
+    def targets(self):
+        return sorted(set((r.destination_cidr_block, r.instance_id)
+            for rtb in self.rtbs for r in rtb.routes if r.instance_id))
+
+    def test_active_unhealthy(self):
+        """The active instance moves its routes away once it fails `threshold` checks"""
+
+        monitor = self.monitor("i-a", healthy = lambda: self.clock.now < 10, alive = lambda: True)
+        monitor.run(30)
+
+        failover, = monitor.failovers
+        self.assertEqual(("i-a", "i-b", 4), (failover["from"], failover["to"], failover["routes"]))
+        self.assertEqual([(CIDRS[0], "i-b"), (CIDRS[1], "i-b"), ("192.168.0.0/16", "i-nat")], self.targets())
+
+        # 3 failed checks a second apart, and the API calls replacing routes
+        self.assertGreater(failover["latency"], 3)
+        self.assertLess(failover["latency"], 3.5)
+
+    def test_standby_takes_over(self):
+        """The standby instance moves routes to itself once the active one stops answering"""
+
+        monitor = self.monitor("i-b", healthy = lambda: True, alive = lambda: self.clock.now < 10)
+        monitor.run(30)
+
+        self.assertEqual(["i-b"], [f["to"] for f in monitor.failovers])
+        self.assertEqual([(CIDRS[0], "i-b"), (CIDRS[1], "i-b")], self.targets()[:2])
+
+    def test_unfit_target(self):
+        """Routes stay on a failing active instance rather than go to an unhealthy one"""
+
+        monitor = self.monitor("i-b", healthy = lambda: False, alive = lambda: self.clock.now < 10)
+        monitor.run(30)
+
+        self.assertEqual([], monitor.failovers)
+        self.assertEqual([(CIDRS[0], "i-a"), (CIDRS[1], "i-a")], self.targets()[:2])
+
+    def test_no_flapping(self):
+        """Sporadic failures below the threshold don't fail over"""
+
+        monitor = self.monitor("i-a", healthy = lambda: int(self.clock.now) % 3 != 0, alive = lambda: True,
+            threshold = 2)
+        monitor.run(60)
+
+        self.assertEqual([], monitor.failovers)
+        self.assertEqual(0, self.ec2.calls.get("ReplaceRoute", 0))
+
+    def test_fail_back(self):
+        """Each monitor follows failovers made by the other one"""
+
+        # i-a is briefly unreachable from i-b, which takes over, then i-b dies
+        a = self.monitor("i-a", healthy = lambda: True, alive = lambda: self.clock.now < 40)
+        b = self.monitor("i-b", healthy = lambda: True, alive = lambda: not 10 <= self.clock.now < 20)
+
+        while self.clock.now < 60:
+            started = self.clock.now
+            a.check()
+            if self.clock.now < 40:
+                b.check()
+            self.clock.sleep(max(0, 1 - (self.clock.now - started)))
+
+        self.assertEqual([("i-a", "i-b")], [(f["from"], f["to"]) for f in b.failovers])
+        self.assertEqual([("i-b", "i-a")], [(f["from"], f["to"]) for f in a.failovers])
+        self.assertEqual([(CIDRS[0], "i-a"), (CIDRS[1], "i-a")], self.targets()[:2])
+
+    def test_check_errors(self):
+        """Failing probes are logged, and the monitor keeps checking"""
+
+        logged = []
+        def healthy():
+            raise OSError("ipsec: not found")
+
+        monitor = self.monitor("i-a", healthy = healthy, alive = lambda: True)
+        monitor.log = logged.append
+        monitor.run(3)
+
+        self.assertEqual(3, len([msg for msg in logged if "ipsec: not found" in msg]))
+        self.assertEqual(3.0, self.clock.now)
+
+class TestWaitForPeers(unittest.TestCase):
+    def test_errors_retried(self):
+        """API errors while waiting for the tag are logged, not fatal"""
+
+        clock = FakeClock()
+        ec2 = FakeEC2(clock)
+        me, other = ec2.add_instance("10.0.1.10"), ec2.add_instance("10.0.1.20")
+
+        def sleep(seconds):
+            clock.sleep(seconds)
+            if clock.now >= 30:
+                ec2.create_tags([me.id], {TAG: "%s 10.0.0.10" % other.id})
+
+        get_all_tags, logged = ec2.get_all_tags, []
+        def flaky(*args, **kwargs):
+            if clock.now < 20:
+                from boto.exception import EC2ResponseError
+                raise EC2ResponseError(503, "Service Unavailable", "RequestLimitExceeded")
+            return get_all_tags(*args, **kwargs)
+        ec2.get_all_tags = flaky
+
+        self.assertEqual((other.id, "10.0.0.10", "10.0.1.20"),
+            wait_for_peers(ec2, me.id, sleep = sleep, log = logged.append))
+        self.assertEqual(30, clock.now)
+        self.assertEqual(2, len([msg for msg in logged if msg.startswith("Can't read tag")]))
+        self.assertEqual(1, len([msg for msg in logged if msg.startswith("Waiting for tag")]))
+
+class TestProbes(unittest.TestCase):
+    def test_sa_established(self):
+        status = ('000 #2: "instavpn/1x1":4500 STATE_QUICK_I2 (sent QI2, IPsec SA established); '
+            'EVENT_SA_REPLACE in 27948s; newest IPSEC; eroute owner; isakmp#1; idle; import:admin initiate\n')
+
+        self.assertTrue(sa_established(status))
+        self.assertFalse(sa_established('000 #1: "instavpn/1x1":4500 STATE_MAIN_I3 (sent MI3, expecting MR3)\n'))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import traceback
+import unittest
+from lib.parallel import run_parallel
+
+class TestParallel(unittest.TestCase):
+    def test_run_parallel(self):
+        """Tasks run concurrently and results are keyed"""
+
+        started = time.time()
+        ret = run_parallel({
+            "client": lambda: time.sleep(0.2) or "c",
+            "server": lambda: time.sleep(0.2) or "s",
+        })
+
+        self.assertEqual(ret, {"client": "c", "server": "s"})
+        self.assertLess(time.time() - started, 0.35)
+
+    def test_run_parallel_raises(self):
+        """Failures are re-raised after all tasks finished"""
+
+        done = []
+
+        def _fail():
+            raise ValueError("boom")
+
+        self.assertRaisesRegexp(ValueError, "boom", run_parallel, {
+            "client": _fail,
+            "server": lambda: done.append(True),
+        })
+        self.assertEqual(done, [True])
+
+    def test_worker_traceback(self):
+        """The re-raised exception carries the traceback of the worker thread"""
+
+        def _worker_fails():
+            raise ValueError("boom")
+
+        try:
+            run_parallel({"client": _worker_fails, "server": lambda: None})
+        except ValueError:
+            frames = [frame[2] for frame in traceback.extract_tb(sys.exc_info()[2])]
+        self.assertIn("_worker_fails", frames)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import bench_provision
+
+# API calls per deployment, check and build; 88-90 when measured
+CALLS_BUDGET = 100
+
+class TestProvision(unittest.TestCase):
+    """End-to-end runs of bench_provision, fast-forwarded"""
+
+    def test_calls(self):
+        """Deployments are built within the API call budget"""
+
+        r = bench_provision.run(3, speedup = 2000)
+
+        self.assertEqual([], r["errors"])
+        self.assertEqual(3, r["built"])
+        self.assertLessEqual(r["calls"], 3 * CALLS_BUDGET)
+        self.assertEqual(6, r["by_action"]["CreateStack"])
+        self.assertEqual(6, r["by_action"]["UpdateStack"])
+
+    def test_single_pass(self):
+        """EIPs are allocated with EC2, and every stack is created once"""
+
+        r = bench_provision.run(3, speedup = 2000, single_pass = True)
+
+        self.assertEqual(3, r["built"])
+        self.assertEqual(6, r["by_action"]["AllocateAddress"])
+        self.assertEqual(6, r["by_action"]["CreateStack"])
+        self.assertEqual(0, r["by_action"]["UpdateStack"])
+
+    def test_throttled(self):
+        """Throttled calls are retried until every deployment is built"""
+
+        r = bench_provision.run(3, rate = 1, speedup = 2000)
+
+        self.assertEqual(3, r["built"])
+        self.assertGreater(r["throttled"], 0)
+        self.assertGreater(r["retries"], 0)
+
+    def test_throttling_raised(self):
+        """EC2 throttling raised as RequestLimitExceeded is retried just the same"""
+
+        r = bench_provision.run(3, rate = 1, speedup = 2000, raising = True)
+
+        self.assertEqual([], r["errors"])
+        self.assertEqual(3, r["built"])
+        self.assertGreater(r["throttled"], 0)
+        self.assertGreater(r["retries"], 0)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from lib.resources import SideResources
+
+from fake_aws import FakeEC2, fake_conn
+
+class TestSideResources(unittest.TestCase):
+    def setUp(self):
+        self.ec2 = FakeEC2(vpc_size = 20)
+        self.vpc = self.ec2.add_vpc("172.31.0.0/16")
+        self.subnet = self.ec2.add_subnet(self.vpc, "172.31.1.0/24")
+        self.rtb = self.ec2.add_route_table(self.vpc, [self.subnet.id])
+        self.res = SideResources(fake_conn(vpc = self.ec2), self.subnet.id)
+
+    def test_prefetch(self):
+        """One filtered describe per resource type"""
+
+        self.res.prefetch()
+        for _ in range(3):
+            self.assertEqual(self.vpc.cidr_block, self.res.vpc.cidr_block)
+            self.assertEqual(self.rtb, self.res.route_table(self.rtb.id))
+            self.assertEqual(1, len(self.res.igws))
+            self.assertEqual(2, len(self.res.route_tables))
+
+        self.assertEqual(self.ec2.calls, {"DescribeSubnets": 1, "DescribeVpcs": 1,
+            "DescribeRouteTables": 1, "DescribeInternetGateways": 1})
+
+    def test_invalidate(self):
+        self.res.route_tables
+        self.res.invalidate("route_tables")
+        self.res.route_tables
+        self.assertEqual(2, self.ec2.calls["DescribeRouteTables"])
+        self.assertEqual(1, self.ec2.calls["DescribeSubnets"])
+
+    def test_route_table_outside_vpc(self):
+        """Route tables from other VPCs are still found, for the checker to reject"""
+        other = self.ec2.add_route_table(self.ec2.add_vpc("192.168.0.0/16"))
+        self.assertEqual(other.vpc_id, self.res.route_table(other.id).vpc_id)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from boto.exception import BotoServerError
+
+from lib.retry import RetryPolicy, TokenBucket
+
+from fake_aws import FakeClock
+
+def server_error(code):
+    return BotoServerError(400, "Bad Request",
+        "<ErrorResponse><Error><Code>%s</Code></Error></ErrorResponse>" % code)
+
+class TestRetryPolicy(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.policy = RetryPolicy(max_attempts = 4, base = 1, cap = 3,
+            sleep = self.sleeps.append, rand = lambda: 1.0)
+
+    def failing(self, errors):
+        errors = list(errors)
+        def _fn():
+            if errors:
+                raise errors.pop(0)
+            return "done"
+        return _fn
+
+    def test_backoff(self):
+        """Retryable errors back off exponentially, up to cap"""
+        self.assertEqual("done", self.policy.call(self.failing([server_error("Throttling")] * 3)))
+        self.assertEqual([1, 2, 3], self.sleeps)
+
+    def test_gives_up(self):
+        self.assertRaises(BotoServerError, self.policy.call,
+            self.failing([server_error("RequestLimitExceeded")] * 4))
+        self.assertEqual(3, len(self.sleeps))
+
+    def test_not_retryable(self):
+        self.assertRaises(BotoServerError, self.policy.call,
+            self.failing([server_error("ValidationError")]))
+        self.assertEqual("done", self.policy.call(self.failing([server_error("ValidationError")]),
+            retry_on = lambda e: "ValidationError" == e.error_code))
+        self.assertRaises(KeyError, self.policy.call, self.failing([KeyError()]))
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        """Burst goes through, then one request per 1/rate seconds"""
+
+        clock = FakeClock()
+        tokens = TokenBucket(rate = 10, burst = 5, clock = clock.time, sleep = clock.sleep)
+
+        for _ in range(25):
+            tokens.acquire()
+        self.assertAlmostEqual(2.0, clock.now)
+
+    def test_throttled(self):
+        clock = FakeClock()
+        tokens = TokenBucket(rate = 10, burst = 1, clock = clock.time, sleep = clock.sleep)
+
+        tokens.throttled()
+        self.assertEqual(5, tokens.rate)
+        for _ in range(10):
+            tokens.succeeded()
+        self.assertEqual(10, tokens.rate)
+
+    def test_shared_across_threads(self):
+        """Concurrent callers never exceed the burst plus rate"""
+
+        tokens = TokenBucket(rate = 200, burst = 10)
+        threads = [threading.Thread(target = lambda: [tokens.acquire() for _ in range(10)])
+            for _ in range(8)]
+
+        started = tokens.clock()
+        for t in threads: t.start()
+        for t in threads: t.join()
+
+        self.assertGreaterEqual(tokens.clock() - started, (80 - 10) / 200.0 * 0.9)
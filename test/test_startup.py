@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import json
+import subprocess
+import sys
+import unittest
+from os.path import dirname, abspath
+
+import lib
+
+SRC = dirname(dirname(abspath(lib.__file__)))
+
+# See "Startup time" in doc/USAGE.md
+HEAVY_MODULES = ("boto", "lib.checker", "lib.actuator", "lib.fleet", "lib.config")
+
+class TestStartup(unittest.TestCase):
+    def measure(self, modules = ("instavpn",)):
+        out = subprocess.check_output([sys.executable, "-c",
+            "import json, sys, time\n"
+            "started = time.time()\n"
+            "import %s\n"
+            "print(json.dumps([time.time() - started, sorted(sys.modules)]))\n" % ", ".join(modules)], cwd = SRC)
+        return json.loads(out)
+
+    def test_no_heavy_imports(self):
+        """Importing instavpn leaves boto and the modules built on it alone"""
+        seconds, modules = self.measure()
+        self.assertEqual([], [m for m in HEAVY_MODULES if m in modules])
+
+    def test_import_budget(self):
+        """instavpn imports in a fraction of the time the heavy modules take, on the same machine"""
+        # Best of three, to tolerate a cold disk cache
+        seconds = min(self.measure()[0] for _ in range(3))
+        heavy = min(self.measure(("instavpn",) + HEAVY_MODULES)[0] for _ in range(3))
+        self.assertLess(seconds, heavy / 2)
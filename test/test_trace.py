@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from lib import trace
+from lib.aws_conn import AWSConn
+
+class TestTrace(unittest.TestCase):
+    def tearDown(self):
+        trace.disable()
+
+    def test_disabled(self):
+        @trace.traced("test")
+        def _fn(x):
+            return x * 2
+
+        trace.enable()
+        trace.disable()
+
+        with trace.span("nothing"):
+            self.assertEqual(4, _fn(2))
+        self.assertEqual([], trace.summary()["spans"])
+
+    def test_spans(self):
+        @trace.traced("test")
+        def _fn(x):
+            with trace.span("inner", "test", x = x):
+                if x < 0:
+                    raise ValueError(x)
+                return x
+
+        trace.enable()
+        _fn(1)
+        _fn(2)
+        self.assertRaises(ValueError, _fn, -1)
+
+        spans = dict((s["name"], s) for s in trace.summary()["spans"])
+        self.assertEqual(3, spans["_fn"]["count"])
+        self.assertEqual(3, spans["inner"]["count"])
+
+        events = trace.chrome_trace()["traceEvents"]
+        self.assertEqual("M", events[0]["ph"])
+        complete = [e for e in events if "X" == e["ph"]]
+        self.assertEqual(6, len(complete))
+        self.assertEqual({"x": -1, "error": "ValueError"}, complete[-1]["args"])
+        self.assertTrue(all(e["ts"] >= 0 and e["dur"] >= 0 for e in complete))
+
+    def test_aws_calls(self):
+        """Connections from AWSConn trace each API call"""
+
+        class FakeConn(object):
+            def make_request(self, action, params = None, path = '/', verb = 'GET'):
+                return action
+
+        conn = AWSConn({"region": "us-east-1"})._instrument(FakeConn(), "ec2")
+
+        trace.enable()
+        self.assertEqual("DescribeVpcs", conn.make_request("DescribeVpcs", {}))
+
+        spans = trace.summary()["spans"]
+        self.assertEqual(["ec2.DescribeVpcs"], [s["name"] for s in spans])
+        self.assertEqual("aws", spans[0]["cat"])
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from lib.cidr import split_cidr
+from lib.tunnels import shard, shard_config, tunnel_count
+
+def server(subnets, ips, weights = None):
+    ipsec = {"subnets": subnets}
+    if weights is not None:
+        ipsec["weights"] = weights
+    return {"ipsec": ipsec, "res": {"servers_allowed": [
+        {"proto": "tcp", "ip": ip, "port": "443"} for ip in ips]}}
+
+class TestShard(unittest.TestCase):
+    def test_split_cidr(self):
+        self.assertEqual(["10.0.0.0/17", "10.0.128.0/17"], split_cidr("10.0.0.0/16"))
+        self.assertEqual(["10.0.0.4/32", "10.0.0.5/32"], split_cidr("10.0.0.4/31"))
+        self.assertRaises(ValueError, split_cidr, "10.0.0.4/32")
+
+    def test_single(self):
+        self.assertEqual([["10.0.0.0/24", "10.1.0.0/16"]], shard(["10.1.0.0/16", "10.0.0.0/24"], 1))
+
+    def test_by_size(self):
+        """The /16 outweighs both /17s, which end up together"""
+        self.assertEqual([["10.0.0.0/16"], ["10.1.0.0/17", "10.1.128.0/17"]],
+            shard(["10.1.0.0/17", "10.0.0.0/16", "10.1.128.0/17"], 2))
+
+    def test_by_weight(self):
+        """Declared weights win over sizes; undeclared prefixes weigh 1"""
+        self.assertEqual([["10.1.0.0/24"], ["10.2.0.0/24"], ["10.0.0.0/16", "10.3.0.0/24"]],
+            shard(["10.0.0.0/16", "10.1.0.0/24", "10.2.0.0/24", "10.3.0.0/24"], 3,
+                {"10.1.0.0/24": 5, "10.2.0.0/24": 4}))
+
+    def test_split(self):
+        """Fewer prefixes than tunnels: the largest ones are halved"""
+        self.assertEqual([["10.0.0.0/17"], ["10.0.128.0/17"], ["10.1.0.0/24"]],
+            shard(["10.0.0.0/16", "10.1.0.0/24"], 3))
+        self.assertEqual([["10.0.0.0/26"], ["10.0.0.64/26"], ["10.0.0.128/26"], ["10.0.0.192/26"]],
+            shard(["10.0.0.0/24"], 4))
+        self.assertRaises(ValueError, shard, ["10.0.0.1/32"], 2)
+
+    def test_balanced(self):
+        """Every tunnel gets a share, within 4/3 of the ideal load"""
+        cidrs = ["10.%d.0.0/%d" % (i, 16 + i % 8) for i in range(40)]
+        size = lambda cidr: 2 ** (32 - int(cidr.split("/")[1]))
+
+        shards = shard(cidrs, 6)
+        loads = [sum(size(cidr) for cidr in tunnel) for tunnel in shards]
+
+        self.assertEqual(sorted(cidrs), sorted(sum(shards, [])))
+        self.assertLessEqual(max(loads), sum(loads) / 6.0 * 4 / 3)
+
+class TestShardConfig(unittest.TestCase):
+    def test_servers_follow_prefixes(self):
+        config = {"tunnels": 2, "server": server(["10.0.0.0/24"], ["10.0.0.10", "10.0.0.200", "10.0.0.20"])}
+
+        shards = shard_config(config)
+
+        self.assertEqual([["10.0.0.0/25"], ["10.0.0.128/25"]], [s["cidrs"] for s in shards])
+        self.assertEqual([["10.0.0.10", "10.0.0.20"], ["10.0.0.200"]],
+            [[dest["ip"] for dest in s["servers_allowed"]] for s in shards])
+
+    def test_default(self):
+        config = {"server": server(["10.0.0.0/24"], ["10.0.0.10"])}
+
+        self.assertEqual(1, tunnel_count(config))
+        self.assertEqual([{"cidrs": ["10.0.0.0/24"], "servers_allowed": config["server"]["res"]["servers_allowed"]}],
+            shard_config(config))
+
+    def test_unreachable(self):
+        config = {"tunnels": 2, "server": server(["10.0.0.0/24"], ["10.9.0.1"])}
+        self.assertRaises(ValueError, shard_config, config)
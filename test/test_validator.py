@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import json
+import shutil
+import tempfile
+import unittest
+from os.path import join
+
+from lib.io import load_config
+from lib.validator import validate_config, validate_paths
+
+def make_config(**kwargs):
+    config = load_config("default_config.json")
+    config["client"]["name"] = "acme"
+    config["params"]["InstanceType"] = "t2.micro"
+    for side in ("server", "client"):
+        config[side]["res"]["subnet_id"] = "subnet-1234abcd"
+    config["server"]["ipsec"]["subnets"] = ["10.0.0.0/16"]
+    config["client"]["ipsec"]["subnets"] = ["172.16.0.0/16"]
+    config["server"]["res"]["servers_allowed"] = [{"proto": "tcp", "ip": "10.0.1.1", "port": "443"}]
+    return config
+
+class TestValidateConfig(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(([], []), validate_config(make_config()))
+
+    def test_all_errors(self):
+        """Every error is reported, missing sections only once"""
+
+        config = make_config()
+        del config["server"]["identity"]
+        config["client"]["name"] = "bad name"
+        config["client"]["res"]["route_table_id"] = "rtb-1"
+        config["client"]["ipsec"]["subnets"] = ["10.0.1.0/24", "300.0.0.0/8"]
+        config["params"]["InstanceType"] = "x9.huge"
+        config["params"]["TunnelProfile"] = "Turbo"
+        config["server"]["res"]["servers_allowed"] += [
+            {"proto": "all", "ip": "192.168.0.1", "port": "22"},
+            {"proto": "icmp", "ip": "10.0.0.1.1", "port": "99999"}]
+
+        errors, warnings = validate_config(config)
+
+        self.assertEqual(errors, [
+            "server.identity: missing",
+            "client.name: invalid value bad name",
+            "client.res.route_table_id: invalid value rtb-1",
+            "params.InstanceType: invalid value x9.huge",
+            "params.TunnelProfile: invalid value Turbo",
+            "server.res.servers_allowed[1]: port must be `all` if proto = `all`",
+            "server.res.servers_allowed[2]: invalid proto icmp",
+            "server.res.servers_allowed[2]: invalid ip 10.0.0.1.1",
+            "server.res.servers_allowed[2]: invalid port 99999",
+            "client.ipsec.subnets: invalid CIDR 300.0.0.0/8",
+            "Conflict between subnet (10.0.0.0/16, 10.0.1.0/24)",
+        ])
+        self.assertEqual(1, len(warnings))
+        self.assertIn("192.168.0.1", warnings[0])
+
+    def test_tunnels(self):
+        config = make_config()
+        config["tunnels"] = 4
+        config["server"]["ipsec"]["weights"] = {"10.0.0.0/16": 2.5}
+        self.assertEqual(([], []), validate_config(config))
+
+        config["tunnels"] = 0
+        config["server"]["ipsec"]["weights"] = {"10.0.0.0/16": "heavy"}
+        self.assertEqual(["tunnels: should be a positive integer",
+            "server.ipsec.weights: should map CIDRs to positive numbers"], validate_config(config)[0])
+
+    def test_ha(self):
+        config = make_config()
+        config["ha"] = True
+        self.assertEqual(([], []), validate_config(config))
+
+        config["ha"] = "yes"
+        self.assertEqual(["ha: should be true or false"], validate_config(config)[0])
+
+    def test_not_a_dict(self):
+        self.assertEqual((["config should be a dict"], []), validate_config([]))
+
+class TestValidatePaths(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_directory_and_ndjson(self):
+        bad = make_config()
+        bad["client"]["name"] = None
+
+        with open(join(self.tmp, "good.json"), "w") as fp:
+            json.dump(make_config(), fp)
+        with open(join(self.tmp, "broken.json"), "w") as fp:
+            fp.write("{")
+        with open(join(self.tmp, "many.ndjson"), "w") as fp:
+            for config in [make_config(), bad] * 10:
+                fp.write(json.dumps(config) + "\n")
+
+        for jobs in (1, 2):
+            results = validate_paths([self.tmp, join(self.tmp, "many.ndjson")], jobs)
+
+            self.assertEqual(22, len(results))
+            self.assertEqual([join(self.tmp, "broken.json"), join(self.tmp, "good.json")],
+                [r[0] for r in results[:2]])
+            self.assertTrue(results[0][1][0].startswith("invalid json"))
+            self.assertEqual([], results[1][1])
+            self.assertEqual(["client.name: required"], results[3][1])
+            self.assertEqual(join(self.tmp, "many.ndjson") + ":2", results[3][0])
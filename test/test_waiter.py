@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from lib.waiter import StackWaiter
+
+from fake_aws import FakeClock, FakeCloudFormation
+
+class TestStackWaiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def waiter(self, cfn, **kwargs):
+        return StackWaiter(cfn, "stack", sleep=self.clock.sleep, clock=self.clock.time, **kwargs)
+
+    def test_wait_complete(self):
+        """Returns within one interval after the stack completes, streams every event"""
+
+        cfn = FakeCloudFormation(self.clock, [
+            ("SG", "AWS::EC2::SecurityGroup", 5),
+            ("VPN", "AWS::EC2::Instance", 60),
+        ])
+        cfn.create_stack("stack")
+
+        seen = []
+        self.assertEqual("CREATE_COMPLETE",
+            self.waiter(cfn, on_event=seen.append, max_interval=10).wait())
+
+        stack = cfn.stacks["stack"]
+        self.assertLessEqual(self.clock.now - stack.completed_at, 10)
+        self.assertEqual([e.event_id for e in seen], [e.event_id for _, e in stack.timeline])
+
+    def test_wait_failed(self):
+        """Raises as soon as the stack starts rolling back"""
+
+        cfn = FakeCloudFormation(self.clock, [
+            ("SG", "AWS::EC2::SecurityGroup", 5),
+            ("VPN", "AWS::EC2::Instance", 60),
+        ], fail_at="SG")
+        cfn.create_stack("stack")
+
+        self.assertRaisesRegexp(Exception, "ROLLBACK_IN_PROGRESS", self.waiter(cfn).wait)
+        self.assertLess(self.clock.now, 10)
+
+    def test_timeout(self):
+        """A stack stuck in progress raises once `timeout` is up"""
+
+        cfn = FakeCloudFormation(self.clock, [("VPN", "AWS::EC2::Instance", 7200)])
+        cfn.create_stack("stack")
+
+        self.assertRaisesRegexp(Exception, "still in progress after 600s",
+            self.waiter(cfn, timeout=600).wait)
+        self.assertGreaterEqual(self.clock.now, 600)
+        self.assertLess(self.clock.now, 610)
+
+    def test_wait_deleted(self):
+        """Returns once the stack is gone by its name, its earlier events ignored"""
+
+        cfn = FakeCloudFormation(self.clock, [("VPN", "AWS::EC2::Instance", 60)], delete_seconds=300)
+        cfn.create_stack("stack")
+        self.clock.sleep(100)
+        cfn.delete_stack("stack")
+
+        self.assertEqual("DELETE_COMPLETE", self.waiter(cfn).wait_deleted())
+        self.assertGreaterEqual(self.clock.now, 400)
+        self.assertLess(self.clock.now, 410)
+        self.assertFalse(cfn.exists("stack"))
+
+    def test_mark(self):
+        """Events before mark() are skipped, also across pages"""
+
+        cfn = FakeCloudFormation(self.clock, [
+            ("R%d" % i, "AWS::EC2::EIP", 1) for i in range(30)
+        ])
+        cfn.page_size = 7
+        cfn.create_stack("stack")
+        self.clock.sleep(100)
+
+        waiter = self.waiter(cfn).mark()
+        cfn.update_stack("stack")
+
+        seen = []
+        waiter.on_event = seen.append
+        self.assertEqual("UPDATE_COMPLETE", waiter.wait())
+        self.assertEqual(len(seen), 62)
+        self.assertEqual("UPDATE_IN_PROGRESS", seen[0].resource_status)